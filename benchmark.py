@@ -0,0 +1,310 @@
+'''
+benchmarks the download -> preprocess -> validate -> plot pipeline on synthetic data, so that changes can be compared run to run.
+
+synthetic ERA5 (era5_YYYY_MM_<vars>.nc) and GCM (atm_<scenario>_YYYY_MM.nc4) files are generated at a configurable resolution
+and duration, and served by stand-ins for the CDS client and the scidb HTTP endpoint, so nothing leaves the machine.
+every stage runs in a fresh process, which reports wall and cpu time, peak RSS and throughput (grid-cell-days per second).
+results can be saved as a baseline and later runs compared against it, flagging stages that got slower or bigger.
+
+    python benchmark.py --months 3 --save-baseline
+    python benchmark.py --months 3                  # compares against ./benchmark_baseline.json
+
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ERA5_NAMES = {'2m_temperature': 't2m', 'total_precipitation': 'tp'}
+STAGES = ('download_era5', 'download_gcm', 'preprocess_era5', 'preprocess_gcm', 'validate_era5', 'validate_gcm', 'pyramid', 'plot', 'cold_start')
+HEAVY = ('numpy', 'pandas', 'xarray', 'scipy', 'matplotlib', 'cartopy', 'requests', 'cdsapi', 'pyarrow') # a cold start should load none
+
+############## SYNTHETIC DATA
+
+def _field(lat: np.ndarray, lon: np.ndarray, times: pd.DatetimeIndex, rng: np.random.Generator) -> np.ndarray:
+    'a temperature-like field in kelvin shaped (time, lat, lon): warm tropics, a seasonal cycle, a daily cycle and noise'
+    base = 300 - 45 * np.sin(np.deg2rad(lat))[:, None] ** 2 + 2 * np.cos(np.deg2rad(lon))[None, :]
+    season = 10 * np.sin(2 * np.pi * (times.dayofyear.to_numpy() / 365.25))[:, None, None] * np.sign(lat)[None, :, None]
+    day = 3 * np.sin(2 * np.pi * times.hour.to_numpy() / 24)[:, None, None]
+    return (base[None] + season + day + rng.normal(0, 1, (len(times), len(lat), len(lon)))).astype(np.float32)
+
+def synthetic_era5(save_to: str, year: int, month: int, variables=('2m_temperature',), resolution=0.25, hours=4, seed=0, days:list=None) -> str:
+    '''
+    writes one month of ERA5-shaped single level data as data_downloader names it, returns the path.
+    hours is a number of evenly spaced timestamps per day or a list of 'HH:MM' (like a cds request's 'time'), days the days
+    of the month (every day by default). values are generated a day at a time into one float32 array per variable,
+    so that the temporaries stay a day big even at 0.25 degrees.
+    '''
+    import xarray as xr
+    rng = np.random.default_rng([seed, year, month])
+    lat, lon = np.arange(90, -90 - resolution / 2, -resolution), np.arange(0, 360, resolution)
+    start = pd.Timestamp(year, month, 1)
+    offsets = [pd.Timedelta(h + ':00') for h in hours] if isinstance(hours, (list, tuple)) else [pd.Timedelta(hours=24 // hours * i) for i in range(hours)]
+    days = [int(d) for d in days] if days else range(1, start.days_in_month + 1)
+    times = pd.DatetimeIndex([start + pd.Timedelta(days=d - 1) + o for d in days for o in offsets])
+    data = {}
+    for v in variables:
+        values = np.empty((len(times), len(lat), len(lon)), dtype=np.float32)
+        for begin in range(0, len(times), len(offsets)):
+            block = _field(lat, lon, times[begin:begin + len(offsets)], rng)
+            values[begin:begin + len(offsets)] = np.clip((block - 290) * 1e-4, 0, None) if v == 'total_precipitation' else block
+        data[ERA5_NAMES[v]] = (('time', 'latitude', 'longitude'), values)
+    path = f"{save_to}era5_{year:04d}_{month:02d}_{'+'.join(variables)}.nc"
+    xr.Dataset(data, coords={'time': times, 'latitude': lat, 'longitude': lon}).to_netcdf(path)
+    return path
+
+def synthetic_gcm(save_to: str, year: int, month: int, scenario='ssp245', resolution=1.25, levels=(100000., 85000., 50000.), seed=0) -> str:
+    'writes one month of 6-hourly GCM-shaped output (ta on pressure levels, psl) as atm_{scenario}_YYYY_MM.nc4, returns the path'
+    import xarray as xr
+    rng = np.random.default_rng([seed, year, month, 1])
+    lat, lon = np.linspace(-90, 90, int(round(180 / resolution)) + 1), np.arange(0, 360, resolution)
+    start = pd.Timestamp(year, month, 1)
+    times = pd.date_range(start, start + pd.offsets.MonthEnd(0) + pd.Timedelta(hours=18), freq='6H')
+    surface = _field(lat, lon, times, rng)
+    ta = np.stack([surface - 6.5e-3 * 44330 * (1 - (p / 100000.) ** 0.19) for p in levels], axis=1)
+    psl = (101325 + rng.normal(0, 800, surface.shape)).astype(np.float32)
+    path = f'{save_to}atm_{scenario}_{year:04d}_{month:02d}.nc4'
+    xr.Dataset({'ta': (('time', 'lev', 'lat', 'lon'), ta), 'psl': (('time', 'lat', 'lon'), psl)},
+        coords={'time': times, 'lev': np.asarray(levels), 'lat': lat, 'lon': lon}).to_netcdf(path)
+    return path
+
+############## STUB BACKENDS
+
+class StubCDSResult:
+    def __init__(self, request: dict, resolution: float, hours: int):
+        self.request, self.resolution, self.hours = request, resolution, hours
+        self.reply = {'state': 'completed'}
+
+    def update(self):
+        pass
+
+    def download(self, target: str):
+        folder = tempfile.mkdtemp()
+        try:
+            # the hours and days actually asked for, like the real server
+            path = synthetic_era5(folder + '/', int(self.request['year']), int(self.request['month']), tuple(self.request['variable']),
+                self.resolution, self.request.get('time') or self.hours, days=self.request.get('day'))
+            shutil.move(path, target)
+        finally: shutil.rmtree(folder, ignore_errors=True)
+
+class StubCDSClient:
+    'stands in for cdsapi.Client(wait_until_complete=False): every request completes at once with synthetic data'
+    def __init__(self, resolution=0.25, hours=4):
+        self.resolution, self.hours = resolution, hours
+
+    def retrieve(self, name: str, request: dict) -> StubCDSResult:
+        return StubCDSResult(request, self.resolution, self.hours)
+
+class _ScidbHandler(SimpleHTTPRequestHandler):
+    'serves {directory}/{fileName} for scidb style ?fileId=...&fileName=... urls, honoring Range requests like the real server'
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        name = parse_qs(urlparse(self.path).query).get('fileName', [''])[0]
+        path = os.path.join(self.directory, os.path.basename(name))
+        if not os.path.isfile(path): return self.send_error(404)
+        size = os.path.getsize(path)
+        first = 0
+        if self.headers.get('Range', '').startswith('bytes='): first = int(self.headers['Range'][6:].split('-')[0] or 0)
+        if first and first >= size: # nothing left to send
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        self.send_response(206 if first else 200)
+        self.send_header('Content-Length', str(size - first))
+        if first: self.send_header('Content-Range', f'bytes {first}-{size - 1}/{size}')
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(first)
+            shutil.copyfileobj(f, self.wfile)
+
+def stub_http_server(directory: str) -> ThreadingHTTPServer:
+    'a local scidb stand-in serving {directory} in a background thread, its url is http://127.0.0.1:{server.server_port}/download'
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_ScidbHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+############## STAGES
+
+def _cell_days(first: pd.Timestamp, months: int, interpolation=1.25) -> int:
+    days = (first + pd.DateOffset(months=months) - first).days
+    return days * int(round(180 / interpolation)) * int(round(360 / interpolation))
+
+def _folder_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+def _stage(stage: str, config: dict) -> dict:
+    '''
+    runs one stage inside {config['workdir']}, returns what it processed: 'cell_days' and/or 'bytes'.
+    stages read what the stages before them wrote, the way WeatherData chains them.
+    '''
+    os.chdir(config['workdir'])
+    first = pd.Timestamp(config['start'] + '-01')
+    last = first + pd.DateOffset(months=config['months']) - pd.Timedelta(days=1)
+    era5, gcm = './downloads/1/tmp/', './downloads/2/SSP245/tmp/'
+    era5_out, gcm_out = './preprocessed/1/tmp/', './preprocessed/2/SSP245/tmp/'
+    cell_days = _cell_days(first, config['months'])
+
+    if stage == 'download_era5':
+        from data_downloader import download_era5_data
+        from data_manifest import DownloadCache
+        assert download_era5_data('2m_temperature', first, last + pd.Timedelta(hours=23), era5, client=StubCDSClient(config['era5_resolution'], config['hours']),
+            poll=0, backoff=0, cache=DownloadCache('./downloads/cache/'))
+        return {'bytes': _folder_bytes('./downloads/cache/')}
+    if stage == 'download_gcm':
+        from data_downloader import download_gcm_data
+        # the download endpoint hands out fixed files, so serve synthetic ones under those names
+        served = tempfile.mkdtemp()
+        synthetic_gcm(served + '/', 1993, 4, 'hist', config['gcm_resolution'])
+        synthetic_gcm(served + '/', 2094, 8, 'ssp245', config['gcm_resolution'])
+        server = stub_http_server(served)
+        if not os.path.exists('./downloads/gcm_fetch/'): os.makedirs('./downloads/gcm_fetch/')
+        try: assert download_gcm_data('ta', 1, first, last, './downloads/gcm_fetch/', base_url=f'http://127.0.0.1:{server.server_port}/download', verbose=False)
+        finally:
+            server.shutdown()
+            shutil.rmtree(served, ignore_errors=True)
+        # and the months that are preprocessed next
+        if not os.path.exists(gcm): os.makedirs(gcm)
+        for period in pd.period_range(first, last, freq='M'): synthetic_gcm(gcm, period.year, period.month, 'ssp245', config['gcm_resolution'])
+        return {'bytes': _folder_bytes('./downloads/gcm_fetch/') + _folder_bytes(gcm)}
+    if stage == 'preprocess_era5':
+        from data_preprocessor import preprocess_era5_data
+        assert preprocess_era5_data('t2m', 'tmp', 1.25, era5, era5_out, start_date=first, end_date=last)
+        return {'cell_days': cell_days, 'bytes': _folder_bytes(era5)}
+    if stage == 'preprocess_gcm':
+        from data_preprocessor import preprocess_gcm_data
+        assert preprocess_gcm_data('ta', 'tmp', 1.25, gcm, gcm_out, start_date=first, end_date=last)
+        return {'cell_days': cell_days, 'bytes': _folder_bytes(gcm)}
+    if stage in ('validate_era5', 'validate_gcm'):
+        from data_validation import validate_preprocessed_era5, validate_preprocessed_gcm
+        validate = validate_preprocessed_era5 if stage == 'validate_era5' else validate_preprocessed_gcm
+        assert validate('tmp', False, first, last, 1.25, era5_out if stage == 'validate_era5' else gcm_out)
+        return {'cell_days': cell_days}
+    if stage == 'pyramid':
+        from data_pyramid import build_pyramid
+        assert build_pyramid(era5_out, ['tmp'], 1.25, incremental=False) and build_pyramid(gcm_out, ['tmp'], 1.25, incremental=False)
+        return {'cell_days': 2 * cell_days}
+    if stage == 'plot':
+        from data_plotter import render_maps
+        specs = [('tmp', str(p), src) for p in pd.period_range(first, last, freq='M') for src in (era5_out, gcm_out)]
+        index = render_maps(specs, './maps/', processes=config['processes'])
+        assert not any('error' in e for e in index), [e['error'] for e in index if 'error' in e]
+        return {'frames': len(index)}
+    if stage == 'cold_start':
+        # a fresh interpreter running the cli's status command, which must not import any of the heavy backends
+        import subprocess
+        cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+        began = time.perf_counter()
+        done = subprocess.run([sys.executable, '-X', 'importtime', cli, 'status'], capture_output=True, text=True, check=True)
+        seconds = time.perf_counter() - began
+        imported = {line.split('|')[-1].strip().split('.')[0] for line in done.stderr.splitlines() if line.startswith('import time:')}
+        heavy = sorted(imported & set(HEAVY))
+        assert not heavy, f'cli status imported {heavy}'
+        return {'process_seconds': round(seconds, 4)}
+    assert False, f'unknown stage {stage}'
+
+def _measured(stage: str, config: dict, results):
+    'child process entry point: runs a stage and reports its timings, peak RSS and throughput through {results}'
+    wall, cpu = time.perf_counter(), time.process_time()
+    try: done = _stage(stage, config)
+    except BaseException as e:
+        results.put({'stage': stage, 'error': repr(e)})
+        return
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record = {'stage': stage, 'seconds': round(wall, 4), 'cpu_seconds': round(cpu + children.ru_utime + children.ru_stime, 4),
+        'peak_rss_mb': round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children.ru_maxrss) / 1024, 1), **done}
+    if 'cell_days' in done: record['cell_days_per_second'] = round(done['cell_days'] / wall)
+    if 'bytes' in done: record['mb_per_second'] = round(done['bytes'] / 2**20 / wall, 2)
+    results.put(record)
+
+def run(config: dict, stages=STAGES, verbose=True) -> list:
+    '''
+    runs {stages} in order, each in a freshly spawned process so that its peak RSS is its own, and returns their records.
+    a stage that fails is recorded with its error and the stages after it still run (and likely fail too).
+    '''
+    context = multiprocessing.get_context('spawn')
+    records = []
+    for stage in stages:
+        results = context.Queue()
+        process = context.Process(target=_measured, args=(stage, config, results))
+        process.start()
+        record = results.get()
+        process.join()
+        records.append(record)
+        if verbose: print(json.dumps(record))
+    return records
+
+def compare(records: list, baseline: dict, tolerance=0.2) -> list:
+    '''
+    regressions of {records} against a baseline (as save_baseline writes it): stages whose time or peak RSS grew
+    by more than {tolerance}, or that failed. returns human-readable lines, empty when there are none.
+    '''
+    before = {r['stage']: r for r in baseline['records']}
+    regressions = []
+    for r in records:
+        if 'error' in r:
+            regressions.append(f"{r['stage']}: failed ({r['error']})")
+            continue
+        if r['stage'] not in before or 'error' in before[r['stage']]: continue
+        for key in ('seconds', 'peak_rss_mb', 'process_seconds'):
+            if key not in r or key not in before[r['stage']]: continue
+            ratio = r[key] / max(before[r['stage']][key], 1e-9)
+            if ratio > 1 + tolerance: regressions.append(f"{r['stage']}: {key} {before[r['stage']][key]} -> {r[key]} ({ratio:.2f}x)")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--start', default='2000-01', help='first month, YYYY-MM')
+    parser.add_argument('--months', type=int, default=2, help='duration in months')
+    parser.add_argument('--era5-resolution', type=float, default=0.25, help='degrees of the synthetic ERA5 grid')
+    parser.add_argument('--gcm-resolution', type=float, default=1.25, help='degrees of the synthetic GCM grid')
+    parser.add_argument('--hours', type=int, default=4, help='ERA5 timestamps per day where a request does not list them (4, like ERA5_HOURS)')
+    parser.add_argument('--processes', type=int, default=2, help='plotting workers')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--workdir', default=None, help='where to generate data (a temporary folder, removed afterwards, by default)')
+    parser.add_argument('--baseline', default='./benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown / growth reported as a regression')
+    args = parser.parse_args(argv)
+
+    config = {k: getattr(args, k) for k in ('start', 'months', 'era5_resolution', 'gcm_resolution', 'hours', 'processes')}
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dminer-bench-')
+    config['workdir'] = os.path.abspath(workdir)
+    if not os.path.exists(config['workdir']): os.makedirs(config['workdir'])
+    try: records = run(config, args.stages)
+    finally:
+        if not args.workdir: shutil.rmtree(config['workdir'], ignore_errors=True)
+
+    settings = {k: v for k, v in config.items() if k != 'workdir'}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f: json.dump({'config': settings, 'records': records}, f, indent=1)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}, run with --save-baseline to record one')
+        return 0
+    baseline = json.load(open(args.baseline))
+    if baseline['config'] != settings: print('warning: baseline was recorded with a different configuration')
+    regressions = compare(records, baseline, args.tolerance)
+    for line in regressions: print('REGRESSION', line)
+    if not regressions: print('no regressions against', args.baseline)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
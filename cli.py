@@ -0,0 +1,130 @@
+'''
+command line entry point: python cli.py {download, preprocess, validate, plot, status} ...
+
+    python cli.py download ERA5 --start 2020-01-01 --end 2020-03-31
+    python cli.py preprocess ERA5 --region 35 -10 60 30
+    python cli.py preprocess GCM --scenario SSP245 --types tmp
+    python cli.py validate 3
+    python cli.py plot ERA5 --period 2020-01 2020-02 1990-1999
+    python cli.py status
+
+sources are looked up in the data_sources registry (by number, name or label), and only the backend of the source and stage
+being run is imported, so status and --help start in a fraction of a second.
+'''
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timezone
+
+def _date(text: str) -> datetime:
+    return datetime.strptime(text, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+def _source(text: str):
+    return int(text) if text.isdigit() else text
+
+def _weather_data(args):
+    from ingest_struct import WeatherData
+    return WeatherData(args.source, args.scenario, args.types or 'default', args.start, args.end, force=args.force, verbose=args.verbose,
+        region=args.region)
+
+def download(args) -> int:
+    data = _weather_data(args)
+    data.download(args.force)
+    return 0 if data.downloaded else 1
+
+def preprocess(args) -> int:
+    data = _weather_data(args)
+    if args.rebuild: data.force = True # rewrite every month of the range, store or not
+    data.preprocess(interpolate=args.interpolate, export_csv=args.export_csv, incremental=not args.rebuild, pyramid=not args.no_pyramid)
+    return 0 if data.preprocessed else 1
+
+def validate(args) -> int:
+    data = _weather_data(args)
+    data.validate(verbose=True)
+    return 0 if data.validated else 1
+
+def plot(args) -> int:
+    from data_plotter import render_maps
+    data = _weather_data(args)
+    specs = [(variable, period, data._preprocessat) for variable in (args.variables or data.data_types) for period in args.period]
+    index = render_maps(specs, args.save_to, args.processes, verbose=True)
+    for entry in index: print(entry.get('path') or f"{entry['variable']} {entry['period']}: {entry['error']}")
+    return 1 if any('error' in e for e in index) else 0
+
+def status(args) -> int:
+    '''
+    what has been downloaded and preprocessed so far, from the folder layout and state files alone (nothing heavy is imported):
+    per source, data types (and region) the download views, store partitions and months recorded, and whether a pyramid and cube exist.
+    '''
+    from data_sources import REGISTRY, get_source
+    sources = [get_source(args.source)] if args.source is not None else list(REGISTRY.values())
+    for source in sources:
+        for variant in (list(source.variants.values()) if source.variants else [None]):
+            path = source.path_of(variant)
+            print(f'{source.label_of(variant)} ({source.number}): ./downloads/{path}/, ./preprocessed/{path}/')
+            preprocessed = f'./preprocessed/{path}/'
+            downloads = f'./downloads/{path}/'
+            types = sorted(set(os.listdir(preprocessed) if os.path.isdir(preprocessed) else [])
+                | set(os.listdir(downloads) if os.path.isdir(downloads) else []))
+            if not types: print('\tnothing yet')
+            for typestr in types:
+                regions = sorted({e for folder in (f'{downloads}{typestr}', f'{preprocessed}{typestr}') if os.path.isdir(folder)
+                    for e in os.listdir(folder) if e.startswith('region-')})
+                for region in [''] + [f'{e}/' for e in regions]:
+                    views = [e for e in os.listdir(f'{downloads}{typestr}/{region}') if not e.startswith('region-')] \
+                        if os.path.isdir(f'{downloads}{typestr}/{region}') else []
+                    at = f'{preprocessed}{typestr}/{region}'
+                    store = f'{at}store/'
+                    partitions = sum(1 for y in (os.listdir(store) if os.path.isdir(store) else []) for _ in os.listdir(f'{store}{y}'))
+                    state = json.load(open(f'{at}state.json')) if os.path.exists(f'{at}state.json') else {}
+                    months = sorted(state.get('partitions', {}))
+                    extras = [e for e in ('pyramid', 'cube') if os.path.isdir(f'{at}{e}')]
+                    print(f"\t{typestr}{' ' + region[:-1] if region else ''}: {len(views)} download view(s), {partitions} partition(s)"
+                        + (f', months {months[0]} -> {months[-1]}' if months else '') + (f" ({', '.join(extras)})" if extras else ''))
+    return 0
+
+def parser() -> argparse.ArgumentParser:
+    main = argparse.ArgumentParser(description='download, preprocess, validate and plot dminer weather data')
+    main.add_argument('--trace', help='append timing spans of this run to a json lines file (see data_trace)')
+    commands = main.add_subparsers(dest='command', required=True)
+
+    def command(name: str, function, help: str, source_required=True) -> argparse.ArgumentParser:
+        sub = commands.add_parser(name, help=help)
+        sub.set_defaults(function=function)
+        sub.add_argument('source', type=_source, nargs=None if source_required else '?', help='source number, name or label (e.g. 1, ERA5, GSOD)')
+        if source_required:
+            sub.add_argument('--scenario', help='GCM scenario, SSP245 or SSP585')
+            sub.add_argument('--types', nargs='+', help="data types, e.g. tmp percip (the source's defaults if not given)")
+            sub.add_argument('--start', type=_date, help='YYYY-MM-DD, the default dates of the source if not given')
+            sub.add_argument('--end', type=_date, help='YYYY-MM-DD')
+            sub.add_argument('--region', nargs=4, type=float, action='append', metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                help='restrict to a box in degrees, repeat for several boxes')
+            sub.add_argument('--force', action='store_true')
+            sub.add_argument('--verbose', action='store_true')
+        return sub
+
+    command('download', download, 'download a source (ERA5 through the shared cache)')
+    sub = command('preprocess', preprocess, 'preprocess a download into the partitioned store')
+    sub.add_argument('--interpolate', type=float, default=1.25, help='grid resolution in degrees')
+    sub.add_argument('--export-csv', action='store_true', help='also write a single data.csv')
+    sub.add_argument('--rebuild', action='store_true', help='reprocess every month of the range, not just new or changed ones')
+    sub.add_argument('--no-pyramid', action='store_true', help='skip the aggregation pyramid')
+    command('validate', validate, 'validate the preprocessed store, exits 1 when it fails')
+    sub = command('plot', plot, 'render mean maps to png files')
+    sub.add_argument('--period', nargs='+', required=True, help="'YYYY-MM', 'YYYY' or 'YYYY-YYYY' periods")
+    sub.add_argument('--variables', nargs='+', help='the data types by default')
+    sub.add_argument('--save-to', default='./maps/')
+    sub.add_argument('--processes', type=int, default=None)
+    command('status', status, 'what is downloaded and preprocessed', source_required=False)
+    return main
+
+def main(argv=None) -> int:
+    args = parser().parse_args(argv)
+    if args.trace:
+        from data_trace import configure
+        configure(args.trace)
+    return args.function(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+############## GENERAL
+
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+# a process-wide cache of loaded datasets (frames, grids, cubes) and what is derived from them (pivots...), so that exploring
+# the same preprocessed data over and over hits memory instead of re-reading and re-parsing it.
+# entries are keyed by what was asked for plus a fingerprint of the files it came from (every file's path, size and mtime),
+# so rewriting the preprocessed output invalidates them, and the least recently used ones are evicted beyond a memory budget.
+
+def files_fingerprint(paths) -> str:
+    '''
+    identity of files and folders (walked recursively): a hash of every file's path, size and mtime.
+    paths that do not exist count as absent, so creating them later changes the fingerprint too.
+    '''
+    h = hashlib.sha1()
+    for path in sorted(paths if isinstance(paths, (list, tuple)) else [paths]):
+        if os.path.isdir(path):
+            for folder, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    stat = os.stat(os.path.join(folder, name))
+                    h.update(f'{os.path.join(folder, name)}|{stat.st_size}|{stat.st_mtime_ns};'.encode())
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            h.update(f'{path}|{stat.st_size}|{stat.st_mtime_ns};'.encode())
+        else: h.update(f'{path}|absent;'.encode())
+    return h.hexdigest()
+
+def _mapped(value) -> bool:
+    'whether value is a memory-mapped array (np.memmap, without importing numpy), whose pages belong to the page cache'
+    return any(cls.__name__ == 'memmap' and cls.__module__.startswith('numpy') for cls in type(value).__mro__)
+
+def sizeof(value) -> int:
+    '''
+    approximate bytes held by a cached value. memory-mapped arrays only count their object, the kernel evicts their pages
+    under pressure on its own, so a mapped cube of decades neither escapes the cache nor pushes real frames out of it.
+    '''
+    if _mapped(value): return sys.getsizeof(value)
+    if hasattr(value, 'memory_usage') and hasattr(value, 'columns'): return int(value.memory_usage(deep=True).sum()) # DataFrame
+    if hasattr(value, 'variables') and isinstance(value.variables, dict) and hasattr(value, 'latitude'): # data_cube.Cube
+        return sizeof(value.variables) + sizeof(value.latitude) + sizeof(value.longitude)
+    if hasattr(value, 'nbytes'): return int(value.nbytes) # ndarray, xarray
+    if isinstance(value, (tuple, list)): return sys.getsizeof(value) + sum(sizeof(e) for e in value)
+    if isinstance(value, dict): return sys.getsizeof(value) + sum(sizeof(e) for e in value.values())
+    return sys.getsizeof(value)
+
+class DatasetCache:
+    '''
+    LRU cache of loaded data bounded by {budget_mb} of memory.
+
+    get(key, paths, loader) returns the value cached under {key} if the files at {paths} did not change since it was loaded,
+    otherwise it calls loader() and caches the result, evicting least recently used entries until everything fits the budget.
+    a value larger than the whole budget is returned without being cached.
+    '''
+    def __init__(self, budget_mb:float=1024):
+        self.budget = int(budget_mb * 2**20)
+        self.entries = OrderedDict() # key -> (fingerprint, value, bytes)
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __str__(self) -> str:
+        return (f'DatasetCache of {len(self)} entries, {self.size / 2**20:.1f} of {self.budget / 2**20:.0f} MiB '
+            f'({self.hits} hits, {self.misses} misses, {self.evictions} evictions)')
+
+    def get(self, key, paths, loader):
+        fingerprint = files_fingerprint(paths)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None: self._drop(key) # the files changed underneath it
+            self.misses += 1
+
+        value = loader() # not under the lock, loading can take a while
+        nbytes = sizeof(value)
+        with self._lock:
+            if key in self.entries: self._drop(key)
+            if nbytes <= self.budget:
+                self.entries[key] = (fingerprint, value, nbytes)
+                self.size += nbytes
+                while self.size > self.budget:
+                    self._drop(next(iter(self.entries)))
+                    self.evictions += 1
+        return value
+
+    def _drop(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def resize(self, budget_mb: float):
+        'changes the budget, evicting as needed'
+        with self._lock:
+            self.budget = int(budget_mb * 2**20)
+            while self.size > self.budget and self.entries:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+# the shared cache, its budget can be set with the DMINER_CACHE_MB environment variable or CACHE.resize
+CACHE = DatasetCache(float(os.environ.get('DMINER_CACHE_MB', 1024)))
+
+def cached(key, paths, loader):
+    'CACHE.get, see DatasetCache'
+    return CACHE.get(key, paths, loader)
@@ -0,0 +1,383 @@
+############## GENERAL
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from typing import Union
+from data_store import iter_store, list_partitions, naive_timestamp
+
+# the long format repeats time, latitude and longitude (float64) on every row, while on our fixed grid they are implied
+# by a row's position. a cube keeps one float32 (time, latitude, longitude) array per variable and the coordinates once.
+
+def grid(interpolation=1.25) -> tuple:
+    '(latitudes, longitudes) of the grid used throughout this repo: latitude -90 -> 90-interpolation, longitude 0 -> 360-interpolation'
+    return np.arange(-90, 90, interpolation), np.arange(0, 360, interpolation)
+
+class Cube:
+    '''
+    Dense daily data on our regular grid: variable -> float32 array shaped (time, latitude, longitude), NaN where there is no value,
+    along with the day (time), latitude and longitude vectors, stored once.
+
+    Convert from and to the long format of the preprocessed stores with from_frame/from_store and to_frame,
+    keep on disk with save/load (plain .npy files, which load can memory-map), and slice days with sel.
+    '''
+    def __init__(self, variables: dict, time, latitude, longitude, interpolation=1.25):
+        self.time = pd.DatetimeIndex(time)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.interpolation = interpolation
+        self.variables = variables
+        shape = self.shape
+        for v, a in variables.items(): assert a.shape == shape, f'{v} is shaped {a.shape}, expected {shape}'
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.time), len(self.latitude), len(self.longitude))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self.variables.values())
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def __getitem__(self, variable: str) -> np.ndarray:
+        return self.variables[variable]
+
+    def __str__(self) -> str:
+        span = f'{self.time[0]:%Y-%m-%d} -> {self.time[-1]:%Y-%m-%d}' if len(self) else 'no days'
+        return f'Cube of {", ".join(self.variables)} shaped {self.shape}, {span} ({self.nbytes / 2**20:.1f} MiB)'
+
+    @classmethod
+    def empty(cls, variables: list, time, interpolation=1.25) -> 'Cube':
+        'an all-NaN cube of {variables} over the days {time}'
+        latitude, longitude = grid(interpolation)
+        arrays = {v: np.full((len(time), len(latitude), len(longitude)), np.nan, dtype=np.float32) for v in variables}
+        return cls(arrays, time, latitude, longitude, interpolation)
+
+    def fill(self, df: pd.DataFrame) -> int:
+        '''
+        scatters the values of a long-format frame (time | latitude | longitude | [variable | s...]) into this cube in one vectorized pass,
+        for the variables both have. rows on days outside of the cube are ignored. returns how many rows landed.
+        '''
+        nlat, nlon = len(self.latitude), len(self.longitude)
+        days, axis = df['time'].to_numpy().astype('datetime64[D]'), self.time.values.astype('datetime64[D]')
+        ti = np.searchsorted(axis, days)
+        inside = ti < len(axis)
+        inside[inside] = axis[ti[inside]] == days[inside]
+        ilat = np.clip(np.rint((df['latitude'].to_numpy(np.float64) + 90) / self.interpolation).astype(np.int64), 0, nlat - 1)
+        ilon = np.rint((df['longitude'].to_numpy(np.float64) % 360) / self.interpolation).astype(np.int64) % nlon
+        flat = ((ti * nlat + ilat) * nlon + ilon)[inside]
+        for v, a in self.variables.items():
+            if v in df: a.reshape(-1)[flat] = df[v].to_numpy(np.float32)[inside]
+        return len(flat)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, variables:list=None, interpolation=1.25, time=None) -> 'Cube':
+        '''
+        a cube of a long-format frame. every column but the coordinates is a variable unless {variables} is given.
+        the time axis is every day from the first to the last of the frame unless given.
+        '''
+        if variables is None: variables = [c for c in df.columns if c not in ('time', 'latitude', 'longitude')]
+        if time is None:
+            days = df['time'].to_numpy().astype('datetime64[D]')
+            time = pd.date_range(days.min(), days.max(), freq='D') if len(days) else pd.DatetimeIndex([])
+        cube = cls.empty(variables, time, interpolation)
+        cube.fill(df)
+        return cube
+
+    @classmethod
+    def from_store(cls, root: str, variables: list, start_date:datetime=None, end_date:datetime=None, interpolation=1.25,
+            path:str=None, **meta) -> 'Cube':
+        '''
+        reads {variables} of the parquet store at {root} between start_date and end_date straight into a cube, partition by partition,
+        so the long format of more than a month is never held at once. the time axis is every day of the range
+        (or of the months in the store when no range is given), days without data are NaN.
+
+        with a {path} the arrays are built in .npy files there (saved like save would, along with {meta}) through memory maps
+        instead of in memory, and the cube returned is memory-mapped, so decades of days never have to fit in RAM.
+        '''
+        start, end = naive_timestamp(start_date), naive_timestamp(end_date)
+        partitions = list_partitions(root, start, end)
+        first = start.floor('D') if start is not None else (pd.Timestamp(*partitions[0][:2], 1) if partitions else None)
+        last = end.floor('D') if end is not None else (pd.Timestamp(*partitions[-1][:2], 1) + pd.offsets.MonthEnd(0) if partitions else None)
+        time = pd.date_range(first, last, freq='D') if first is not None and last is not None else pd.DatetimeIndex([])
+
+        if path is None:
+            cube = cls.empty(variables, time, interpolation)
+            for _, _, df in iter_store(root, ['latitude', 'longitude'] + list(variables), start, end): cube.fill(df)
+            return cube
+
+        if not os.path.exists(path): os.makedirs(path)
+        if os.path.exists(f'{path}cube.json'): os.remove(f'{path}cube.json') # no longer describes the files until rebuilt
+        latitude, longitude = grid(interpolation)
+        shape = (len(time), len(latitude), len(longitude))
+        arrays = {}
+        for v in variables:
+            arrays[v] = np.lib.format.open_memmap(f'{path}{v}.npy.tmp', mode='w+', dtype=np.float32, shape=shape)
+            for day in range(0, shape[0], 366): arrays[v][day:day + 366] = np.nan # a year at a time, to bound dirty pages
+        cube = cls(arrays, time, latitude, longitude, interpolation)
+        for _, _, df in iter_store(root, ['latitude', 'longitude'] + list(variables), start, end): cube.fill(df)
+        for a in arrays.values(): a.flush()
+        del cube
+        arrays.clear()
+        for v in variables: os.replace(f'{path}{v}.npy.tmp', f'{path}{v}.npy')
+        cls._save_meta(path, time, latitude, longitude, variables, shape, interpolation, meta)
+        return cls.load(path, mmap=True)
+
+    def to_frame(self, how='any') -> pd.DataFrame:
+        '''
+        flattens back to the long format of the stores, time | latitude | longitude | [variable | s...] sorted the same way.
+        cell-days are dropped when any (how='any', as preprocessing does) or all (how='all') variables are NaN, kept if how is None.
+        '''
+        nlat, nlon = len(self.latitude), len(self.longitude)
+        if how is None or not self.variables: index = np.arange(int(np.prod(self.shape)))
+        else:
+            present = [~np.isnan(a).ravel() for a in self.variables.values()]
+            index = np.flatnonzero(np.logical_and.reduce(present) if how == 'any' else np.logical_or.reduce(present))
+        ti, cell = np.divmod(index, nlat * nlon)
+        df = pd.DataFrame({'time': self.time.values[ti], 'latitude': self.latitude[cell // nlon], 'longitude': self.longitude[cell % nlon]})
+        for v, a in self.variables.items(): df[v] = a.reshape(-1)[index]
+        return df
+
+    def sel(self, start_date:datetime=None, end_date:datetime=None) -> 'Cube':
+        'the days between start_date and end_date (inclusive), as views of this cube rather than copies'
+        start, end = naive_timestamp(start_date), naive_timestamp(end_date)
+        begin = self.time.searchsorted(start.floor('D')) if start is not None else 0
+        finish = self.time.searchsorted(end.floor('D'), side='right') if end is not None else len(self.time)
+        return Cube({v: a[begin:finish] for v, a in self.variables.items()}, self.time[begin:finish], self.latitude, self.longitude, self.interpolation)
+
+    def to_xarray(self):
+        import xarray as xr
+        return xr.Dataset({v: (('time', 'latitude', 'longitude'), a) for v, a in self.variables.items()},
+            coords={'time': self.time, 'latitude': self.latitude, 'longitude': self.longitude})
+
+    def save(self, path: str, **meta) -> str:
+        '''
+        saves the cube as a folder {path} of .npy files, one per variable plus the coordinates, and a small cube.json describing them
+        along with any {meta} (e.g. what the cube was built from, see info).
+        '''
+        if not os.path.exists(path): os.makedirs(path)
+        for v, a in self.variables.items(): np.save(f'{path}{v}.npy', np.ascontiguousarray(a, dtype=np.float32))
+        self._save_meta(path, self.time, self.latitude, self.longitude, list(self.variables), self.shape, self.interpolation, meta)
+        return path
+
+    @staticmethod
+    def _save_meta(path: str, time, latitude, longitude, variables: list, shape: tuple, interpolation, meta: dict):
+        'the coordinates and cube.json of a saved cube, written last so that info only sees complete cubes'
+        np.save(f'{path}time.npy', pd.DatetimeIndex(time).values.astype('datetime64[D]'))
+        np.save(f'{path}latitude.npy', np.asarray(latitude, dtype=np.float64))
+        np.save(f'{path}longitude.npy', np.asarray(longitude, dtype=np.float64))
+        with open(f'{path}cube.json.tmp', 'w') as f:
+            json.dump(dict(meta, variables=list(variables), shape=list(shape), interpolation=interpolation), f, indent=1)
+        os.replace(f'{path}cube.json.tmp', f'{path}cube.json')
+
+    @staticmethod
+    def info(path: str) -> Union[dict, None]:
+        'the cube.json of a saved cube, None if there is none'
+        return json.load(open(f'{path}cube.json')) if os.path.exists(f'{path}cube.json') else None
+
+    @classmethod
+    def load(cls, path: str, variables:list=None, mmap=False) -> 'Cube':
+        'loads a cube saved with save, only {variables} if given. with mmap the arrays are memory-mapped read-only instead of read'
+        meta = json.load(open(f'{path}cube.json'))
+        mode = 'r' if mmap else None
+        arrays = {v: np.load(f'{path}{v}.npy', mmap_mode=mode) for v in (variables or meta['variables'])}
+        return cls(arrays, np.load(f'{path}time.npy'), np.load(f'{path}latitude.npy'), np.load(f'{path}longitude.npy'), meta['interpolation'])
+
+############## RAW EXPORT
+
+# for training readers: one headerless float32 file per variable, C order (time, latitude, longitude), plus a raw.json sidecar
+# describing the layout, so any process (or language) can memory-map the arrays and slice day ranges without parsing anything,
+# and every process on a host shares the same pages of the page cache.
+
+RAW_FORMAT = 'dminer-raw-1'
+
+def export_raw(root: str, save_to: str, variables: list, start_date: datetime, end_date: datetime, interpolation=1.25, **meta) -> str:
+    '''
+    exports {variables} of the parquet store at {root} for every day from start_date to end_date (inclusive) to {save_to}:
+    {variable}.f32 files and raw.json. the arrays are written through memory maps partition by partition, so the export never
+    holds more than a month in memory whatever its length. days or cells without data are NaN. {meta} is added to raw.json.
+    which days hold any value of each variable is saved along ({variable}.days.npy), so readers need not scan the arrays for it.
+
+    files are written under temporary names and swapped in at the end, so readers that have the old export mapped keep
+    a consistent view and new readers see the new one.
+    '''
+    start, end = naive_timestamp(start_date).floor('D'), naive_timestamp(end_date).floor('D')
+    time = pd.date_range(start, end, freq='D')
+    latitude, longitude = grid(interpolation)
+    shape = (len(time), len(latitude), len(longitude))
+    if not os.path.exists(save_to): os.makedirs(save_to)
+
+    arrays = {}
+    for v in variables:
+        arrays[v] = np.memmap(f'{save_to}{v}.f32.tmp', dtype='<f4', mode='w+', shape=shape)
+        for day in range(0, shape[0], 366): arrays[v][day:day + 366] = np.nan # a year at a time, to bound dirty pages
+    present = {v: np.zeros(shape[0], dtype=bool) for v in variables}
+    cube = Cube(arrays, time, latitude, longitude, interpolation)
+    for _, _, df in iter_store(root, ['latitude', 'longitude'] + list(variables), start, end + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')):
+        cube.fill(df)
+        days = (df['time'].to_numpy().astype('datetime64[D]') - np.datetime64(start.date(), 'D')).astype(np.int64)
+        for v in variables:
+            if v not in df: continue
+            inside = df[v].notna().to_numpy() & (days >= 0) & (days < shape[0])
+            present[v][days[inside]] = True
+    for a in arrays.values(): a.flush()
+    del cube
+    arrays.clear()
+    for v in variables:
+        os.replace(f'{save_to}{v}.f32.tmp', f'{save_to}{v}.f32')
+        with open(f'{save_to}{v}.days.npy', 'wb') as f: np.save(f, present[v])
+
+    sidecar = dict(meta, format=RAW_FORMAT, dtype='float32', byteorder='little', order='C', dims=['time', 'latitude', 'longitude'],
+        shape=list(shape), variables={v: f'{v}.f32' for v in variables}, present={v: f'{v}.days.npy' for v in variables},
+        time={'start': f'{start:%Y-%m-%d}', 'step_days': 1, 'count': shape[0]},
+        latitude={'start': float(latitude[0]), 'step': interpolation, 'count': shape[1]},
+        longitude={'start': float(longitude[0]), 'step': interpolation, 'count': shape[2]})
+    with open(f'{save_to}raw.json.tmp', 'w') as f: json.dump(sidecar, f, indent=1)
+    os.replace(f'{save_to}raw.json.tmp', f'{save_to}raw.json')
+    return save_to
+
+class RawArrays:
+    '''
+    Read-only, zero-copy access to an export_raw folder: every variable is an np.memmap shaped (time, latitude, longitude).
+    days(start, end) slices a day range as views, nothing is read until values are touched.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = json.load(open(f'{path}raw.json'))
+        assert self.meta['format'] == RAW_FORMAT, f"unknown raw format {self.meta['format']} in {path}"
+        shape = tuple(self.meta['shape'])
+        self.arrays = {v: np.memmap(f'{path}{name}', dtype='<f4', mode='r', shape=shape) for v, name in self.meta['variables'].items()}
+        # variable -> whether each day holds any value (None for exports older than that record)
+        self.present = {v: np.load(f'{path}{name}') for v, name in self.meta['present'].items()} if 'present' in self.meta else None
+        self.start = np.datetime64(self.meta['time']['start'], 'D')
+        lat, lon = self.meta['latitude'], self.meta['longitude']
+        self.latitude = lat['start'] + lat['step'] * np.arange(lat['count'])
+        self.longitude = lon['start'] + lon['step'] * np.arange(lon['count'])
+
+    def __len__(self) -> int:
+        return self.meta['shape'][0]
+
+    def __getitem__(self, variable: str) -> np.memmap:
+        return self.arrays[variable]
+
+    def __str__(self) -> str:
+        return f"RawArrays {self.path} of {', '.join(self.arrays)} shaped {tuple(self.meta['shape'])} from {self.start}"
+
+    @property
+    def time(self) -> pd.DatetimeIndex:
+        return pd.date_range(str(self.start), periods=len(self), freq='D')
+
+    def index(self, date) -> int:
+        'position of a day on the time axis'
+        return int((np.datetime64(naive_timestamp(date).floor('D').date(), 'D') - self.start).astype(np.int64))
+
+    def days(self, start_date:datetime=None, end_date:datetime=None) -> dict:
+        'variable -> view of the days from start_date to end_date (inclusive, clipped to the export)'
+        begin = max(self.index(start_date), 0) if start_date is not None else 0
+        finish = min(self.index(end_date) + 1, len(self)) if end_date is not None else len(self)
+        return {v: a[begin:finish] for v, a in self.arrays.items()}
+
+    def cube(self) -> Cube:
+        'the whole export as a Cube whose arrays are the memory maps'
+        return Cube(dict(self.arrays), self.time, self.latitude, self.longitude, self.meta['latitude']['step'])
+
+############## SERIES
+
+# for per-cell history queries: the same values laid out point-major, (latitude, longitude, time) per variable, so the whole
+# time series of a cell is one contiguous run of the file (decades of days are a few hundred KiB) and of a tile of neighbouring
+# cells a few such runs, instead of one value in every day's slab of a time-major layout.
+
+SERIES_FORMAT = 'dminer-series-1'
+
+def export_series(raw: str, save_to: str, days=366, **meta) -> str:
+    '''
+    transposes the export_raw folder {raw} into point-major {variable}.f32 files shaped (latitude, longitude, time) in {save_to},
+    {days} days at a time, so memory only holds one block of days whatever the length of the export.
+    also saves which cells hold any value at all (present.npy, for nearest) and a series.json sidecar with {meta}.
+    files are swapped in at the end like export_raw's.
+    '''
+    source = RawArrays(raw)
+    ntime, nlat, nlon = source.meta['shape']
+    if not os.path.exists(save_to): os.makedirs(save_to)
+    present = np.zeros((nlat, nlon), dtype=bool)
+    for v, a in source.arrays.items():
+        out = np.memmap(f'{save_to}{v}.f32.tmp', dtype='<f4', mode='w+', shape=(nlat, nlon, ntime))
+        for t in range(0, ntime, days):
+            block = np.asarray(a[t:t + days])
+            out[:, :, t:t + len(block)] = block.transpose(1, 2, 0)
+            present |= np.isfinite(block).any(axis=0)
+        out.flush()
+        del out
+    with open(f'{save_to}present.npy.tmp', 'wb') as f: np.save(f, present)
+    for v in source.arrays: os.replace(f'{save_to}{v}.f32.tmp', f'{save_to}{v}.f32')
+    os.replace(f'{save_to}present.npy.tmp', f'{save_to}present.npy')
+
+    sidecar = dict(meta, **{k: source.meta[k] for k in ('dtype', 'byteorder', 'order', 'variables', 'time', 'latitude', 'longitude')},
+        format=SERIES_FORMAT, dims=['latitude', 'longitude', 'time'], shape=[nlat, nlon, ntime])
+    with open(f'{save_to}series.json.tmp', 'w') as f: json.dump(sidecar, f, indent=1)
+    os.replace(f'{save_to}series.json.tmp', f'{save_to}series.json')
+    return save_to
+
+class SeriesArrays:
+    '''
+    Read-only access to an export_series folder: every variable is an np.memmap shaped (latitude, longitude, time).
+    cell, cells and nearest return the full time series of grid cells in the long format of the stores
+    (time | latitude | longitude | [variable | s...]), reading only their contiguous runs of the files.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = json.load(open(f'{path}series.json'))
+        assert self.meta['format'] == SERIES_FORMAT, f"unknown series format {self.meta['format']} in {path}"
+        shape = tuple(self.meta['shape'])
+        self.arrays = {v: np.memmap(f'{path}{name}', dtype='<f4', mode='r', shape=shape) for v, name in self.meta['variables'].items()}
+        self.present = np.load(f'{path}present.npy')
+        self.interpolation = self.meta['latitude']['step']
+        lat, lon = self.meta['latitude'], self.meta['longitude']
+        self.latitude = lat['start'] + lat['step'] * np.arange(lat['count'])
+        self.longitude = lon['start'] + lon['step'] * np.arange(lon['count'])
+        self.time = pd.date_range(self.meta['time']['start'], periods=self.meta['time']['count'], freq='D')
+        self._tree = None
+
+    def __getitem__(self, variable: str) -> np.memmap:
+        return self.arrays[variable]
+
+    def __str__(self) -> str:
+        return f"SeriesArrays {self.path} of {', '.join(self.arrays)} shaped {tuple(self.meta['shape'])} from {self.time[0]:%Y-%m-%d}"
+
+    def _frame(self, ilat: np.ndarray, ilon: np.ndarray, dropna: bool) -> pd.DataFrame:
+        'long-format series of the cells (ilat, ilon), cell by cell in the order given'
+        n, ntime = len(ilat), len(self.time)
+        df = pd.DataFrame({'time': np.tile(self.time.values, n), 'latitude': np.repeat(self.latitude[ilat], ntime),
+            'longitude': np.repeat(self.longitude[ilon], ntime)})
+        for v, a in self.arrays.items(): df[v] = a[ilat, ilon].reshape(-1) # one contiguous run per cell
+        return df.dropna(how='all', subset=list(self.arrays)).reset_index(drop=True) if dropna else df
+
+    def cells(self, lats, lons, dropna=True) -> pd.DataFrame:
+        'series of the grid cells nearest to every (lat, lon), days without any value dropped if dropna'
+        from data_spatial import grid_cell
+        ilat, ilon = grid_cell(np.atleast_1d(lats), np.atleast_1d(lons), self.interpolation)
+        return self._frame(ilat, ilon, dropna)
+
+    def cell(self, lat: float, lon: float, dropna=True) -> pd.DataFrame:
+        'series of the grid cell holding (lat, lon)'
+        return self.cells([lat], [lon], dropna)
+
+    def nearest(self, lat: float, lon: float, dropna=True) -> pd.DataFrame:
+        '''
+        series of the cell nearest to (lat, lon), by great-circle distance, among those holding any value,
+        which differs from cell for sparse data such as GSOD stations. the distance in km is in df.attrs['km'].
+        '''
+        from data_spatial import _xyz, _chord_to_km
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._cells = np.argwhere(self.present)
+            assert len(self._cells), f'{self} holds no values'
+            self._tree = cKDTree(_xyz(self.latitude[self._cells[:, 0]], self.longitude[self._cells[:, 1]]))
+        chord, i = self._tree.query(_xyz([lat], [lon])[0])
+        df = self._frame(self._cells[i:i + 1, 0], self._cells[i:i + 1, 1], dropna)
+        df.attrs['km'] = float(_chord_to_km(chord))
+        return df
@@ -1,60 +1,271 @@
 ####################### ERA5
 
-import cdsapi
-from datetime import datetime
+import os
+import uuid
+import shutil
+import calendar
+from datetime import datetime, timedelta, timezone
 from typing import Union
+from data_manifest import DownloadCache, sha256_of
+from data_trace import span
 import asyncio
 
-def download_era5_data(variables: Union[str, list], start_date:datetime, end_date:datetime, save_to='./') -> bool:
+ERA5_HOURS = ['00:00', '06:00', '12:00', '18:00'] # they don't like 0:00 :(
+ERA5_LAG_DAYS = 5 # ERA5 is published about five days behind real time
+ERA5_AREA_PAD = 2.5 # degrees downloaded around a region, so that its edge cells can be regridded onto grids up to 2.5 degrees
+
+def plan_era5_requests(variables: Union[str, list], start_date:datetime, end_date:datetime, group_size:int=1, hours:list=ERA5_HOURS, area:list=None) -> list:
+    '''
+        splits a date range into CDS-sized jobs, one per month and per group of {group_size} variables (None puts all of them in one group).
+        every job only asks for the days of its month that are inside the range, so no extra dates are fetched.
+        area ([north, west, south, east], see data_spatial.Region.area) limits every job to that box instead of the globe.
+
+        returns a list of dicts with the cds request under 'request' and the file it should be saved to under 'target':
+        era5_YYYY_MM_{variable[+variable...]}.nc
+    '''
+    if isinstance(variables, str): variables = [variables]
+    if not end_date: end_date = start_date
+    group_size = group_size or len(variables)
+    groups = [variables[i:i + group_size] for i in range(0, len(variables), group_size)]
+
+    jobs = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        first = start_date.day if (year, month) == (start_date.year, start_date.month) else 1
+        last = end_date.day if (year, month) == (end_date.year, end_date.month) else calendar.monthrange(year, month)[1]
+        for group in groups:
+            job = {
+                'request': {
+                    'product_type': 'reanalysis',
+                    'variable': group,
+                    'year': f'{year:04d}',
+                    'month': f'{month:02d}',
+                    'day': [f'{day:02d}' for day in range(first, last + 1)],
+                    'time': list(hours),
+                    'format': 'netcdf',
+                },
+                'target': f"era5_{year:04d}_{month:02d}_{'+'.join(group)}.nc",
+            }
+            if area: job['request']['area'] = list(area) # North, West, South, East.
+            jobs.append(job)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return jobs
+
+async def _run_era5_job(client, job: dict, save_to: str, inflight: asyncio.Semaphore, retries: int, backoff: float, poll: float, verbose: bool) -> bool:
+    '''
+        submits one job, polls it until cds is done with it, and downloads the result to {save_to}{job['target']}.
+        the blocking client calls run in the default executor so that many jobs can wait in the cds queue at once.
+    '''
+    loop = asyncio.get_event_loop()
+    target = f"{save_to}{job['target']}"
+    async with inflight:
+        for attempt in range(retries + 1):
+            try:
+                with span('download.era5.queue', target=job['target'], attempt=attempt): # waiting on cds
+                    result = await loop.run_in_executor(None, client.retrieve, 'reanalysis-era5-single-levels', job['request'])
+                    while result.reply['state'] not in ('completed', 'failed'):
+                        await asyncio.sleep(poll)
+                        await loop.run_in_executor(None, result.update)
+                if result.reply['state'] == 'failed': raise RuntimeError(result.reply.get('error', 'cds request failed'))
+                with span('download.era5.transfer', target=job['target']) as s:
+                    await loop.run_in_executor(None, result.download, target + '.part')
+                    s.add(bytes=os.path.getsize(target + '.part'))
+                os.replace(target + '.part', target) # only complete files ever carry the final name
+                if verbose: print(f"downloaded {job['target']}")
+                return True
+            except Exception as e:
+                if attempt == retries:
+                    print(f"ERA5 job {job['target']} failed after {retries + 1} attempts: {e}")
+                    return False
+                if verbose: print(f"ERA5 job {job['target']} failed ({e}), retrying in {backoff * 2 ** attempt}s")
+                await asyncio.sleep(backoff * 2 ** attempt)
+
+async def _run_era5_jobs(client, jobs: list, save_to: str, max_inflight: int, retries: int, backoff: float, poll: float, verbose: bool) -> list:
+    inflight = asyncio.Semaphore(max_inflight)
+    return await asyncio.gather(*[_run_era5_job(client, job, save_to, inflight, retries, backoff, poll, verbose) for job in jobs])
+
+def download_era5_data(variables: Union[str, list], start_date:datetime, end_date:datetime, save_to='./', group_size:int=1, 
+        max_inflight:int=4, retries:int=3, backoff:float=30, poll:float=10, client=None, verbose:bool=False, 
+        cache:DownloadCache=None, refresh:bool=False, region=None) -> bool:
     '''
-        downloads data at a single datetime or range thereof of global {variable} to data.nc in {save_to}
+        downloads data at a single datetime or range thereof of global {variable} to {save_to}, one file per job of plan_era5_requests.
+        with a data_spatial.Region only its enclosing box (plus ERA5_AREA_PAD degrees) is requested.
         save_to must end in a forward-slash.
 
-        assumes range of times from start_date and end_date. this means end_date CANNOT be earlier in the day than start_date.
-        ...well, technically an hour earlier, as the algorithm will not look at minutes, and hence rounds down all times to XX:00.
-        ERA5 only has 00:00, 6:00, 12:00, and 18:00. so of those hours in your range, only those are included for the final request.
+        ERA5 only has 00:00, 6:00, 12:00, and 18:00 for our purposes, all four are requested for every day in the range.
         That's up to four hours a day of DAILY DATA.
 
         This is daily data.
 
         variable must be str or list thereof.
 
+        up to {max_inflight} jobs are submitted to cds at once and polled asynchronously every {poll} seconds.
+        failed jobs are retried {retries} times, waiting backoff, 2*backoff, 4*backoff... seconds in between.
+        jobs whose file already exists are skipped, so an interrupted download picks up where it left off.
+
+        client defaults to cdsapi.Client(wait_until_complete=False). anything with the same retrieve(name, request) -> result
+        interface (result.reply['state'], result.update(), result.download(target)) can stand in for it, e.g. in tests.
+
+        if a data_manifest.DownloadCache is given, whole months are downloaded one variable at a time into the cache instead,
+        only for the (variable, month) units it does not hold yet (all of them if refresh), and {save_to} becomes a view of 
+        links to the cached units. preprocessing then crops the months to the requested dates.
+        a month that is not over yet is only fetched up to the last day ERA5 has (ERA5_LAG_DAYS ago), and fetched again
+        once a request needs days past those its unit covers.
+        units of a region are cached under their own keys, apart from the global ones and those of other regions.
+
         valid variables for era5 can be found here.
     '''
-    assert start_date.time() <= end_date.time(), f"ERA5 data for {variables} has end_date with time before start_date"
-    hour_list = [f'{hour:02d}:00' for hour in range(start_date.hour, end_date.hour + 1, 6)]
-        # they don't like 0:00 :(
-
-    c = cdsapi.Client()
-
-    request_params = {
-        'product_type': 'reanalysis',
-        'variable': variables,
-        'year': [start_date.year, end_date.year] if end_date else start_date.year,
-        'month': [start_date.month, end_date.month] if end_date else start_date.month,
-        'day': [start_date.day, end_date.day] if end_date else start_date.day,
-        'time': hour_list if len(hour_list) > 1 else hour_list[0],
-        'format': 'netcdf',
-        # 'area': [lat+1, lon-1, lat-1, lon+1], # North, West, South, East.
-    }
-
-    c.retrieve(
-        'reanalysis-era5-single-levels',
-        request_params,
-        f'{save_to}data.nc'
-    )
-
-    return True
+    if cache is not None: return _download_era5_cached(variables, start_date, end_date, save_to, cache, refresh,
+        max_inflight, retries, backoff, poll, client, verbose, region)
 
-################### GCM
+    area = region.area(ERA5_AREA_PAD) if region is not None else None
+    jobs = [job for job in plan_era5_requests(variables, start_date, end_date, group_size, area=area) if not os.path.exists(f"{save_to}{job['target']}")]
+    if verbose: print(f'{len(jobs)} ERA5 jobs left to download into {save_to}')
+    return _download_era5_jobs(jobs, save_to, max_inflight, retries, backoff, poll, client, verbose)
+
+def _download_era5_jobs(jobs: list, save_to: str, max_inflight: int, retries: int, backoff: float, poll: float, client, verbose: bool) -> bool:
+    if not jobs: return True
+    if client is None:
+        import cdsapi
+        client = cdsapi.Client(wait_until_complete=False, delete=False, quiet=not verbose)
+
+    done = asyncio.run(_run_era5_jobs(client, jobs, save_to, max_inflight, retries, backoff, poll, verbose))
+    return all(done)
+
+def _download_era5_cached(variables: Union[str, list], start_date:datetime, end_date:datetime, save_to: str, cache: DownloadCache, 
+        refresh: bool, max_inflight: int, retries: int, backoff: float, poll: float, client, verbose: bool, region=None) -> bool:
+    '''
+    see download_era5_data. fetches the (variable, month) units {cache} does not hold or that do not cover the requested days
+    into it, then links all of them into {save_to}.
+    '''
+    if not end_date: end_date = start_date
+    latest = _latest_era5_day()
+    stop = min(end_date.date().replace(day=calendar.monthrange(end_date.year, end_date.month)[1]), latest)
+    area = region.area(ERA5_AREA_PAD) if region is not None else None
+    jobs, needed = {}, {}
+    for job in plan_era5_requests(variables, start_date.replace(day=1), end_date.replace(year=stop.year, month=stop.month, day=stop.day),
+            group_size=1, area=area) if stop >= start_date.date().replace(day=1) else []:
+        request = job['request']
+        year, month = int(request['year']), int(request['month'])
+        key = DownloadCache.key(1, request['variable'][0], year, month, region.key if region is not None else None)
+        if region is not None: job['target'] = job['target'].replace('.nc', f'_{region.key}.nc') # staged apart from global units
+        job['days'] = tuple(f"{year:04d}-{month:02d}-{request['day'][i]}" for i in (0, -1)) # what the unit will cover
+        first = max(start_date.date(), datetime(year, month, 1).date())
+        last = min(end_date.date(), latest, datetime(year, month, calendar.monthrange(year, month)[1]).date())
+        needed[key] = (first.isoformat(), last.isoformat())
+        jobs[key] = job
+    if not jobs:
+        print(f'ERA5 has no data from {start_date} yet')
+        return False
+
+    missing = list(jobs) if refresh else cache.missing(jobs, days=needed)
+    if verbose: print(f'{len(jobs) - len(missing)} of {len(jobs)} ERA5 units already cached, downloading {len(missing)}')
+    if missing:
+        # a staging folder of its own, so that overlapping downloads never write the same .part file
+        staging = f'{cache.root}staging/{os.getpid()}-{uuid.uuid4().hex[:8]}/'
+        os.makedirs(staging)
+        try:
+            _download_era5_jobs([jobs[key] for key in missing], staging, max_inflight, retries, backoff, poll, client, verbose)
+            for key in missing:
+                if os.path.exists(f"{staging}{jobs[key]['target']}"): cache.add(key, f"{staging}{jobs[key]['target']}", jobs[key]['days'])
+        finally: shutil.rmtree(staging, ignore_errors=True)
 
-import pandas as pd
-import wget
+    cache.link({key: job['target'] for key, job in jobs.items()}, save_to)
+    absent = cache.missing(jobs, days=needed)
+    if absent: print(f'{len(absent)} ERA5 units could not be downloaded: {", ".join(absent)}')
+    return not absent
+
+def _latest_era5_day():
+    'the last day ERA5 can be expected to have'
+    return (datetime.now(timezone.utc) - timedelta(days=ERA5_LAG_DAYS)).date()
+
+################### HTTP
+
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import tqdm
 
-def download_gcm_data(variables: Union[str, list], gcm_type:int, start_date:datetime, end_date:datetime, save_to='./') -> bool:
-    """Download GCM data from CDS. Will get all 4 values per day.
+def http_session(pool_size:int=8) -> requests.Session:
+    'a session whose connection pool is big enough for {pool_size} parallel downloads, so connections get reused between files'
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_file(session: requests.Session, url: str, filepath: str, sha256:str=None, chunk_size:int=1 << 20, 
+        retries:int=5, backoff:float=5, timeout:float=60, position:int=0, verbose:bool=True) -> bool:
+    '''
+        downloads {url} to {filepath} through {filepath}.part, resuming a partial file with an http Range request,
+        and retrying with backoff whenever the connection drops.
+
+        the finished file must match the size the server announced, and {sha256} if one is given, 
+        before it is moved to {filepath}. a mismatch throws the partial file away and starts over.
+    '''
+    part = filepath + '.part'
+    for attempt in range(retries + 1):
+        try:
+            with span('download.http', file=os.path.basename(filepath), attempt=attempt) as s:
+                have = os.path.getsize(part) if os.path.exists(part) else 0
+                # identity: content-length must be the size of the bytes written, and ranges must be offsets into the file itself
+                headers = {'Accept-Encoding': 'identity', **({'Range': f'bytes={have}-'} if have else {})}
+                with session.get(url, stream=True, headers=headers, timeout=timeout) as response:
+                    if response.status_code == 416: total = have # the partial file already holds everything
+                    else:
+                        response.raise_for_status()
+                        if have and response.status_code != 206: have = 0 # server ignored the range, start over
+                        length = response.headers.get('content-length')
+                        encoded = response.headers.get('content-encoding', 'identity') != 'identity' # decoded by iter_content
+                        total = have + int(length) if length is not None and not encoded else None
+
+                        progress = tqdm.tqdm(total=total, initial=have, unit='iB', unit_scale=True, 
+                            desc=os.path.basename(filepath), position=position, leave=verbose, disable=not verbose)
+                        with open(part, 'ab' if have else 'wb', buffering=chunk_size) as f:
+                            for data in response.iter_content(chunk_size=chunk_size):
+                                f.write(data)
+                                progress.update(len(data))
+                        progress.close()
+
+                size = os.path.getsize(part)
+                s.add(bytes=size - have)
+                if total is not None and size < total: raise IOError(f'{filepath} cut off at {size} of {total} bytes') # resumed next attempt
+                if (total is not None and size != total) or (sha256 and sha256_of(part) != sha256):
+                    os.remove(part)
+                    raise IOError(f'{filepath} failed verification ({size} bytes, expected {total})')
+                os.replace(part, filepath)
+                return True
+        except (requests.RequestException, IOError) as e:
+            if attempt == retries:
+                print(f'download of {url} failed after {retries + 1} attempts: {e}')
+                return False
+            if verbose: print(f'download of {url} interrupted ({e}), resuming in {backoff * 2 ** attempt}s')
+            time.sleep(backoff * 2 ** attempt)
+
+def fetch_files(files: dict, parallel:int=4, checksums:dict=None, verbose:bool=True, **kwargs) -> bool:
+    '''
+        downloads every url -> filepath in {files} with fetch_file, {parallel} at a time over one pooled session.
+        files that already exist are skipped. checksums optionally maps filepaths to their sha256.
+        returns whether every file is present afterwards.
+    '''
+    todo = [(url, path) for url, path in files.items() if not os.path.exists(path)]
+    if not todo: return True
+    checksums = checksums or {}
+    session = http_session(parallel)
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        done = list(pool.map(lambda job: fetch_file(session, job[1][0], job[1][1], checksums.get(job[1][1]), 
+            position=job[0] % parallel, verbose=verbose, **kwargs), enumerate(todo)))
+    session.close()
+    return all(done)
+
+################### GCM
+
+GCM_URL = 'https://download.scidb.cn/download'
+
+def download_gcm_data(variables: Union[str, list], gcm_type:int, start_date:datetime, end_date:datetime, save_to='./', 
+        parallel:int=4, checksums:dict=None, base_url:str=GCM_URL, verbose:bool=True) -> bool:
+    """Download GCM data from scidb. Will get all 4 values per day.
 
     Args:
         variables (list): Variables to download
@@ -64,6 +275,9 @@ def download_gcm_data(variables: Union[str, list], gcm_type:int, start_date:date
         start_date (datetime): Start date
         end_date (datetime): End date  
         save_to (str): Path to save the data
+        parallel (int): Number of files downloaded at once (see fetch_files), partial files are resumed
+        checksums (dict): Optional sha256 per file name to verify against
+        base_url (str): Download endpoint, can be pointed at a local server for testing
     """
     # download method informed by professor's 
     # !wget -P /content/drive/MyDrive/P_Misc/Climate-Forecasting/GCM_bc \
@@ -72,30 +286,25 @@ def download_gcm_data(variables: Union[str, list], gcm_type:int, start_date:date
 
     # Determine fileIds based on gcm_type and date range
   
-    fileIds = ['61b95de78bba886bd1c5216a', '61babc7dac0a5211856bc715'] 
-    
-    for fileId in fileIds:
-        url = f'https://download.scidb.cn/download?fileId={fileId}&dataSetType=personal'
-        # Stream the response to a file on disk
-        response = requests.get(url, stream=True)
-        total_size = int(response.headers.get('content-length', 0))
-        
-        filepath = f'{save_to}{fileId}.nc'
-        
-        progress_bar = tqdm.tqdm(total=total_size, unit='iB', unit_scale=True)
-        with open(filepath, 'wb') as f:
-            for data in response.iter_content(chunk_size=1024):
-                progress_bar.update(len(data))
-                f.write(data)
-            
-        progress_bar.close()
-
-    return True
-    
-
-    
+    fileIds = {'61b95de78bba886bd1c5216a': 'atm_hist_1993_04.nc4', '61babc7dac0a5211856bc715': 'atm_ssp245_2094_08.nc4'}
+
+    files = {f'{base_url}?fileId={fileId}&dataSetType=personal&fileName={name}': f'{save_to}{name}' for fileId, name in fileIds.items()}
+    checksums = {f'{save_to}{name}': digest for name, digest in (checksums or {}).items()}
+    return fetch_files(files, parallel, checksums, verbose)
 
 ################### GSOD
 
-def download_gsod_data(variable, start_date:datetime, end_date:datetime, save_to='./') -> bool:
-    return True
\ No newline at end of file
+GSOD_URL = 'https://www.ncei.noaa.gov/data/global-summary-of-the-day/archive/'
+ISD_HISTORY_URL = 'https://www.ncei.noaa.gov/pub/data/noaa/isd-history.csv'
+
+def download_gsod_data(variable, start_date:datetime, end_date:datetime, save_to='./', parallel:int=4, 
+        base_url:str=GSOD_URL, history_url:str=ISD_HISTORY_URL, verbose:bool=True) -> bool:
+    '''
+        downloads the yearly GSOD archives (one csv per station inside) from start_date to end_date as gsod_YYYY.tar.gz,
+        and isd-history.csv, the station locations data_spatial.StationIndex is built from, to {save_to}.
+        archives hold every variable, so {variable} does not narrow the download.
+        transfers are parallel and resumable, see fetch_files.
+    '''
+    files = {f'{base_url}{year}.tar.gz': f'{save_to}gsod_{year}.tar.gz' for year in range(start_date.year, end_date.year + 1)}
+    files[history_url] = f'{save_to}isd-history.csv'
+    return fetch_files(files, parallel, verbose=verbose)
\ No newline at end of file
@@ -0,0 +1,140 @@
+############## GENERAL
+
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from data_cube import RawArrays
+
+# feeding the downscaling model: aligned (low resolution input, high resolution target) samples, each a spatial patch over a
+# window of consecutive days, cut straight out of two export_raw folders (see data_cube.RawArrays). nothing but the batches
+# being assembled is ever read, so decades of data cost the page cache, not the training process.
+
+class PairedBatches:
+    '''
+    Shuffled batches of aligned samples from an {inputs} export (e.g. GCM) and a {targets} export (ERA5, GSOD) on a finer grid.
+    inputs and targets are RawArrays or export_raw folders; their grids must share their origin and the input resolution
+    must be a multiple of the target's, {scale} target cells to an input cell.
+
+    a sample is a {patch} x {patch} cell patch of the input grid (origins every {stride} cells, {patch} by default) over {window}
+    consecutive days, and the patch covering the same area on the target grid over the same days.
+    iterating yields one epoch of dicts:
+        input: float32 (batch, window, input variables, patch, patch)
+        target: float32 (batch, window, target variables, patch * scale, patch * scale), NaN where there is no value
+        day: first day of every sample, latitude/longitude: south-west corner of every patch
+
+    the order of an epoch only depends on {seed} and the epoch number, so runs are reproducible whatever {workers} is.
+    the next {prefetch} batches are assembled by a pool of {workers} threads while the current one is used.
+    days the inputs or targets have no value at all on (e.g. days outside of a source's records, or months missing from a
+    download) are skipped when skip_empty_days, as recorded by export_raw. samples whose target patch is less than {min_valid}
+    finite (as a fraction) are dropped from their batch, so sparse targets such as GSOD stations can still be used,
+    at the cost of smaller batches.
+    '''
+    def __init__(self, inputs, targets, input_variables:list=None, target_variables:list=None, patch=8, window=1, stride:int=None,
+                 batch_size=32, start_date=None, end_date=None, seed=0, prefetch=4, workers=2, skip_empty_days=True, min_valid=0.):
+        self.inputs = inputs if isinstance(inputs, RawArrays) else RawArrays(inputs)
+        self.targets = targets if isinstance(targets, RawArrays) else RawArrays(targets)
+        self.input_variables = list(input_variables or self.inputs.arrays)
+        self.target_variables = list(target_variables or self.targets.arrays)
+        self.patch, self.window, self.stride = patch, window, stride or patch
+        self.batch_size, self.seed, self.prefetch, self.workers, self.min_valid = batch_size, seed, prefetch, workers, min_valid
+        self.epoch = 0
+
+        step_in, step_out = self.inputs.meta['latitude']['step'], self.targets.meta['latitude']['step']
+        self.scale = int(round(step_in / step_out))
+        assert self.scale >= 1 and abs(self.scale * step_out - step_in) < 1e-9, \
+            f'the input resolution ({step_in}) is not a multiple of the target resolution ({step_out})'
+        for axis in ('latitude', 'longitude'):
+            assert abs(self.inputs.meta[axis]['start'] - self.targets.meta[axis]['start']) < 1e-9, f'the grids do not share their {axis} origin'
+
+        # days both have, as offsets into each
+        first = max(self.inputs.start, self.targets.start)
+        last = min(self.inputs.start + len(self.inputs), self.targets.start + len(self.targets)) - 1
+        if start_date is not None: first = max(first, self.inputs.start + self.inputs.index(start_date))
+        if end_date is not None: last = min(last, self.inputs.start + self.inputs.index(end_date))
+        self.first = first
+        self._offsets = (int((first - self.inputs.start).astype(np.int64)), int((first - self.targets.start).astype(np.int64)))
+        days = max(int((last - first).astype(np.int64)) + 1, 0)
+
+        present = np.ones(days, dtype=bool)
+        if skip_empty_days and days:
+            present &= self._present(self.inputs, self.input_variables, self._offsets[0], days)
+            present &= self._present(self.targets, self.target_variables, self._offsets[1], days)
+        # a window starts on a day when all of its days are present
+        complete = np.convolve(present, np.ones(window, dtype=np.int64), mode='valid') == window if days >= window else np.zeros(0, dtype=bool)
+        self.starts = np.flatnonzero(complete).astype(np.int32) # day offsets from {first}
+
+        nlat = min(self.inputs.meta['latitude']['count'], self.targets.meta['latitude']['count'] // self.scale)
+        nlon = min(self.inputs.meta['longitude']['count'], self.targets.meta['longitude']['count'] // self.scale)
+        self.origins = np.array([(i, j) for i in range(0, nlat - patch + 1, self.stride) for j in range(0, nlon - patch + 1, self.stride)],
+            dtype=np.int32).reshape(-1, 2) # input cells of the south-west corners
+        assert len(self.origins), f'a {patch} cell patch does not fit the {nlat} x {nlon} input grid'
+
+    @staticmethod
+    def _present(arrays: RawArrays, variables: list, offset: int, days: int, chunk=366) -> np.ndarray:
+        '''
+        whether each day holds any finite value of every variable, from what export_raw recorded,
+        or read a chunk of days at a time for older exports that lack that record.
+        '''
+        present = np.ones(days, dtype=bool)
+        for v in variables:
+            if arrays.present is not None:
+                present &= arrays.present[v][offset:offset + days]
+                continue
+            for d in range(0, days, chunk):
+                block = arrays[v][offset + d:offset + min(d + chunk, days)]
+                present[d:d + len(block)] &= np.isfinite(block).any(axis=(1, 2))
+        return present
+
+    def __len__(self) -> int:
+        'batches per epoch (fewer samples may come out when min_valid drops some)'
+        return -(-self.samples // self.batch_size)
+
+    @property
+    def samples(self) -> int:
+        return len(self.starts) * len(self.origins)
+
+    def __str__(self) -> str:
+        return (f'PairedBatches of {self.samples} samples ({len(self.starts)} windows x {len(self.origins)} patches) in {len(self)} batches of {self.batch_size}, '
+            f"{', '.join(self.input_variables)} {self.patch}x{self.patch} -> {', '.join(self.target_variables)} "
+            f'{self.patch * self.scale}x{self.patch * self.scale}, {self.window} day window(s) from {self.first}')
+
+    def order(self, epoch: int) -> np.ndarray:
+        'sample indices of an epoch in the order they are served, a function of seed and epoch only'
+        return np.random.default_rng([self.seed, epoch]).permutation(self.samples)
+
+    def batch(self, indices: np.ndarray) -> dict:
+        'assembles the samples at {indices} (see order) into a batch, copying only their patches out of the memory maps'
+        n_origins, p, s, w = len(self.origins), self.patch, self.scale, self.window
+        starts, origins = self.starts[indices // n_origins], self.origins[indices % n_origins]
+        x = np.empty((len(indices), w, len(self.input_variables), p, p), dtype=np.float32)
+        y = np.empty((len(indices), w, len(self.target_variables), p * s, p * s), dtype=np.float32)
+        for b, (t, (i, j)) in enumerate(zip(starts, origins)):
+            t_in, t_out = self._offsets[0] + t, self._offsets[1] + t
+            for c, v in enumerate(self.input_variables): x[b, :, c] = self.inputs[v][t_in:t_in + w, i:i + p, j:j + p]
+            for c, v in enumerate(self.target_variables): y[b, :, c] = self.targets[v][t_out:t_out + w, i * s:(i + p) * s, j * s:(j + p) * s]
+        if self.min_valid > 0:
+            keep = np.isfinite(y).reshape(len(y), -1).mean(axis=1) >= self.min_valid
+            x, y, starts, origins = x[keep], y[keep], starts[keep], origins[keep]
+        return {'input': x, 'target': y, 'day': self.first + starts.astype('timedelta64[D]'),
+            'latitude': self.inputs.latitude[origins[:, 0]], 'longitude': self.inputs.longitude[origins[:, 1]]}
+
+    def batches(self, epoch:int=None):
+        '''
+        yields the batches of an epoch ({self.epoch} by default) in order, while the next {prefetch} are being assembled in the
+        background. stopping early (break) cancels what was not started yet.
+        '''
+        order = self.order(self.epoch if epoch is None else epoch)
+        pending = deque()
+        with ThreadPoolExecutor(self.workers) as pool:
+            try:
+                for begin in range(0, len(order), self.batch_size):
+                    pending.append(pool.submit(self.batch, order[begin:begin + self.batch_size]))
+                    if len(pending) > self.prefetch: yield pending.popleft().result()
+                while pending: yield pending.popleft().result()
+            finally:
+                for future in pending: future.cancel()
+
+    def __iter__(self):
+        'one epoch, the next one on the next iteration'
+        epoch, self.epoch = self.epoch, self.epoch + 1
+        return self.batches(epoch)
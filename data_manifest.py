@@ -0,0 +1,117 @@
+############## GENERAL
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+try: import fcntl
+except ImportError: fcntl = None # windows, only threads of one process are serialized there
+
+_LOCKS = {} # manifest path -> threading.Lock shared by every DownloadCache of that root in this process
+_SHARED = {}
+
+def sha256_of(filepath: str, chunk_size:int=1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''): h.update(block)
+    return h.hexdigest()
+
+class DownloadCache:
+    '''
+    A content-addressed cache of downloaded units shared by every WeatherData.
+
+    A unit is the smallest piece a source is downloaded in (for ERA5 one variable for one month), keyed "source/variable/YYYY-MM"
+    (or "source/variable/YYYY-MM/region-..." for the units of a data_spatial.Region).
+    Files are stored once under {root}objects/<first two hex digits>/<sha256><ext>, and {root}manifest.json records
+    which file (sha256 and size) holds each unit, and the days it covers when it was fetched before its month was over
+    (first and last, YYYY-MM-DD), so that a later, longer request fetches it again. A WeatherData view of a date range is then just a folder of links
+    to the units it needs (see link), so overlapping or differently-ordered requests only fetch what is missing.
+
+    Several downloads may use the same root at once (threads of WorkingData.run, or other processes): add merges its unit
+    into the manifest on disk under a file lock rather than writing its own snapshot over it. shared(root) hands out
+    one instance per root for the whole process.
+    '''
+    def __init__(self, root='./downloads/cache/'):
+        self.root = root
+        self._manifest_path = f'{root}manifest.json'
+        self._lock = _LOCKS.setdefault(os.path.abspath(self._manifest_path), threading.Lock())
+        if not os.path.exists(f'{root}objects/'): os.makedirs(f'{root}objects/')
+        self.manifest = json.load(open(self._manifest_path)) if os.path.exists(self._manifest_path) else {}
+
+    def __str__(self) -> str:
+        return f'DownloadCache {self.root} holding {len(self.manifest)} units'
+
+    @classmethod
+    def shared(cls, root='./downloads/cache/') -> 'DownloadCache':
+        'the one DownloadCache of {root} in this process'
+        key = os.path.abspath(root)
+        if key not in _SHARED: _SHARED[key] = cls(root)
+        return _SHARED[key]
+
+    @staticmethod
+    def key(source: int, variable: str, year: int, month: int, region:str=None) -> str:
+        return f'{source}/{variable}/{year:04d}-{month:02d}' + (f'/{region}' if region else '')
+
+    def path(self, key: str) -> str:
+        entry = self.manifest[key]
+        return f"{self.root}objects/{entry['sha256'][:2]}/{entry['sha256']}{entry['ext']}"
+
+    def has(self, key: str, verify=False, days:tuple=None) -> bool:
+        '''
+        whether the unit is cached, covers {days} ((first, last) as YYYY-MM-DD, when given) and its file is intact
+        (right size, and right hash if verify). units recorded without days cover the whole of their unit.
+        '''
+        if key not in self.manifest: return False
+        covered = self.manifest[key].get('days')
+        if days and covered and (covered[0] > days[0] or covered[1] < days[1]): return False
+        path = self.path(key)
+        if not os.path.exists(path) or os.path.getsize(path) != self.manifest[key]['size']: return False
+        return not verify or sha256_of(path) == self.manifest[key]['sha256']
+
+    def missing(self, keys, verify=False, days:dict=None) -> list:
+        'the keys that are not cached, or whose units do not cover the days {days} maps them to (see has)'
+        return [key for key in keys if not self.has(key, verify, (days or {}).get(key))]
+
+    def add(self, key: str, filepath: str, days:tuple=None) -> str:
+        'moves a freshly downloaded file into the cache as {key}, covering {days} (first, last) if not all of it, returns where it is stored now'
+        digest = sha256_of(filepath)
+        ext = os.path.splitext(filepath)[1]
+        target = f'{self.root}objects/{digest[:2]}/{digest}{ext}'
+        if not os.path.exists(os.path.dirname(target)): os.makedirs(os.path.dirname(target))
+        if os.path.exists(target): os.remove(filepath) # identical content is already stored
+        else: os.replace(filepath, target)
+        with self._lock, open(f'{self.root}manifest.lock', 'a') as lock:
+            if fcntl: fcntl.flock(lock, fcntl.LOCK_EX) # released when the file closes
+            # units other downloads added since this instance read the manifest must survive this write
+            if os.path.exists(self._manifest_path): self.manifest.update(json.load(open(self._manifest_path)))
+            self.manifest[key] = {'sha256': digest, 'size': os.path.getsize(target), 'ext': ext}
+            if days: self.manifest[key]['days'] = list(days)
+            self._save()
+        return target
+
+    def _save(self):
+        tmp = self._manifest_path + '.tmp'
+        with open(tmp, 'w') as f: json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._manifest_path) # never leave a half-written manifest behind
+
+    def link(self, names: dict, view: str) -> list:
+        '''
+        puts the cached units of {names} (key -> file name) into the folder {view} as hard links
+        (falling back to symlinks, then copies), replacing stale entries. returns the keys that are not cached.
+        '''
+        if not os.path.exists(view): os.makedirs(view)
+        absent = []
+        for key, name in names.items():
+            if not self.has(key):
+                absent.append(key)
+                continue
+            source, target = self.path(key), f'{view}{name}'
+            if os.path.lexists(target):
+                if os.path.exists(target) and os.path.samefile(source, target): continue
+                os.remove(target)
+            try: os.link(source, target)
+            except OSError:
+                try: os.symlink(os.path.abspath(source), target)
+                except OSError: shutil.copy2(source, target)
+        return absent
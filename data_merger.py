@@ -0,0 +1,78 @@
+############## GENERAL
+
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from data_store import list_partitions, read_partition, write_partition, clear_store, naive_timestamp
+
+# sources are aligned on (time, latitude, longitude), encoded as one int64 per cell-day on the shared grid:
+# day * cells + latitude index * longitudes + longitude index. sorted, unique keys make every join a linear merge.
+KEY = ['time', 'latitude', 'longitude']
+
+def encode_key(df: pd.DataFrame, interpolation=1.25) -> np.ndarray:
+    nlat, nlon = int(round(180 / interpolation)), int(round(360 / interpolation))
+    days = df['time'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    ilat = np.rint((df['latitude'].to_numpy(np.float64) + 90) / interpolation).astype(np.int64)
+    ilon = np.rint((df['longitude'].to_numpy(np.float64) % 360) / interpolation).astype(np.int64) % nlon
+    return days * (nlat * nlon) + ilat * nlon + ilon
+
+def decode_key(keys: np.ndarray, interpolation=1.25) -> pd.DataFrame:
+    nlat, nlon = int(round(180 / interpolation)), int(round(360 / interpolation))
+    days, cells = np.divmod(keys, nlat * nlon)
+    return pd.DataFrame({
+        'time': days.astype('datetime64[D]').astype('datetime64[ns]'),
+        'latitude': (cells // nlon) * interpolation - 90,
+        'longitude': (cells % nlon) * interpolation,
+    })
+
+def _keyed(df: pd.DataFrame, interpolation: float, label: str, verbose: bool) -> pd.DataFrame:
+    'indexes a source partition by its sorted cell-day key, averaging any duplicate keys (e.g. several stations in a cell)'
+    df = df.set_index(encode_key(df, interpolation)).drop(columns=KEY).sort_index()
+    if not df.index.is_unique:
+        if verbose: print(f'{int(df.index.duplicated().sum())} duplicate cell-days in {label} averaged before merging')
+        df = df.groupby(level=0).mean()
+    return df
+
+def merge_partition(frames: dict, technique='saveall', interpolation=1.25, verbose=False) -> pd.DataFrame:
+    '''
+    joins one partition of every source (label -> long-format frame) on the grid key with an outer sort-merge join.
+
+    technique:
+      - saveall: keep every source's values side by side as {variable}_{label}, for every cell-day any source has
+      - combine: average values of the same variable across sources into a single {variable} column
+    '''
+    keyed = [_keyed(df, interpolation, label, verbose).add_suffix(f'_{label}') for label, df in frames.items() if df is not None and len(df)]
+    if not keyed: return pd.DataFrame(columns=KEY)
+    # indexes are sorted and unique, so pandas aligns them with a linear merge rather than hashing
+    joined = pd.concat(keyed, axis=1, join='outer', sort=True)
+
+    if technique == 'combine':
+        variables = {}
+        for column in joined.columns: variables.setdefault(column.rsplit('_', 1)[0], []).append(column)
+        joined = pd.DataFrame({v: joined[columns].mean(axis=1) for v, columns in variables.items()}, index=joined.index)
+    else: assert technique == 'saveall', f'unknown merging technique {technique}'
+
+    merged = decode_key(joined.index.to_numpy(), interpolation)
+    for column in joined.columns: merged[column] = joined[column].to_numpy()
+    return merged
+
+def merge_stores(stores: dict, save_to: str, technique='saveall', interpolation=1.25, start_date:datetime=None, end_date:datetime=None, verbose=False) -> bool:
+    '''
+    merges the preprocessed stores of several sources (label -> store root) into a store at {save_to}store/,
+    one year/month partition at a time, so memory scales with a single month of every source rather than with decades.
+    only the dates between start_date and end_date (inclusive) are merged if given. see merge_partition for the techniques.
+    '''
+    start, end = naive_timestamp(start_date), naive_timestamp(end_date)
+    months = sorted({(year, month) for root in stores.values() for year, month, _ in list_partitions(root, start, end)})
+    clear_store(f'{save_to}store/')
+    for year, month in months:
+        frames = {}
+        for label, root in stores.items():
+            df = read_partition(root, year, month)
+            if df is not None and start is not None: df = df[df['time'] >= start]
+            if df is not None and end is not None: df = df[df['time'] <= end]
+            frames[label] = df
+        merged = merge_partition(frames, technique, interpolation, verbose)
+        if len(merged): write_partition(merged, f'{save_to}store/')
+        if verbose: print(f'merged {year:04d}-{month:02d}: {len(merged)} cell-days from {sum(f is not None for f in frames.values())} source(s)')
+    return bool(months)
@@ -6,26 +6,47 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
+import os
+from data_store import load_preprocessed
+from data_pyramid import query_days
+from data_cache import cached
 import asyncio
 
+def mean_map(data_dir, variable, start, end) -> tuple:
+    '''
+    (latitudes, longitudes, grid of means) of {variable} between the days start and end (inclusive) in the preprocessed data_dir,
+    from the aggregation pyramid if there is one, else from the store (or legacy data.csv).
+    kept in the process-wide data_cache until the preprocessed output changes, so drawing the same map again is free.
+    '''
+    data_dir = os.path.join(data_dir, '')
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    def load():
+        if os.path.exists(f'{data_dir}pyramid/state.json'):
+            # combine the few precomputed decade/year blocks of the whole months, and the days of partial ones (see data_pyramid)
+            return query_days(data_dir, variable, start, end)
+        # Load only the variable and the dates asked for
+        df = load_preprocessed(data_dir, ['latitude', 'longitude', variable], start, end + pd.Timedelta(hours=23, minutes=59, seconds=59))
+        # Create a pivot table with latitude and longitude as indices
+        pivot = df.pivot_table(values=variable, index='latitude', columns='longitude')
+        return pivot.index.to_numpy(), pivot.columns.to_numpy(), pivot.to_numpy()
+    return cached(('mean_map', data_dir, variable, start, end), [f'{data_dir}pyramid/', f'{data_dir}store/', f'{data_dir}data.csv'], load)
+
+def _read_csv(path: str, **kwargs) -> pd.DataFrame:
+    'pd.read_csv through the process-wide data_cache, the frame is shared so it must not be modified in place'
+    return cached(('read_csv', os.path.abspath(path), repr(sorted(kwargs.items()))), [path], lambda: pd.read_csv(path, **kwargs))
+
 def plot_spatial_freq_map(data_dir, variable, start_year, end_year):
     """
     Create a spatial frequency map for a specified variable and time period.
 
     Parameters:
-    - data_dir: The directory where the data file is located.
+    - data_dir: The directory where the preprocessed store (or legacy data.csv) is located. 
+      If an aggregation pyramid was built there (data_pyramid.build_pyramid) the map is read from it instead.
     - variable: The variable of interest to plot.
     - start_year, end_year: The time period for which to plot the data.
     """
-    # Load the data
-    df = pd.read_csv(f'{data_dir}/data.csv')
-    
-    # Filter for the specified time period and variable
-    df['time'] = pd.to_datetime(df['time'])
-    df = df[(df['time'].dt.year >= start_year) & (df['time'].dt.year <= end_year)]
-    
-    # Create a pivot table with latitude and longitude as indices
-    pivot = df.pivot_table(values=variable, index='latitude', columns='longitude')
+    lat, lon, values = mean_map(data_dir, variable, f'{start_year}-01-01', f'{end_year}-12-31')
+    pivot = pd.DataFrame(values, index=lat, columns=lon)
     
     # Create the plot
     fig = plt.figure(figsize=(10, 5))
@@ -54,11 +75,8 @@ def plot_data(df1, df2, title1, title2):
 
 
 def plot_data(variable):
-    df = pd.read_csv(f'{variable}_data.csv')
-
     # Assuming we're working with time series data
-    df['time'] = pd.to_datetime(df['time'])
-    df.set_index('time', inplace=True)
+    df = _read_csv(f'{variable}_data.csv', parse_dates=['time']).set_index('time')
 
     # plot data
     df['t2m'].plot()
@@ -67,13 +85,10 @@ def plot_data(variable):
 
 def plot_global_data(variable, name='April 2023'):
     # Load data from the csv file
-    data = pd.read_csv(f'{variable}_data.csv')
+    data = _read_csv(f'{variable}_data.csv')
 
     print(data.shape)
 
-    # cast to 32bit
-    data['t2m'] = data['t2m'].astype(np.float32)
-
     #longitude = np.linspace(-180, 180, 192)
     #latitude = np.linspace(-90, 90, 94)
     #longitude, latitude = np.meshgrid(longitude, latitude)
@@ -83,7 +98,9 @@ def plot_global_data(variable, name='April 2023'):
     #plt.contourf(longitude, latitude, data.t2m, cmap='jet')
     
         # Pivot data to 2D format suitable for contour plot
-    data_2d = data.pivot(index='latitude', columns='longitude', values='t2m')
+    # cast to 32bit
+    data_2d = cached(('global_pivot', os.path.abspath(f'{variable}_data.csv')), [f'{variable}_data.csv'],
+        lambda: data.pivot(index='latitude', columns='longitude', values='t2m').astype(np.float32))
 
     # Create a contour plot of the data
     plt.contourf(data_2d.columns, data_2d.index, data_2d.values, cmap='jet')
@@ -92,3 +109,100 @@ def plot_global_data(variable, name='April 2023'):
     plt.xlabel('Longitude')
     plt.ylabel('Latitude')
     plt.show()
+
+############## BATCH RENDERING
+
+import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+def _period_range(period) -> tuple:
+    '''
+    (start, end, label) of a plot period: 'YYYY-MM', 'YYYY', 'YYYY-YYYY' or a (start, end) pair of anything pandas reads as dates.
+    '''
+    if isinstance(period, (tuple, list)):
+        start, end = pd.Timestamp(period[0]), pd.Timestamp(period[1])
+        return start, end, f'{start:%Y%m%d}-{end:%Y%m%d}'
+    period = str(period)
+    if re.fullmatch(r'\d{4}-\d{4}', period):
+        first, last = period.split('-')
+        return pd.Timestamp(f'{first}-01-01'), pd.Timestamp(f'{last}-12-31'), period
+    p = pd.Period(period)
+    return p.start_time, p.end_time.floor('D'), period
+
+_CANVAS = {} # per worker process: (figsize, dpi) -> (figure, map axes, colorbar axes), reused for every frame
+
+def _canvas(figsize: tuple, dpi: int) -> tuple:
+    '''
+    a figure drawn with the Agg backend directly (no pyplot, no display), whose projection and coastlines are set up
+    only once per worker. frames only swap the data layer and colorbar.
+    '''
+    if (figsize, dpi) not in _CANVAS:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0.03, 0.08, 0.82, 0.84], projection=ccrs.PlateCarree())
+        ax.set_global()
+        ax.coastlines()
+        cax = fig.add_axes([0.88, 0.15, 0.02, 0.7])
+        _CANVAS[figsize, dpi] = fig, ax, cax
+    return _CANVAS[figsize, dpi]
+
+def _render(spec: dict) -> dict:
+    'renders one map spec (see render_maps) in a worker, returns its index entry'
+    entry = {k: spec[k] for k in ('variable', 'period', 'source')}
+    try:
+        start, end, label = _period_range(spec['period'])
+        lat, lon, values = mean_map(spec['source'], spec['variable'], start, end)
+        fig, ax, cax = _canvas(spec['figsize'], spec['dpi'])
+        mesh = ax.pcolormesh(lon, lat, np.ma.masked_invalid(values), transform=ccrs.PlateCarree(), shading='auto',
+            cmap=spec['cmap'], vmin=spec.get('vmin'), vmax=spec.get('vmax'))
+        cax.clear()
+        fig.colorbar(mesh, cax=cax, label=spec['variable'])
+        ax.set_title(f"{spec['variable']} {spec.get('name', spec['source'])} ({label})")
+        entry['path'] = spec['path']
+        fig.savefig(entry['path'])
+        mesh.remove()
+    except Exception as e: # one bad frame should not take the batch down with it
+        entry['error'] = repr(e)
+    return entry
+
+def render_maps(specs: list, save_to='./maps/', processes:int=None, cmap='viridis', figsize=(10, 5), dpi=100, verbose=False) -> list:
+    '''
+    Renders a batch of mean maps to PNG files in {save_to}, headless and in parallel, instead of one plt.show() at a time.
+
+    specs is a list of (variable, period, source) tuples or dicts with those keys, where source is a preprocessed directory 
+    (e.g. WeatherData._preprocessat) and period is 'YYYY-MM', 'YYYY', 'YYYY-YYYY' or a (start, end) pair.
+    dicts may also set 'name' (used instead of the source in titles and file names), 'vmin'/'vmax' (to share a color scale 
+    across frames) and 'cmap'.
+
+    frames are spread over a pool of {processes} workers, each of which sets up its figure, projection and coastlines once.
+    writes {save_to}index.json listing every spec with the path of its image, or the error it failed with, and returns that list.
+    images are named {variable}_{name or source}_{period}.png. specs that would share a name (other cmap or vmin/vmax,
+    sources that read the same once sanitized...) get a short hash of the spec appended, so no frame overwrites another.
+    '''
+    if not os.path.exists(save_to): os.makedirs(save_to)
+    jobs, taken = [], set()
+    for n, spec in enumerate(specs):
+        if not isinstance(spec, dict): spec = dict(zip(('variable', 'period', 'source'), spec))
+        job = {'cmap': cmap, **spec, 'save_to': save_to, 'figsize': tuple(figsize), 'dpi': dpi}
+        try: label = _period_range(spec['period'])[2]
+        except Exception: label = re.sub(r'[^\w.-]+', '-', str(spec['period'])) # the worker reports the error
+        source = re.sub(r'[^\w.-]+', '-', str(spec.get('name', spec['source']))).strip('-.')
+        name = f"{spec['variable']}_{source}_{label}"
+        if name in taken: name += '_' + hashlib.sha1(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()[:8]
+        if name in taken: name += f'_{n}' # the very same spec twice
+        taken.add(name)
+        job['path'] = f'{save_to}{name}.png'
+        jobs.append(job)
+
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes) as pool:
+        index = list(pool.map(_render, jobs, chunksize=max(1, len(jobs) // (processes * 4))))
+
+    with open(f'{save_to}index.json', 'w') as f: json.dump(index, f, indent=1, default=str)
+    failed = [e for e in index if 'error' in e]
+    if verbose: print(f'rendered {len(index) - len(failed)} map(s) to {save_to}, {len(failed)} failed')
+    return index
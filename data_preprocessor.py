@@ -1,112 +1,419 @@
-####################### ERA5
+############## GENERAL
 
+import os
+import glob
 from datetime import datetime
 import xarray as xr
 import numpy as np
+import pandas as pd
 from typing import Union
+from data_regridder import as_regridder
+from data_store import clear_store, clear_partition, write_partition, naive_timestamp, fingerprint, load_state, save_state
+from data_store import export_csv as store_to_csv
+from data_trace import span
 import asyncio
 
-def preprocess_era5_data(variables: Union[str, list], transform=None, interpolate=1.25, get_from='./', save_to='./', verbose:bool=False) -> bool:
+def _time_chunks(data, chunk='M'):
+    '''
+        yields (period, dataset) for consecutive slices of data along time, one per {chunk} period (a pandas offset alias such as 'M' or 'D').
+        slicing is lazy, so nothing is read from disk until the caller loads a chunk.
+        if chunk is None the whole dataset is yielded once.
+    '''
+    if chunk is None:
+        yield None, data
+        return
+    periods = data.indexes['time'].to_period(chunk)
+    # times are sorted, so every period is one contiguous run
+    starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+    for begin, finish in zip(starts, np.r_[starts[1:], len(periods)]):
+        yield periods[begin], data.isel(time=slice(begin, finish))
+
+def _daily_mean(data, variables: list):
     '''
-        loads data from {get_from}data.nc, 
-        interpolates at 1.25 degrees by default, 
+        averages sub-daily {variables} of data to one value per day at 00:00, as a vectorized reduction over the (sorted) time axis.
+        a timestamp only counts towards a cell's mean if every variable is present there, 
+        which is the same as dropping rows with any NaN before averaging in long format.
+        cell-days without a single valid timestamp are left NaN.
+    '''
+    days = data.indexes['time'].floor('D')
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    arrays = [data[v].transpose('time', ...) for v in variables]
+    valid = np.logical_and.reduce([a.notnull().values for a in arrays])
+    counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+
+    daily = {}
+    for v, a in zip(variables, arrays):
+        sums = np.add.reduceat(np.where(valid, a.values.astype(np.float64), 0.), starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'): daily[v] = (a.dims, sums / counts)
+    coords = {d: data[d] for d in arrays[0].dims if d != 'time'}
+    coords['time'] = days[starts]
+    return xr.Dataset(daily, coords=coords)
+
+def _to_frame(daily, order=('time', 'latitude', 'longitude')):
+    'flattens a daily dataset to long format (only for export), dropping cell-days that have no value'
+    return daily.to_dataframe(dim_order=list(order)).reset_index().dropna(how='any')
+
+####################### ERA5
+
+def _era5_months(get_from: str):
+    '''
+        yields (month period, source files, dataset) for every month of the era5 download in {get_from}: either a single legacy data.nc, 
+        or the era5_YYYY_MM_{variables}.nc files of data_downloader.plan_era5_requests, merged per month.
+        datasets are lazy, nothing is read until the caller loads (part of) a month.
+    '''
+    if os.path.exists(f'{get_from}data.nc'):
+        with xr.open_dataset(f'{get_from}data.nc') as data:
+            for period, month in _time_chunks(data, 'M'): yield period, [f'{get_from}data.nc'], month
+        return
+
+    months = {}
+    for path in sorted(glob.glob(f'{get_from}era5_*.nc')):
+        months.setdefault(tuple(os.path.basename(path).split('_')[1:3]), []).append(path)
+    for year, month in sorted(months):
+        parts = [xr.open_dataset(path) for path in months[year, month]]
+        try: yield pd.Period(f'{year}-{month}', 'M'), months[year, month], xr.merge(parts)
+        finally:
+            for part in parts: part.close()
+
+def preprocess_era5_data(variables: Union[str, list], transform=None, interpolate=1.25, get_from='./', save_to='./', verbose:bool=False, chunk='M', export_csv=False, 
+        start_date:datetime=None, end_date:datetime=None, incremental=False, region=None) -> bool:
+    '''
+        loads data from {get_from}data.nc (or the per-month files download_era5_data saves there), 
+        interpolates at 1.25 degrees by default, (interpolate may also be a data_regridder.Regridder, e.g. a conservative one)
         converts temp to celsius, 
         and saves dataframe as
-        long | lat | time | [variable | s...]
+        time | latitude | longitude | [variable | s...]
+        to the parquet store in {save_to}store/, partitioned by year and month (see data_store).
+        export_csv additionally writes the whole store to {save_to}data.csv.
 
         variables can include: 't2m'
 
         transform if not nonetype (str or list thereof) will transform variable name/s to something else.
 
         averages daily data to a single value at 00:00
+
+        data is walked month by month, and within a month {chunk} (pandas offset alias, 'M' by default, 'D' for single days) 
+        at a time; each chunk is loaded, regridded, averaged and written before the next is read, 
+        so peak memory depends on the chunk and not on the date range.
+
+        start_date and end_date (inclusive, whole days) crop the downloaded data, e.g. the full cached months of a download view.
+
+        {save_to}state.json records, per month partition, the fingerprints (size, mtime) of the source files and the days covered,
+        along with the parameters used. if incremental, months whose sources are unchanged and whose partition already covers 
+        the requested days are skipped, and only new or changed months are (re)written. otherwise every month of the range
+        is rewritten, while the months of other ranges are kept. the whole store is only rebuilt when the parameters changed.
+
+        region (a data_spatial.Region) restricts everything to its boxes: only the source values around them are read,
+        they are regridded onto the region's grid points alone, and cells outside of every box are not written.
     '''
     # for some reason era5 downloads to a variable with a different name than the one they ask for.
+    if isinstance(variables, str): variables = [variables]
+    if isinstance(transform, str): transform = [transform]
+    if isinstance(transform, list):
+        assert len(transform) == len(variables), 'incorrect transform list passed into era5 preprocessing'
 
-    # load netCDF file
-    data = xr.open_dataset(f'{get_from}data.nc')
-    if verbose: print(data, 'ERA5 data opened for preprocessing.')
-
-    # handle missing values
-    df = data.to_dataframe()
-    for var in variables:
-        df.loc[10,var] = np.nan
-        missing = df.shape[0] - df[var].count()
-        if verbose: print(f'{missing} missing values found in {var} of {get_from}data.nc.')
-        if missing:
-            df[var].fillna(method='bfill', inplace=True)  # you can choose your appropriate method to handle NaNs
-            if verbose: print(f'\tMissing values in {var} replaced using backward fill')
-
-    if verbose:
-        print(df.index.unique())
-        print("Number of unique timestamps: ", len(df.index.unique()))
-        print("Total number of entries: ", len(df))
-
-    if interpolate:
-        # Create a new coordinate grid
-        new_lon = np.arange(0, 360, interpolate)
-        new_lat = np.arange(-90, 90, interpolate)
-
-        # Interpolate the data to the new grid
-        data_interp = data.interp(longitude=new_lon, latitude=new_lat, method='linear')
-
-        # Convert to dataframe
-        df = data_interp.to_dataframe()
-    else:
-        df = data.to_dataframe()
-    
-    # preprocess standard variables
-    for v in variables:
-        if v in df:
-            if v == 't2m': # convert kelvin to celsius
-                df[v] = df[v] - 273.15
-            else: print(f'variable {v} lacking preprocessing in {get_from}data.nc')
-        else: assert False, f'expected variable {v} not found in {get_from}data.nc'
+    return _preprocess_months('era5', _era5_months(get_from), variables, transform, interpolate, get_from, save_to, verbose, chunk, 
+        export_csv, start_date, end_date, incremental, region=region)
 
-    # Reset the index to make Lat, Lon, and Time columns
-    df = df.reset_index()
+# variables our sources give in kelvin, converted to celsius during preprocessing
+KELVIN_VARIABLES = ('t2m', 'ta')
 
-    # Count number of rows with NaN values
-    nan_rows = df.isnull().any(axis=1).sum()
-    if verbose: print(f"Dropping {nan_rows} rows due to NaN values.")
-    # Drop rows with NaN values
-    df = df.dropna(how='any')
+def _preprocess_months(label: str, months, variables: list, transform, interpolate, get_from: str, save_to: str, verbose: bool, chunk, 
+        export_csv: bool, start_date, end_date, incremental: bool, params:dict=None, region=None) -> bool:
+    '''
+        the month-by-month preprocessing shared by the gridded sources. months yields (month period, source files, lazy dataset),
+        see preprocess_era5_data for what happens to each of them and how {save_to}state.json makes reruns incremental.
+        params are extra preprocessing parameters that invalidate the store when they change. see preprocess_era5_data for region.
+    '''
+    first = naive_timestamp(start_date).floor('D') if start_date else None
+    last = naive_timestamp(end_date).floor('D') + np.timedelta64(1, 'D') - np.timedelta64(1, 'ns') if end_date else None
 
-    # Print dataframe before resampling
-    if verbose: print("\nDataframe before resampling:\n", df.head())
+    # weights onto the new grid are computed once (or loaded from disk) and reused for every chunk
+    regridder = as_regridder(interpolate, region)
 
-    # Average to daily values
-    df.set_index('time', inplace=True)
-    df.index = df.index.to_period('D')  # Convert the timestamp to daily period
-    df = df.groupby(['latitude', 'longitude', df.index]).mean() 
+    store, state_path = f'{save_to}store/', f'{save_to}state.json'
+    params = dict(params or {}, variables=variables, transform=transform, regrid=str(regridder) if regridder else None,
+        region=region.key if region is not None else None)
+    # the store is shared by every date range: only a change of parameters invalidates the months of other ranges
+    state = load_state(state_path)
+    if state.get('params') != params:
+        if state and verbose: print(f'preprocessing parameters changed, rebuilding {store}')
+        clear_store(store)
+        state = {'params': params, 'partitions': {}}
 
-    # Reset the index for 'time' to be timestamp again
-    df.reset_index(inplace=True)
-    df['time'] = df['time'].dt.to_timestamp()
+    # netCDF files are opened lazily, values are only read per chunk
+    written = skipped = 0
+    for period, files, month in months:
+        for v in variables: assert v in month, f'expected variable {v} not found in {get_from}'
+        month = month[variables].sel(time=slice(first, last))
+        if not month.sizes['time']: continue
+        if region is not None: month = region.subset(month, pad=regridder.resolution if regridder else 0)
 
-    # Print dataframe after resampling
-    if verbose: print("\nDataframe after resampling:\n", df.head())
+        days = [str(month['time'].values[0])[:10], str(month['time'].values[-1])[:10]]
+        entry = {'files': fingerprint(files), 'days': days}
+        done = state['partitions'].get(str(period))
+        if incremental and done and done['files'] == entry['files'] and done['days'][0] <= days[0] and done['days'][1] >= days[1]:
+            skipped += 1
+            continue
 
-    # Transform variable names
-    if isinstance(transform, str): transform = [transform]
-    if isinstance(transform, list):
-        assert len(transform) == len(variables), 'incorrect transform list passed into era5 preprocessing'
-        for original, new in zip(variables, transform):
-            df.rename(columns={original: new}, inplace=True)
+        clear_partition(store, period.year, period.month)
+        for n, (sub, part) in enumerate(_time_chunks(month, chunk)):
+            with span('preprocess.load', source=label, period=str(sub)) as s:
+                part = part.load()
+                s.add(cells=int(np.prod([part.sizes[d] for d in part.dims])), bytes=int(part.nbytes))
+            if verbose: print(f'preprocessing {sub} ({part.sizes["time"]} timestamps)')
 
-    # Save dataframe as csv
-    df.to_csv(f'{save_to}data.csv', index=False)
+            # report missing values
+            for var in variables:
+                missing = int(part[var].isnull().sum())
+                if verbose: print(f'{missing} missing values found in {var} of {get_from}.')
 
-    if verbose: print(f"preprocessed era5 data with columns {', '.join(df.columns)}\n{data}")
+            # Interpolate the data to the new grid
+            if regridder:
+                with span('preprocess.regrid', source=label, period=str(sub)): part = regridder(part)
+
+            # preprocess standard variables
+            for v in variables:
+                if v in KELVIN_VARIABLES: # convert kelvin to celsius
+                    part[v] = part[v] - 273.15
+                else: print(f'variable {v} lacking preprocessing in {get_from}')
+
+            # Average to daily values on the grid itself
+            with span('preprocess.daily_mean', source=label, period=str(sub)) as s:
+                daily = _daily_mean(part, variables)
+                if region is not None: # cells of the enclosing box that are in none of the boxes
+                    daily = daily.where(xr.DataArray(region.contains(daily['latitude'].values, daily['longitude'].values), dims=('latitude', 'longitude')))
+                s.add(cell_days=int(np.prod([daily.sizes[d] for d in daily.dims])))
+            if verbose: print(f"{int(daily[variables[0]].isnull().sum())} cell-days without valid values will be dropped.")
+
+            # Only now flatten to time | latitude | longitude | [variable | s...]
+            with span('preprocess.to_frame', source=label, period=str(sub)) as s:
+                df = _to_frame(daily)
+                s.add(rows=len(df))
+
+            # Transform variable names
+            if isinstance(transform, list):
+                df.rename(columns=dict(zip(variables, transform)), inplace=True)
+
+            # Write the chunk into its month's partition
+            with span('preprocess.write', source=label, period=str(sub)) as s:
+                write_partition(df, store, name=f'part-{n:03d}')
+                s.add(rows=len(df))
+            del df, daily, part
+
+        # only record the month once all of it is written, so an interrupted run redoes it
+        state['partitions'][str(period)] = entry
+        save_state(state_path, state)
+        written += 1
+
+    assert written or state['partitions'], f'no {label} data found in {get_from}'
+    if verbose: print(f'preprocessed {written} {label} month(s) into {store}, {skipped} unchanged month(s) skipped')
+    if export_csv: store_to_csv(store, f'{save_to}data.csv')
     return True
 
 ################### GCM
 
-def preprocess_gcm_data(variable:str, interpolate=1.25, get_from='./', save_to='./', verbose:bool=False) -> bool:
-    return True
+from functools import partial
+
+def _gcm_select(data, variables: list, level=None):
+    '''
+        trims a single GCM file to {variables} as it is opened, so the other fields are never part of the virtual dataset.
+        variables on pressure levels (ta, hur, ua...) are reduced to {level} (Pa, nearest), by default the one nearest the surface.
+    '''
+    data = data[variables]
+    if 'lev' in data.dims:
+        data = data.isel(lev=int(data['lev'].argmax())) if level is None else data.sel(lev=level, method='nearest')
+    return data
+
+def _gcm_months(get_from: str, variables: list, level=None):
+    '''
+        yields (month period, source files, dataset) for every month of the atm_{scenario}_YYYY_MM.nc4 files in {get_from}.
+        all files are opened at once as one lazy (dask backed) dataset, trimmed to {variables} per file, 
+        so a month's values are only read when the caller loads it and never more than the chunks it spans.
+    '''
+    paths = sorted(glob.glob(f'{get_from}atm_*.nc4'))
+    if not paths: return
+    files = {}
+    for path in paths:
+        files.setdefault(tuple(os.path.basename(path)[:-len('.nc4')].split('_')[-2:]), []).append(path)
+
+    with xr.open_mfdataset(paths, combine='by_coords', preprocess=partial(_gcm_select, variables=variables, level=level),
+            data_vars='minimal', coords='minimal', compat='override', parallel=True) as data:
+        data = data.sortby('time')
+        for period, month in _time_chunks(data, 'M'):
+            yield period, files.get((f'{period.year:04d}', f'{period.month:02d}'), []), month
+
+def preprocess_gcm_data(variables: Union[str, list], transform=None, interpolate=1.25, get_from='./', save_to='./', verbose:bool=False, chunk='M', 
+        export_csv=False, start_date:datetime=None, end_date:datetime=None, incremental=False, level=None, region=None) -> bool:
+    '''
+        loads the monthly GCM output in {get_from} (atm_hist_YYYY_MM.nc4 / atm_ssp245_YYYY_MM.nc4 as download_gcm_data saves it)
+        as one lazy multi-file dataset, reading only {variables} and the months between start_date and end_date.
+        pressure level variables are taken at {level} (Pa), by default the level nearest the surface.
+
+        variables can include: 'ta' (air temperature, converted to celsius), 'tos', 'psl', 'ps', 'hur', 'ua', 'va', 'zg'
+
+        everything else works like preprocess_era5_data: months are regridded, averaged to days and written chunk by chunk 
+        to the parquet store in {save_to}store/, incremental skips months whose files did not change, and region
+        restricts the values read and regridded to its boxes (the scidb files themselves are only served whole).
+    '''
+    if isinstance(variables, str): variables = [variables]
+    if isinstance(transform, str): transform = [transform]
+    if isinstance(transform, list):
+        assert len(transform) == len(variables), 'incorrect transform list passed into gcm preprocessing'
+
+    return _preprocess_months('gcm', _gcm_months(get_from, variables, level), variables, transform, interpolate, get_from, save_to, verbose, chunk, 
+        export_csv, start_date, end_date, incremental, params={'level': level}, region=region)
 
 ################### GSOD
 
-def preprocess_gsod_data(variable:str, interpolate=1.25, get_from='./', save_to='./', verbose:bool=False) -> bool:
+import io
+import tarfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from data_spatial import grid_cell
+
+# values GSOD uses for "missing" per column, and conversions to the units of our other sources
+GSOD_MISSING = {'TEMP': 9999.9, 'DEWP': 9999.9, 'SLP': 9999.9, 'STP': 9999.9, 'MAX': 9999.9, 'MIN': 9999.9,
+    'VISIB': 999.9, 'WDSP': 999.9, 'MXSPD': 999.9, 'GUST': 999.9, 'SNDP': 999.9, 'PRCP': 99.99}
+GSOD_UNITS = {
+    'TEMP': lambda f: (f - 32) * (5 / 9), 'DEWP': lambda f: (f - 32) * (5 / 9), # fahrenheit -> celsius
+    'MAX': lambda f: (f - 32) * (5 / 9), 'MIN': lambda f: (f - 32) * (5 / 9),
+    'PRCP': lambda inches: inches * 0.0254 # inches -> metres, like ERA5's tp
+}
+
+def _read_gsod_archive(path: str, variables: list) -> pd.DataFrame:
+    '''
+        parses every station csv of a yearly GSOD tarball into one frame without extracting anything to disk:
+        members are streamed out of the archive, their headers dropped (but the first), and the bytes parsed by a single read_csv
+        with fixed dtypes instead of one read_csv per station.
+    '''
+    blobs, header = [], None
+    with tarfile.open(path, mode='r|gz') as archive: # stream mode, members are read in order without seeking
+        for member in archive:
+            if not member.isfile() or not member.name.endswith('.csv'): continue
+            data = archive.extractfile(member).read()
+            if not data: continue
+            first, _, body = data.partition(b'\n')
+            if header is None: header = first
+            blobs.append(body if body.endswith(b'\n') else body + b'\n')
+    if header is None: return pd.DataFrame(columns=['STATION', 'DATE', 'LATITUDE', 'LONGITUDE'] + variables)
+
+    dtypes = {'STATION': str, 'LATITUDE': np.float64, 'LONGITUDE': np.float64, **{v: np.float64 for v in variables}}
+    return pd.read_csv(io.BytesIO(header + b'\n' + b''.join(blobs)), usecols=list(dtypes) + ['DATE'], dtype=dtypes, parse_dates=['DATE'])
+
+def _ingest_gsod_year(path: str, variables: list, transform: list, interpolation: float, save_to: str, first, last, region=None,
+        index=None) -> tuple:
+    '''
+        process pool worker: ingests one yearly archive into the station store ({save_to}stations/) and, averaged per grid cell,
+        into the gridded store ({save_to}store/). returns (station rows, cell-days) written.
+        rows without a location are placed where the data_spatial.StationIndex {index} has their station, if it knows it.
+    '''
+    with span('preprocess.read_gsod', archive=os.path.basename(path)) as s:
+        df = _read_gsod_archive(path, variables)
+        s.add(rows=len(df))
+    if first is not None: df = df[df['DATE'] >= first]
+    if last is not None: df = df[df['DATE'] <= last]
+
+    # missing values and units, a column at a time (assigned, as df may be a filtered slice of the archive)
+    converted = {}
+    for v in variables:
+        values = df[v].to_numpy()
+        if v in GSOD_MISSING: values = np.where(values == GSOD_MISSING[v], np.nan, values)
+        if v in GSOD_UNITS: values = GSOD_UNITS[v](values)
+        converted[v] = values
+    df = df.assign(**converted)
+
+    df = df.rename(columns={'DATE': 'time', 'STATION': 'station', 'LATITUDE': 'station_latitude', 'LONGITUDE': 'station_longitude'})
+    lost = np.flatnonzero((df['station_latitude'].isna() | df['station_longitude'].isna()).to_numpy())
+    if index is not None and len(lost):
+        pos = index.positions(df['station'].to_numpy()[lost])
+        lost, pos = lost[pos >= 0], pos[pos >= 0]
+        lats, lons = df['station_latitude'].to_numpy(copy=True), df['station_longitude'].to_numpy(copy=True)
+        lats[lost], lons[lost] = index.lats[pos], index.lons[pos]
+        df = df.assign(station_latitude=lats, station_longitude=lons)
+    df = df.dropna(subset=['station_latitude', 'station_longitude'])
+    names = dict(zip(variables, transform)) if transform else {}
+    stations = df.rename(columns=names)
+
+    # cell means: every station contributes to the grid point nearest to it
+    ilat, ilon = grid_cell(df['station_latitude'], df['station_longitude'], interpolation)
+    if region is not None: # only the stations whose cell is in the region
+        inside = region.mask(interpolation)[ilat, ilon]
+        df, stations, ilat, ilon = df[inside], stations[inside], ilat[inside], ilon[inside]
+    df = df.assign(latitude=ilat * interpolation - 90, longitude=ilon * interpolation)
+    gridded = df.groupby(['time', 'latitude', 'longitude'], sort=True)[variables].mean().reset_index()
+    gridded = gridded.dropna(how='all', subset=variables).rename(columns=names) # cell-days no station reported anything for
+
+    with span('preprocess.write', source='gsod', archive=os.path.basename(path)) as s:
+        if len(stations): write_partition(stations, f'{save_to}stations/', name='gsod')
+        if len(gridded): write_partition(gridded, f'{save_to}store/', name='gsod')
+        s.add(rows=len(stations) + len(gridded))
+    return len(stations), len(gridded)
+
+def preprocess_gsod_data(variables: Union[str, list], transform=None, interpolate=1.25, get_from='./', save_to='./', verbose:bool=False,
+        start_date:datetime=None, end_date:datetime=None, incremental=False, processes:int=None, region=None) -> bool:
+    '''
+        ingests the yearly gsod_YYYY.tar.gz archives in {get_from}, one archive per process of a pool of {processes} (all cores by default,
+        but one when called from a worker process, e.g. of WorkingData.run whose LIMITS already bound the cores in use),
+        converting GSOD's missing-value sentinels to NaN and temperatures to celsius (see GSOD_MISSING, GSOD_UNITS).
+        saves every station-day as time | station | station_latitude | station_longitude | [variable | s...] to {save_to}stations/
+        and their means per grid cell (at {interpolate} degrees) as time | latitude | longitude | [variable | s...] to {save_to}store/,
+        both partitioned by year and month.
+
+        variables are GSOD columns, e.g. 'TEMP', 'PRCP'. transform renames them like for era5.
+        start_date and end_date (inclusive) crop the data. incremental skips archives that did not change since they were ingested,
+        otherwise the years of the range are reingested (those of other ranges are kept unless the parameters changed).
+        region (a data_spatial.Region) keeps only the stations whose grid cell is inside it.
+        stations are binned by their coordinates; rows the archives give no coordinates for are placed from {get_from}isd-history.csv
+        through its data_spatial.StationIndex (built once and cached, see StationIndex.from_isd_history) instead of being dropped.
+    '''
+    if isinstance(variables, str): variables = [variables]
+    if isinstance(transform, str): transform = [transform]
+    if isinstance(transform, list):
+        assert len(transform) == len(variables), 'incorrect transform list passed into gsod preprocessing'
+    interpolate = getattr(interpolate, 'resolution', interpolate) # stations are not regridded, only binned
+
+    first = naive_timestamp(start_date).floor('D') if start_date else None
+    last = naive_timestamp(end_date).floor('D') if end_date else None
+
+    state_path = f'{save_to}state.json'
+    params = {'variables': variables, 'transform': transform, 'interpolate': interpolate, 'region': region.key if region is not None else None}
+    state = load_state(state_path)
+    if state.get('params') != params:
+        clear_store(f'{save_to}store/')
+        clear_store(f'{save_to}stations/')
+        state = {'params': params, 'partitions': {}}
+
+    archives = {}
+    for path in sorted(glob.glob(f'{get_from}gsod_*.tar.gz')):
+        year = int(os.path.basename(path)[5:9])
+        if first is not None and year < first.year or last is not None and year > last.year: continue
+        days = [str(max(first, pd.Timestamp(year, 1, 1)).date()) if first is not None else f'{year}-01-01',
+                str(min(last, pd.Timestamp(year, 12, 31)).date()) if last is not None else f'{year}-12-31']
+        entry = {'files': fingerprint([path]), 'days': days}
+        done = state['partitions'].get(str(year))
+        if incremental and done and done['files'] == entry['files'] and done['days'][0] <= days[0] and done['days'][1] >= days[1]: continue
+        for month in range(1, 13):
+            clear_partition(f'{save_to}store/', year, month)
+            clear_partition(f'{save_to}stations/', year, month)
+        archives[year] = (path, entry)
+    if verbose: print(f'ingesting {len(archives)} GSOD archive(s) from {get_from}')
+    index = None
+    if archives and os.path.exists(f'{get_from}isd-history.csv'):
+        from data_spatial import StationIndex
+        index = StationIndex.from_isd_history(f'{get_from}isd-history.csv', interpolate)
+
+    if processes is None and multiprocessing.parent_process() is not None: processes = 1 # never a pool of pools
+    with ThreadPoolExecutor(1) if processes == 1 else ProcessPoolExecutor(processes) as pool: # one: in this process, in order
+        futures = {year: pool.submit(_ingest_gsod_year, path, variables, transform, interpolate, save_to, first, last, region, index) 
+            for year, (path, _) in archives.items()}
+        for year, future in futures.items():
+            rows, cells = future.result()
+            state['partitions'][str(year)] = archives[year][1]
+            save_state(state_path, state)
+            if verbose: print(f'GSOD {year}: {rows} station-days, {cells} cell-days')
+
+    assert state['partitions'], f'no gsod archives found in {get_from}'
     return True
 
 ############## GENERAL
@@ -0,0 +1,184 @@
+############## GENERAL
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from data_cube import Cube, grid
+from data_store import list_partitions, read_partition, read_store, fingerprint, load_state, save_state, naive_timestamp
+
+# an aggregation pyramid holds, for every variable and grid cell, the sum, count, min and max of the daily values of each
+# month, year and decade, saved as {root}pyramid/{level}/{block}.npz. these combine exactly (sums and counts add up,
+# min of mins, max of maxes), so any range of whole months is answered from a handful of small grids instead of the daily data.
+
+LEVELS = ('month', 'year', 'decade')
+STATS = ('mean', 'min', 'max', 'count')
+
+def _block(level: str, year: int, month:int=None) -> str:
+    return {'month': f'{year:04d}-{month:02d}', 'year': f'{year:04d}', 'decade': f'{year - year % 10:04d}s'}[level]
+
+def _save(path: str, block: dict):
+    if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **block)
+    os.replace(tmp, path) # never leave a half-written block behind
+
+def _load(path: str) -> dict:
+    with np.load(path) as f: return {k: f[k] for k in f.files}
+
+def _aggregate(cube: Cube) -> dict:
+    'month block of a cube: {variable}_sum/_count/_min/_max grids over its days'
+    block = {}
+    for v, a in cube.variables.items():
+        valid = ~np.isnan(a)
+        block[f'{v}_count'] = valid.sum(axis=0, dtype=np.int32)
+        block[f'{v}_sum'] = np.where(valid, a, 0).sum(axis=0, dtype=np.float64)
+        block[f'{v}_min'] = np.where(valid, a, np.inf).min(axis=0).astype(np.float32)
+        block[f'{v}_max'] = np.where(valid, a, -np.inf).max(axis=0).astype(np.float32)
+    return block
+
+def _combine(blocks: list) -> dict:
+    'one block out of several of the same variables and grid'
+    combined = dict(blocks[0])
+    for block in blocks[1:]:
+        for k, a in block.items():
+            if k.endswith('_min'): combined[k] = np.minimum(combined[k], a)
+            elif k.endswith('_max'): combined[k] = np.maximum(combined[k], a)
+            else: combined[k] = combined[k] + a
+    return combined
+
+def build_pyramid(get_from: str, variables: list, interpolation=1.25, incremental=True, verbose=False) -> bool:
+    '''
+    builds the aggregation pyramid of the preprocessed store in {get_from}store/ into {get_from}pyramid/,
+    meant to run right after preprocessing.
+
+    {get_from}pyramid/state.json records the fingerprint of every month partition aggregated,
+    so if incremental only changed months are re-aggregated, along with the years and decades they belong to.
+    blocks of months that are no longer in the store are deleted (and their years and decades recombined),
+    and a rebuild (not incremental, or other parameters) starts from an empty pyramid.
+    '''
+    root, state_path = f'{get_from}pyramid/', f'{get_from}pyramid/state.json'
+    params = {'variables': list(variables), 'interpolation': interpolation}
+    state = load_state(state_path) if incremental else {}
+    if state.get('params') != params:
+        for level in LEVELS: shutil.rmtree(f'{root}{level}/', ignore_errors=True)
+        state = {'params': params, 'months': {}}
+
+    changed = set()
+    partitions = list_partitions(f'{get_from}store/')
+    current = {_block('month', year, month) for year, month, _ in partitions}
+    for key in [k for k in state['months'] if k not in current]: # partitions gone from the store
+        del state['months'][key]
+        if os.path.exists(f'{root}month/{key}.npz'): os.remove(f'{root}month/{key}.npz')
+        changed.add(int(key[:4]))
+    for year, month, paths in partitions:
+        key, entry = _block('month', year, month), fingerprint(paths)
+        if state['months'].get(key) == entry and os.path.exists(f'{root}month/{key}.npz'): continue
+        df = read_partition(f'{get_from}store/', year, month, ['time', 'latitude', 'longitude'] + list(variables))
+        days = pd.date_range(pd.Timestamp(year, month, 1), periods=pd.Timestamp(year, month, 1).days_in_month, freq='D')
+        _save(f'{root}month/{key}.npz', _aggregate(Cube.from_frame(df, variables, interpolation, days)))
+        state['months'][key] = entry
+        changed.add(year)
+        if verbose: print(f'aggregated {key}')
+
+    # years from their months, then decades from their years
+    months = {}
+    for year, month, _ in partitions: months.setdefault(year, []).append(month)
+    for year, present in months.items():
+        if year in changed or not os.path.exists(f"{root}year/{_block('year', year)}.npz"):
+            _save(f"{root}year/{_block('year', year)}.npz", _combine([_load(f"{root}month/{_block('month', year, m)}.npz") for m in present]))
+            changed.add(year)
+    decades = {}
+    for year in months: decades.setdefault(year - year % 10, []).append(year)
+    for decade, years in decades.items():
+        if changed & set(years) or not os.path.exists(f"{root}decade/{_block('decade', decade)}.npz"):
+            _save(f"{root}decade/{_block('decade', decade)}.npz", _combine([_load(f"{root}year/{_block('year', y)}.npz") for y in years]))
+
+    # blocks without a single month left in the store
+    expected = {'month': current, 'year': {_block('year', y) for y in months}, 'decade': {_block('decade', d) for d in decades}}
+    for level in LEVELS:
+        for name in (os.listdir(f'{root}{level}/') if os.path.isdir(f'{root}{level}/') else []):
+            if name.endswith('.npz') and name[:-len('.npz')] not in expected[level]: os.remove(f'{root}{level}/{name}')
+    save_state(state_path, state)
+    if verbose: print(f'pyramid of {len(partitions)} month(s) in {root}, {len(changed)} year(s) updated')
+    return bool(partitions)
+
+def _cover(start: pd.Period, end: pd.Period) -> list:
+    '''
+    the fewest aligned blocks (level, year, month) covering the months start to end: whole decades, then whole years, then months.
+    '''
+    blocks, month = [], start
+    while month <= end:
+        if month.month == 1 and month.year % 10 == 0 and pd.Period(f'{month.year + 9}-12', 'M') <= end:
+            blocks.append(('decade', month.year, None))
+            month = pd.Period(f'{month.year + 10}-01', 'M')
+        elif month.month == 1 and pd.Period(f'{month.year}-12', 'M') <= end:
+            blocks.append(('year', month.year, None))
+            month = pd.Period(f'{month.year + 1}-01', 'M')
+        else:
+            blocks.append(('month', month.year, month.month))
+            month += 1
+    return blocks
+
+def _query(get_from: str, variable: str, start_date: datetime, end_date: datetime) -> tuple:
+    'the grid and the combined block of {variable} over the months from start_date to end_date (None if no block has data)'
+    root = f'{get_from}pyramid/'
+    interpolation = load_state(f'{root}state.json')['params']['interpolation']
+    start, end = naive_timestamp(start_date).to_period('M'), naive_timestamp(end_date).to_period('M')
+    paths = [f'{root}{level}/{_block(level, year, month)}.npz' for level, year, month in _cover(start, end)]
+    blocks = []
+    for path in paths:
+        if not os.path.exists(path): continue # no data in that block
+        with np.load(path) as f: blocks.append({k: f[k] for k in f.files if k.startswith(f'{variable}_')})
+    latitude, longitude = grid(interpolation)
+    return latitude, longitude, _combine(blocks) if blocks else None
+
+def query_pyramid(get_from: str, variable: str, start_date: datetime, end_date: datetime, stat='mean') -> tuple:
+    '''
+    the {stat} ('mean', 'min', 'max' or 'count') of the daily values of {variable} per grid cell over the months from start_date
+    to end_date (whole months, inclusive), combined from the fewest precomputed blocks of {get_from}pyramid/.
+    returns (latitudes, longitudes, grid shaped latitude x longitude), NaN where no day had a value.
+    '''
+    assert stat in STATS, f'unknown statistic {stat}'
+    latitude, longitude, block = _query(get_from, variable, start_date, end_date)
+    if block is None: return latitude, longitude, np.full((len(latitude), len(longitude)), np.nan)
+
+    count = block[f'{variable}_count']
+    if stat == 'count': return latitude, longitude, count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = block[f'{variable}_sum'] / count if stat == 'mean' else block[f'{variable}_{stat}'].astype(np.float64)
+    values[count == 0] = np.nan
+    return latitude, longitude, values
+
+def query_days(get_from: str, variable: str, start_date: datetime, end_date: datetime) -> tuple:
+    '''
+    the mean of the daily values of {variable} per grid cell over the days from start_date to end_date (inclusive):
+    the whole months in between from the pyramid, the days of partial months at either end from the store,
+    so the result is the same as averaging the daily data itself. returns (latitudes, longitudes, grid) like query_pyramid.
+    '''
+    first, last = naive_timestamp(start_date).floor('D'), naive_timestamp(end_date).floor('D')
+    whole = [m for m in pd.period_range(first.to_period('M'), last.to_period('M'), freq='M')
+        if m.start_time >= first and m.end_time.floor('D') <= last]
+    partial = [(first, last)] if not whole else [(a, b) for a, b in ((first, whole[0].start_time - pd.Timedelta(days=1)),
+        (whole[-1].end_time.floor('D') + pd.Timedelta(days=1), last)) if a <= b]
+
+    interpolation = load_state(f'{get_from}pyramid/state.json')['params']['interpolation']
+    latitude, longitude = grid(interpolation)
+    sums, counts = np.zeros((len(latitude), len(longitude))), np.zeros((len(latitude), len(longitude)), dtype=np.int64)
+    if whole:
+        # every block read once, its exact sums and counts added as they are
+        _, _, block = _query(get_from, variable, whole[0].start_time, whole[-1].start_time)
+        if block is not None:
+            sums += block[f'{variable}_sum']
+            counts += block[f'{variable}_count']
+    for a, b in partial:
+        df = read_store(f'{get_from}store/', ['latitude', 'longitude', variable], a, b + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns'))
+        df = df[df[variable].notna()]
+        ilat = np.clip(np.rint((df['latitude'].to_numpy(np.float64) + 90) / interpolation).astype(np.int64), 0, len(latitude) - 1)
+        ilon = np.rint((df['longitude'].to_numpy(np.float64) % 360) / interpolation).astype(np.int64) % len(longitude)
+        np.add.at(sums, (ilat, ilon), df[variable].to_numpy(np.float64))
+        np.add.at(counts, (ilat, ilon), 1)
+    with np.errstate(invalid='ignore', divide='ignore'): values = sums / counts
+    values[counts == 0] = np.nan
+    return latitude, longitude, values
@@ -0,0 +1,190 @@
+############## GENERAL
+
+import os
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+from typing import Union
+
+# names the sources use for their horizontal coordinates, ERA5 first, then GCM/NCEP.
+LAT_NAMES = ('latitude', 'lat')
+LON_NAMES = ('longitude', 'lon')
+
+def _linear_weights(src: np.ndarray, dst: np.ndarray):
+    '''
+    1d linear interpolation weights from src to dst coordinates as a sparse (dst x src) matrix, along with a mask of
+    the dst points inside the range of src. src may be ascending or descending (ERA5 latitudes run 90 -> -90).
+    '''
+    order = np.argsort(src)
+    s = src[order]
+    i = np.clip(np.searchsorted(s, dst, side='right') - 1, 0, len(s) - 2)
+    w = (dst - s[i]) / (s[i + 1] - s[i])
+    valid = (dst >= s[0]) & (dst <= s[-1])
+    rows = np.flatnonzero(valid)
+    W = sp.csr_matrix((np.r_[1 - w[rows], w[rows]], (np.r_[rows, rows], np.r_[order[i[rows]], order[i[rows] + 1]])),
+        shape=(len(dst), len(src)))
+    W.eliminate_zeros()
+    return W, valid
+
+def _unwrap(src: np.ndarray, dst: np.ndarray) -> tuple:
+    '''
+    source and target longitudes in 0 -> 360 (so -180 -> 180 sources match our grid), shifted onto one continuous range
+    that starts after the widest gap of the source. a source that crosses longitude 0 (e.g. 350 -> 30 as a region is cut out
+    of it) then runs 350 -> 390 instead of being split at 0. global sources are left as they are.
+    '''
+    src, dst = np.asarray(src, dtype=np.float64) % 360, np.asarray(dst, dtype=np.float64) % 360
+    if len(src) < 2: return src, dst
+    s = np.sort(src)
+    gaps = np.diff(s)
+    if s[0] + 360 - s[-1] >= gaps.max(): return src, dst # the widest gap is across 360 already
+    origin = s[np.argmax(gaps) + 1]
+    return (src - origin) % 360 + origin, (dst - origin) % 360 + origin
+
+def _bounds(centers: np.ndarray, lo=None, hi=None) -> np.ndarray:
+    'cell edges halfway between sorted centers, extended by half a cell at either end and clipped to [lo, hi]'
+    mids = (centers[1:] + centers[:-1]) / 2
+    edges = np.r_[centers[0] - (centers[1] - centers[0]) / 2, mids, centers[-1] + (centers[-1] - centers[-2]) / 2]
+    return np.clip(edges, lo, hi) if lo is not None else edges
+
+def _overlap_weights(src: np.ndarray, dst: np.ndarray, dst_width: float, kind: str):
+    '''
+    1d area-conservative weights: the share of each dst cell covered by each src cell, as a sparse (dst x src) matrix.
+    kind 'lat' measures overlaps in sin(latitude) so that weights are proportional to area on the sphere,
+    kind 'lon' measures them in degrees and wraps around at 360.
+    '''
+    order = np.argsort(src)
+    s = src[order]
+    if kind == 'lat':
+        se = np.sin(np.deg2rad(_bounds(s, -90, 90)))
+        de = np.sin(np.deg2rad(np.clip(np.c_[dst - dst_width / 2, dst + dst_width / 2], -90, 90)))
+        shifts = (0,)
+    else:
+        se = _bounds(s)
+        de = np.c_[dst - dst_width / 2, dst + dst_width / 2]
+        shifts = (-360, 0, 360)
+    overlap = np.zeros((len(dst), len(src)))
+    for shift in shifts:
+        overlap += np.clip(np.minimum(de[:, 1:2], se[None, 1:] + shift) - np.maximum(de[:, 0:1], se[None, :-1] + shift), 0, None)
+    total = overlap.sum(axis=1)
+    valid = total > 0
+    overlap[valid] /= total[valid, None]
+    W = sp.csr_matrix(overlap)[:, np.argsort(order)]
+    return W, valid
+
+class Regridder:
+    '''
+    Regrids data on any regular (lat, lon) source grid onto a fixed target grid as a single sparse matrix multiply.
+
+    The target grid defaults to the one used throughout this repo: latitude -90 -> 90-resolution, longitude 0 -> 360-resolution.
+    method is either 'linear' (bilinear, same values as xarray's interp(method='linear')) or 'conservative' (area-weighted).
+
+    Source longitudes may be in -180 -> 180 or 0 -> 360, and may cross longitude 0 (see _unwrap).
+
+    Weights are computed once per source grid, kept in memory, and cached on disk in {cache_dir} keyed by
+    (source grid, target grid, method), so ERA5 (0.25), GCM and NCEP inputs all only pay for them on the very first run.
+    '''
+    METHODS = ('linear', 'conservative')
+
+    def __init__(self, resolution=1.25, method='linear', lat=None, lon=None, cache_dir='./cache/regrid/'):
+        assert method in self.METHODS, f'Invalid regridding method: {method}'
+        self.resolution = resolution
+        self.method = method
+        self.lat = np.asarray(lat if lat is not None else np.arange(-90, 90, resolution), dtype=np.float64)
+        self.lon = np.asarray(lon if lon is not None else np.arange(0, 360, resolution), dtype=np.float64)
+        self.cache_dir = cache_dir
+        self._weights = {}
+
+    def __str__(self) -> str:
+        return f'Regridder {self.method} to {len(self.lat)}x{len(self.lon)} ({self.resolution} degrees)'
+
+    def _key(self, src_lat: np.ndarray, src_lon: np.ndarray) -> str:
+        h = hashlib.sha1(f'{self.method}|{self.resolution}'.encode()) # the resolution is the cell width of conservative weights
+        for a in (src_lat, src_lon, self.lat, self.lon): h.update(np.ascontiguousarray(a, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def weights(self, src_lat, src_lon):
+        '''
+        returns (W, valid): the sparse (target cells x source cells) weight matrix for a source grid,
+        and a mask of the target cells that the source grid covers. loads from or saves to the disk cache as needed.
+        '''
+        src_lat = np.asarray(src_lat, dtype=np.float64)
+        src_lon = np.asarray(src_lon, dtype=np.float64)
+        key = self._key(src_lat, src_lon)
+        if key in self._weights: return self._weights[key]
+
+        path = f'{self.cache_dir}{self.method}_{key}.npz'
+        if os.path.exists(path):
+            W = sp.load_npz(path).tocsr()
+            valid = np.load(path.replace('.npz', '_valid.npy'))
+        else:
+            src, dst = _unwrap(src_lon, self.lon)
+            if self.method == 'linear':
+                Wlat, vlat = _linear_weights(src_lat, self.lat)
+                Wlon, vlon = _linear_weights(src, dst)
+            else:
+                Wlat, vlat = _overlap_weights(src_lat, self.lat, self.resolution, 'lat')
+                Wlon, vlon = _overlap_weights(src, dst, self.resolution, 'lon')
+            # grids are separable, so the 2d weights are the kronecker product of the 1d ones (row-major lat, lon)
+            W = sp.kron(Wlat, Wlon, format='csr')
+            valid = np.outer(vlat, vlon).ravel()
+            if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir)
+            sp.save_npz(path, W)
+            np.save(path.replace('.npz', '_valid.npy'), valid)
+        self._weights[key] = W, valid
+        return W, valid
+
+    def regrid(self, values: np.ndarray, src_lat, src_lon) -> np.ndarray:
+        '''
+        regrids an array whose last two axes are (src_lat, src_lon), every leading index (time slice, variable...) at once.
+        target cells outside of the source grid are NaN. with the conservative method NaN source cells are left out
+        and the remaining weights are renormalized.
+        '''
+        W, valid = self.weights(src_lat, src_lon)
+        lead = values.shape[:-2]
+        X = np.asarray(values, dtype=np.float64).reshape(-1, values.shape[-2] * values.shape[-1])
+        missing = np.isnan(X)
+        if self.method == 'conservative' and missing.any():
+            out = (W @ np.where(missing, 0., X).T).T
+            with np.errstate(invalid='ignore', divide='ignore'): out /= (W @ (~missing).T.astype(np.float64)).T
+        else: out = (W @ X.T).T
+        out[:, ~valid] = np.nan
+        return out.reshape(lead + (len(self.lat), len(self.lon)))
+
+    def __call__(self, data: Union[xr.Dataset, xr.DataArray]) -> Union[xr.Dataset, xr.DataArray]:
+        '''
+        regrids every variable of data that has both a latitude and longitude dimension, stacking them into one matrix multiply.
+        returns the same kind of object on dims latitude/longitude, other variables and coordinates are dropped.
+        '''
+        if isinstance(data, xr.DataArray): return self(data.to_dataset(name=data.name or 'data'))[data.name or 'data']
+        lat = next(n for n in LAT_NAMES if n in data.dims)
+        lon = next(n for n in LON_NAMES if n in data.dims)
+        names = [v for v in data.data_vars if lat in data[v].dims and lon in data[v].dims]
+        arrays = [data[v].transpose(..., lat, lon) for v in names]
+        stacked = np.concatenate([a.values.reshape(-1, data.sizes[lat], data.sizes[lon]) for a in arrays])
+        out = self.regrid(stacked, data[lat].values, data[lon].values)
+
+        regridded, offset = {}, 0
+        for v, a in zip(names, arrays):
+            n = int(np.prod(a.shape[:-2]))
+            regridded[v] = (a.dims[:-2] + ('latitude', 'longitude'), out[offset:offset + n].reshape(a.shape[:-2] + out.shape[-2:]))
+            offset += n
+        coords = {d: data[d] for d in arrays[0].dims[:-2] if d in data.coords} if arrays else {}
+        coords.update(latitude=self.lat, longitude=self.lon)
+        return xr.Dataset(regridded, coords=coords, attrs=data.attrs)
+
+_SHARED = {}
+
+def as_regridder(interpolate, region=None) -> Union[Regridder, None]:
+    '''
+    interprets the interpolate argument of the preprocessing functions:
+    a Regridder is used as-is, a resolution in degrees gets a process-wide shared linear Regridder, and falsy means no regridding.
+    with a data_spatial.Region the shared Regridder only targets the grid points of the region (see Region.grid).
+    '''
+    if not interpolate: return None
+    if isinstance(interpolate, Regridder): return interpolate
+    key = (interpolate, region.key if region is not None else None)
+    if key not in _SHARED:
+        lat, lon = region.grid(interpolate) if region is not None else (None, None)
+        _SHARED[key] = Regridder(interpolate, lat=lat, lon=lon)
+    return _SHARED[key]
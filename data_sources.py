@@ -0,0 +1,155 @@
+############## GENERAL
+
+from datetime import datetime, timezone
+from bidict import bidict
+
+# the sources WeatherData can work with, registered by number. every source only imports its backend (xarray, cdsapi,
+# requests...) inside its methods, so importing this module, WeatherData or the cli costs next to nothing,
+# and a WeatherData of one source never loads the dependencies of another.
+# a new source is a subclass of Source decorated with @register, here or in any module imported before it is used.
+
+REGISTRY = {} # number -> Source
+
+def register(cls):
+    'class decorator adding a Source to the registry'
+    source = cls()
+    assert source.number not in REGISTRY, f'source number {source.number} is registered twice'
+    REGISTRY[source.number] = source
+    return cls
+
+def get_source(source) -> 'Source':
+    'the registered Source of a number, name or label'
+    if source in REGISTRY: return REGISTRY[source]
+    for e in REGISTRY.values():
+        if source in (e.name, e.label): return e
+    assert False, f'Invalid source: {source}'
+
+class Source:
+    '''
+    A data source: what it is called, which of our data types it has (and what the server and its files call them),
+    its default dates, and how to download, preprocess and validate it for a WeatherData.
+    '''
+    number = None
+    name = None # full name
+    label = None # short name, e.g. for merged columns
+    types = {} # our shorthand -> (name the download server expects, name in the downloaded files)
+    defaults = [] # our shorthands used when data_types='default', i'm in chronological order!
+    dates = (None, None) # default start and end dates
+    variants = None # bidict of variant name -> number for sources that need one (e.g. GCM scenarios)
+    download_marker = None # file name whose presence in a download folder means it is downloaded (None: always download)
+
+    def describe(self, variant=None) -> str:
+        return self.name
+
+    def label_of(self, variant=None) -> str:
+        return self.label
+
+    def path_of(self, variant=None) -> str:
+        'folder of this source (and variant) under ./downloads/ and ./preprocessed/'
+        return f'{self.number}'
+
+    def download(self, data, force: bool) -> bool:
+        raise NotImplementedError
+
+    def preprocess(self, data, interpolate, export_csv: bool, incremental: bool) -> bool:
+        raise NotImplementedError
+
+    def validate(self, data, verbose: bool):
+        raise NotImplementedError
+
+####################### ERA5
+
+@register
+class ERA5(Source):
+    'ERA5 ([read more here](https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation))'
+    number, name, label = 1, 'ERA5', 'ERA5'
+    types = {
+        'tmp': ('2m_temperature', 't2m'), # temperatures are only considered at surface-level for our purposes.
+        'percip': ('total_precipitation', 'tp'),
+    }
+    defaults = ['tmp', 'percip']
+    dates = (datetime(1940, 1, 1, tzinfo=timezone.utc),
+        datetime(2023, 6, 30, tzinfo=timezone.utc)) # data after 2015 will be used for confirming the quality of the trained model
+    download_marker = 'data.nc'
+
+    def download(self, data, force: bool) -> bool:
+        # ERA5 goes through the shared DownloadCache in ./downloads/cache/
+        from data_downloader import download_era5_data
+        from data_manifest import DownloadCache
+        return download_era5_data(data._downloadingtypenames, data.start_date, data.end_date, data._downloadat,
+            verbose=data.verbose, cache=DownloadCache.shared(), refresh=force, region=data.region)
+
+    def preprocess(self, data, interpolate, export_csv: bool, incremental: bool) -> bool:
+        from data_preprocessor import preprocess_era5_data
+        return preprocess_era5_data(data._downloadedtypenames, data.data_types, interpolate, data._downloadat, data._preprocessat, data.verbose,
+            export_csv=export_csv, start_date=data.start_date, end_date=data.end_date, incremental=incremental, region=data.region)
+
+    def validate(self, data, verbose: bool):
+        from data_validation import validate_preprocessed_era5
+        return validate_preprocessed_era5(data.data_types, verbose, data.start_date, data.end_date, 1.25, data._preprocessat, data.region)
+
+################### GCM
+
+@register
+class GCM(Source):
+    'IPCC Global Climate Model (GCM) Output ([read more here](https://ipcc-data.org/sim/gcm_monthly/))'
+    number, name, label = 2, 'IPCC Global Climate Model (GCM) Output', 'GCM'
+    types = {
+        'tmp': ('ta', 'ta'), # the GCM has no 2m field, air temperature at its lowest pressure level is the nearest
+    } # the GCM output holds no precipitation
+    defaults = ['tmp']
+    dates = (datetime(1979, 1, 1, tzinfo=timezone.utc), datetime(2100, 1, 1, 23, tzinfo=timezone.utc))
+    variants = bidict({
+        'SSP245': 1,
+        'SSP585': 2
+    })
+
+    def describe(self, variant=None) -> str:
+        return f'GCM ({self.variants.inverse[variant]})'
+
+    def label_of(self, variant=None) -> str:
+        return f'GCM-{self.variants.inverse[variant]}'
+
+    def path_of(self, variant=None) -> str:
+        return f'{self.number}/{self.variants.inverse[variant]}' # scenarios apart
+
+    def download(self, data, force: bool) -> bool:
+        # scidb only serves whole files, a region is cut out of them when preprocessing
+        from data_downloader import download_gcm_data
+        return download_gcm_data(data._downloadingtypenames, data.gcm_type, data.start_date, data.end_date, data._downloadat)
+
+    def preprocess(self, data, interpolate, export_csv: bool, incremental: bool) -> bool:
+        from data_preprocessor import preprocess_gcm_data
+        return preprocess_gcm_data(data._downloadedtypenames, data.data_types, interpolate, data._downloadat, data._preprocessat, data.verbose,
+            export_csv=export_csv, start_date=data.start_date, end_date=data.end_date, incremental=incremental, region=data.region)
+
+    def validate(self, data, verbose: bool):
+        from data_validation import validate_preprocessed_gcm
+        return validate_preprocessed_gcm(data.data_types, verbose, data.start_date, data.end_date, 1.25, data._preprocessat, data.region)
+
+################### GSOD
+
+@register
+class GSOD(Source):
+    'Global Surface Summary of the Day - GSOD ([read more here](https://www.ncei.noaa.gov/access/metadata/landing-page/bin/iso?id=gov.noaa.ncdc:C00516))'
+    number, name, label = 3, 'Global Surface Summary of the Day - GSOD', 'GSOD'
+    types = {
+        'tmp': ('TEMP', 'TEMP'), # mean daily temperature column of the per-station csvs
+        'percip': ('PRCP', 'PRCP'),
+    }
+    defaults = ['tmp', 'percip']
+    dates = (datetime(1979, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 1, 23, tzinfo=timezone.utc)) # GSOD records actually begin in 1929.
+    # like GSOD, data continues to present, but we have decided to train model on data until 2015-01-01 00:00.
+
+    def download(self, data, force: bool) -> bool:
+        from data_downloader import download_gsod_data
+        return download_gsod_data(data._downloadingtypenames, data.start_date, data.end_date, data._downloadat, verbose=data.verbose)
+
+    def preprocess(self, data, interpolate, export_csv: bool, incremental: bool) -> bool:
+        from data_preprocessor import preprocess_gsod_data
+        return preprocess_gsod_data(data._downloadedtypenames, data.data_types, interpolate, data._downloadat, data._preprocessat, data.verbose,
+            start_date=data.start_date, end_date=data.end_date, incremental=incremental, region=data.region)
+
+    def validate(self, data, verbose: bool):
+        from data_validation import validate_preprocessed_gsod
+        return validate_preprocessed_gsod(data.data_types, verbose, data.start_date, data.end_date, 1.25, data._preprocessat, data.region)
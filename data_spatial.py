@@ -0,0 +1,230 @@
+############## GENERAL
+
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from typing import Union
+
+EARTH_RADIUS_KM = 6371.0088
+
+def _xyz(lats, lons) -> np.ndarray:
+    'unit vectors on the sphere, chord distances between them grow monotonically with great-circle distance'
+    lat, lon = np.deg2rad(np.asarray(lats, dtype=np.float64)), np.deg2rad(np.asarray(lons, dtype=np.float64))
+    return np.c_[np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+
+def _chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+def _km_to_chord(km):
+    return 2 * np.sin(np.asarray(km) / (2 * EARTH_RADIUS_KM))
+
+def grid_cell(lats, lons, interpolation=1.25):
+    '''
+    (latitude index, longitude index) of the nearest point of our grid (latitude -90 -> 90-interpolation,
+    longitude 0 -> 360-interpolation) for every lat/lon, by arithmetic alone. the north pole folds into the last row.
+    '''
+    nlat, nlon = int(round(180 / interpolation)), int(round(360 / interpolation))
+    ilat = np.clip(np.rint((np.asarray(lats, dtype=np.float64) + 90) / interpolation), 0, nlat - 1).astype(np.int64)
+    ilon = np.rint((np.asarray(lons, dtype=np.float64) % 360) / interpolation).astype(np.int64) % nlon
+    return ilat, ilon
+
+class StationIndex:
+    '''
+    Spatial index of irregular stations (e.g. the ~10k of GSOD) for matching them to our grid and to each other.
+
+    Holds a KD-tree over the stations' unit vectors (so distances are great-circle, also across the antimeridian),
+    and a lookup table of each station's grid cell along with the stations of each cell.
+    Every query takes arrays, answering for all points at once.
+
+    Build it with from_isd_history, which caches the built index on disk until the station list or grid changes.
+    '''
+    VERSION = 2 # of the pickled layout, indexes cached by other versions are rebuilt
+
+    def __init__(self, ids, lats, lons, interpolation=1.25):
+        self.ids = np.asarray(ids).astype(str)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64) % 360
+        self.interpolation = interpolation
+        self.tree = cKDTree(_xyz(self.lats, self.lons))
+        self._sorted = np.argsort(self.ids, kind='stable') # ids are looked up by binary search
+
+        # cell lookup table: station -> cell, and cell -> stations as a sorted order plus offsets
+        self.ilat, self.ilon = grid_cell(self.lats, self.lons, interpolation)
+        self.nlat, self.nlon = int(round(180 / interpolation)), int(round(360 / interpolation))
+        self.cells = self.ilat * self.nlon + self.ilon
+        self._by_cell = np.argsort(self.cells, kind='stable')
+        self._offsets = np.searchsorted(self.cells[self._by_cell], np.arange(self.nlat * self.nlon + 1))
+        self._grid_tree = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __str__(self) -> str:
+        return f'StationIndex of {len(self)} stations on a {self.interpolation} degree grid'
+
+    @classmethod
+    def from_isd_history(cls, path: str, interpolation=1.25, cache_dir='./cache/stations/') -> 'StationIndex':
+        '''
+        builds the index from NOAA's isd-history.csv (station id = USAF + WBAN, as GSOD names its files),
+        or loads it from {cache_dir} if it was built from the same file and grid before.
+        '''
+        stat = os.stat(path)
+        key = hashlib.sha1(f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{interpolation}|{cls.VERSION}'.encode()).hexdigest()
+        cached = f'{cache_dir}{key}.pkl'
+        if os.path.exists(cached):
+            with open(cached, 'rb') as f: return pickle.load(f)
+
+        history = pd.read_csv(path, dtype={'USAF': str, 'WBAN': str}, usecols=['USAF', 'WBAN', 'LAT', 'LON'])
+        history = history.dropna(subset=['LAT', 'LON'])
+        history = history[(history['LAT'] != 0) | (history['LON'] != 0)] # 0, 0 marks unknown locations
+        history = history.drop_duplicates(subset=['USAF', 'WBAN'], keep='last')
+        index = cls((history['USAF'] + history['WBAN']).to_numpy(), history['LAT'].to_numpy(), history['LON'].to_numpy(), interpolation)
+
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+        with open(cached, 'wb') as f: pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return index
+
+    def positions(self, ids) -> np.ndarray:
+        'positions of station ids in this index, -1 for unknown stations'
+        ids = np.asarray(ids).astype(str)
+        if not len(self.ids): return np.full(len(ids), -1, dtype=np.int64)
+        pos = self._sorted[np.clip(np.searchsorted(self.ids[self._sorted], ids), 0, len(self.ids) - 1)]
+        return np.where(self.ids[pos] == ids, pos, -1).astype(np.int64)
+
+    def cell_of(self, ids) -> tuple:
+        '(latitude, longitude) of the grid cell of each station id, NaN for unknown stations'
+        pos = self.positions(ids)
+        known = pos >= 0
+        lat, lon = np.full(len(pos), np.nan), np.full(len(pos), np.nan)
+        lat[known] = self.ilat[pos[known]] * self.interpolation - 90
+        lon[known] = self.ilon[pos[known]] * self.interpolation
+        return lat, lon
+
+    def stations_in_cell(self, ilat: int, ilon: int) -> np.ndarray:
+        'ids of the stations whose nearest grid point is (ilat, ilon)'
+        cell = ilat * self.nlon + ilon
+        return self.ids[self._by_cell[self._offsets[cell]:self._offsets[cell + 1]]]
+
+    def knn(self, lats, lons, k=1) -> tuple:
+        '''
+        the k nearest stations of every point: (distances in km, station positions), both shaped (points, k).
+        positions index self.ids, self.lats, ...
+        '''
+        chord, pos = self.tree.query(_xyz(lats, lons), k=k)
+        chord, pos = np.asarray(chord).reshape(-1, k), np.asarray(pos).reshape(-1, k)
+        return _chord_to_km(chord), pos
+
+    def radius(self, lats, lons, km: float) -> list:
+        'positions of the stations within {km} of every point, one array per point'
+        return [np.asarray(p, dtype=np.int64) for p in self.tree.query_ball_point(_xyz(lats, lons), _km_to_chord(km))]
+
+    def nearest_cells(self, k=4) -> tuple:
+        '''
+        the k nearest grid points of every station: (distances in km, latitude indices, longitude indices), each shaped (stations, k).
+        useful to compare a station against the cells around it rather than just its own.
+        '''
+        if self._grid_tree is None:
+            lat, lon = np.meshgrid(np.arange(self.nlat) * self.interpolation - 90, np.arange(self.nlon) * self.interpolation, indexing='ij')
+            self._grid_tree = cKDTree(_xyz(lat.ravel(), lon.ravel()))
+        chord, cells = self._grid_tree.query(_xyz(self.lats, self.lons), k=k)
+        chord, cells = np.asarray(chord).reshape(-1, k), np.asarray(cells).reshape(-1, k)
+        return _chord_to_km(chord), cells // self.nlon, cells % self.nlon
+
+############## REGIONS
+
+class Region:
+    '''
+    One or more (south, west, north, east) boxes in degrees to restrict a WeatherData to, from the download to validation.
+    longitudes may be given in -180 -> 180 or 0 -> 360, a box whose west is east of its east wraps around longitude 0/360.
+
+    the stages work on the enclosing box of all boxes (one cds area, one regridding target), and cells outside every box
+    are only dropped when the daily values are written, so a few distant boxes cost about as much as the box around them.
+    key names the region in paths and cache keys, so data of different regions never mixes.
+    '''
+    def __init__(self, boxes):
+        if isinstance(boxes, Region): boxes = boxes.boxes
+        if len(boxes) == 4 and all(isinstance(e, (int, float)) for e in boxes): boxes = [boxes]
+        self.boxes = []
+        for south, west, north, east in boxes:
+            assert -90 <= south < north <= 90, f'Invalid region latitudes {south} -> {north}'
+            width = min(east - west if east > west else east - west + 360, 360)
+            assert width > 0, f'Invalid region longitudes {west} -> {east}'
+            self.boxes.append((float(south), float(west % 360), float(north), float(width)))
+        assert self.boxes, 'a region needs at least one box'
+        self.key = 'region-' + hashlib.sha1(repr(sorted(self.boxes)).encode()).hexdigest()[:10]
+
+    def __str__(self) -> str:
+        return 'region ' + '; '.join(f'{s}..{n}N {w}..{(w + width) % 360 if width < 360 else w + width}E' for s, w, n, width in self.boxes)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Region) and self.key == other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def enclosing(self) -> tuple:
+        '(south, west, north, width) of the smallest box holding every box, west in 0 -> 360 and the width eastwards from it'
+        south, north = min(b[0] for b in self.boxes), max(b[2] for b in self.boxes)
+        # the smallest arc starts at the west of some box
+        west, width = min(((w, max((b[1] - w) % 360 + b[3] for b in self.boxes)) for _, w, _, _ in self.boxes), key=lambda e: e[1])
+        return south, west, north, min(width, 360)
+
+    def area(self, pad=0.) -> list:
+        'the enclosing box grown by {pad} degrees as a cds area: [north, west, south, east], west in -180 -> 180'
+        south, west, north, width = self.enclosing()
+        if width + 2 * pad >= 360: return [min(north + pad, 90), -180, max(south - pad, -90), 180]
+        west = (west - pad + 180) % 360 - 180
+        return [min(north + pad, 90), west, max(south - pad, -90), west + width + 2 * pad]
+
+    def _lon_offsets(self, lons, pad=0.) -> np.ndarray:
+        'how far east of the (padded) west of the enclosing box every longitude is, NaN where it is outside of the box'
+        _, west, _, width = self.enclosing()
+        offsets = (np.asarray(lons, dtype=np.float64) - (west - pad)) % 360
+        return np.where((width + 2 * pad >= 360) | (offsets <= width + 2 * pad + 1e-9), offsets, np.nan)
+
+    def grid(self, interpolation=1.25) -> tuple:
+        '''
+        (latitudes, longitudes) of the points of our grid in the enclosing box, the regridding target of a region.
+        longitudes run eastwards from the west of the box, so they are not sorted when it wraps around 0/360.
+        '''
+        south, _, north, _ = self.enclosing()
+        lat = np.arange(-90, 90, interpolation)
+        lon = np.arange(0, 360, interpolation)
+        offsets = self._lon_offsets(lon)
+        lon = lon[np.isfinite(offsets)][np.argsort(offsets[np.isfinite(offsets)], kind='stable')]
+        return lat[(lat >= south - 1e-9) & (lat <= north + 1e-9)], lon
+
+    def contains(self, lats, lons) -> np.ndarray:
+        'boolean (latitudes x longitudes) mask of the points inside any box'
+        lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+        inside = np.zeros((len(lats), len(lons)), dtype=bool)
+        for south, west, north, width in self.boxes:
+            inside |= np.outer((lats >= south - 1e-9) & (lats <= north + 1e-9), ((lons - west) % 360 <= width + 1e-9) | (width >= 360))
+        return inside
+
+    def mask(self, interpolation=1.25) -> np.ndarray:
+        'boolean (latitude x longitude) mask of the cells of our whole grid inside the region'
+        return self.contains(np.arange(-90, 90, interpolation), np.arange(0, 360, interpolation))
+
+    def subset(self, data, pad=0.):
+        '''
+        the part of a (lazy) xarray dataset in the enclosing box grown by {pad} degrees plus one cell of its own grid,
+        so regridding the region's edge cells still has neighbours. nothing is read, the selection stays lazy.
+        longitudes come out in 0 -> 360 like our grid's, whichever convention the source uses (cds answers a west below 0
+        with -180 -> 180 longitudes).
+        '''
+        lat = next(n for n in ('latitude', 'lat') if n in data.dims)
+        lon = next(n for n in ('longitude', 'lon') if n in data.dims)
+        lats, lons = data[lat].values, data[lon].values
+        # the spacing of the source grid, modulo 360 so that the jump of a source that wraps (e.g. 359.75 -> 0) is not taken for one
+        step = max(np.median(np.abs(np.diff(lats))) if len(lats) > 1 else 0, np.median(np.diff(lons) % 360) if len(lons) > 1 else 0)
+        south, _, north, _ = self.enclosing()
+        ilat = np.flatnonzero((lats >= south - pad - step) & (lats <= north + pad + step))
+        offsets = self._lon_offsets(lons, pad + step)
+        ilon = np.flatnonzero(np.isfinite(offsets))
+        ilon = ilon[np.argsort(offsets[ilon], kind='stable')]
+        data = data.isel({lat: ilat, lon: ilon})
+        return data.assign_coords({lon: data[lon] % 360})
@@ -0,0 +1,129 @@
+############## GENERAL
+
+import os
+import json
+import glob
+import shutil
+import pandas as pd
+from datetime import datetime
+from typing import Union
+
+# preprocessed data lives in a store directory partitioned as {root}year=YYYY/month=MM/part*.parquet,
+# typed, compressed parquet files (usually one per month). readers only open the partitions (and columns) they need.
+
+def naive_timestamp(date) -> Union[pd.Timestamp, None]:
+    'our datetimes are utc-aware while stored times are naive utc, this makes them comparable'
+    if date is None: return None
+    date = pd.Timestamp(date)
+    return date.tz_convert('UTC').tz_localize(None) if date.tzinfo else date
+
+def partition_path(root: str, year: int, month: int) -> str:
+    return f'{root}year={year:04d}/month={month:02d}/'
+
+def clear_store(root: str):
+    'removes every partition of the store at {root}'
+    if os.path.exists(root): shutil.rmtree(root)
+
+def clear_partition(root: str, year: int, month: int):
+    'removes one year/month partition of the store at {root}'
+    if os.path.exists(partition_path(root, year, month)): shutil.rmtree(partition_path(root, year, month))
+
+def write_partition(df: pd.DataFrame, root: str, name='part', compression='snappy') -> list:
+    '''
+    writes a long-format frame (with a 'time' column) into the store at {root} as {name}.parquet in every year/month it spans.
+    a file of the same name is replaced, other files in the partition are kept (so a month can be written in several chunks).
+    returns the paths written.
+    '''
+    written = []
+    times = pd.DatetimeIndex(df['time'])
+    for (year, month), part in df.groupby([times.year, times.month], sort=True):
+        path = partition_path(root, year, month)
+        if not os.path.exists(path): os.makedirs(path)
+        part.to_parquet(f'{path}{name}.parquet', index=False, compression=compression)
+        written.append(f'{path}{name}.parquet')
+    return written
+
+def fingerprint(paths: list) -> dict:
+    'cheap identity of source files: name -> [size, mtime in ns]'
+    return {os.path.basename(p): [os.path.getsize(p), os.stat(p).st_mtime_ns] for p in sorted(paths)}
+
+def load_state(path: str) -> dict:
+    return json.load(open(path)) if os.path.exists(path) else {}
+
+def save_state(path: str, state: dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f: json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, path) # never leave a half-written state behind
+
+def list_partitions(root: str, start_date:datetime=None, end_date:datetime=None) -> list:
+    '''
+    returns sorted (year, month, [paths]) of the partitions in {root} that may hold data between start_date and end_date (inclusive),
+    so that readers can skip the rest without opening them.
+    '''
+    start, end = naive_timestamp(start_date), naive_timestamp(end_date)
+    partitions = []
+    if not os.path.exists(root): return partitions
+    for ydir in sorted(os.listdir(root)):
+        if not ydir.startswith('year='): continue
+        year = int(ydir[5:])
+        for mdir in sorted(os.listdir(f'{root}{ydir}')):
+            if not mdir.startswith('month='): continue
+            month = int(mdir[6:])
+            if start is not None and (year, month) < (start.year, start.month): continue
+            if end is not None and (year, month) > (end.year, end.month): continue
+            paths = sorted(glob.glob(f'{root}{ydir}/{mdir}/*.parquet'))
+            if paths: partitions.append((year, month, paths))
+    return partitions
+
+def _filters(start, end) -> Union[list, None]:
+    filters = []
+    if start is not None: filters.append(('time', '>=', start))
+    if end is not None: filters.append(('time', '<=', end))
+    return filters or None
+
+def iter_store(root: str, columns:list=None, start_date:datetime=None, end_date:datetime=None):
+    '''
+    yields (year, month, dataframe) partition by partition.
+    columns projects the read down to those columns (time is always read), and the date range is pushed down
+    both to partition pruning and to the parquet reader as a row filter.
+    '''
+    start, end = naive_timestamp(start_date), naive_timestamp(end_date)
+    if columns is not None and 'time' not in columns: columns = ['time'] + list(columns)
+    for year, month, paths in list_partitions(root, start, end):
+        parts = [pd.read_parquet(path, columns=columns, filters=_filters(start, end)) for path in paths]
+        yield year, month, parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+def read_partition(root: str, year: int, month: int, columns:list=None) -> Union[pd.DataFrame, None]:
+    'reads a single year/month partition of the store at {root}, None if it does not exist'
+    paths = sorted(glob.glob(f'{partition_path(root, year, month)}*.parquet'))
+    if not paths: return None
+    parts = [pd.read_parquet(path, columns=columns) for path in paths]
+    return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+def read_store(root: str, columns:list=None, start_date:datetime=None, end_date:datetime=None) -> pd.DataFrame:
+    'reads the store at {root} into a single dataframe, see iter_store for projection and date filtering'
+    parts = [df for _, _, df in iter_store(root, columns, start_date, end_date)]
+    if not parts: return pd.DataFrame(columns=columns if columns is None or 'time' in columns else ['time'] + list(columns))
+    return pd.concat(parts, ignore_index=True)
+
+def export_csv(root: str, save_to: str, columns:list=None, start_date:datetime=None, end_date:datetime=None) -> str:
+    'opt-in export of the store at {root} to a single csv at {save_to}, written one partition at a time'
+    header = True
+    for _, _, df in iter_store(root, columns, start_date, end_date):
+        df.to_csv(save_to, index=False, mode='w' if header else 'a', header=header)
+        header = False
+    return save_to
+
+def load_preprocessed(get_from: str, columns:list=None, start_date:datetime=None, end_date:datetime=None) -> pd.DataFrame:
+    '''
+    loads preprocessed data from the store in {get_from}store/,
+    or from a legacy {get_from}data.csv when no store exists (which has to be parsed in full).
+    '''
+    if os.path.exists(f'{get_from}store/'): return read_store(f'{get_from}store/', columns, start_date, end_date)
+
+    if columns is not None and 'time' not in columns: columns = ['time'] + list(columns)
+    df = pd.read_csv(f'{get_from}data.csv', usecols=columns, parse_dates=['time'])
+    start, end = naive_timestamp(start_date), naive_timestamp(end_date)
+    if start is not None: df = df[df['time'] >= start]
+    if end is not None: df = df[df['time'] <= end]
+    return df.reset_index(drop=True)
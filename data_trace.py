@@ -0,0 +1,157 @@
+############## GENERAL
+
+import os
+import json
+import time
+import resource
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+# structured timing of the pipeline. code wraps its stages in span(name, **fields), and every finished span becomes one
+# json line: wall and cpu time, peak and current RSS, bytes read and written, plus whatever counts the code added (rows, cells...).
+# spans nest (per thread and asyncio task) through their parent id. tracing is off, and span() nearly free, until configure()
+# or the DMINER_TRACE environment variable names a file to append to. process pool workers inherit that variable, so their
+# spans end up in the same file.
+
+_CONFIG = {
+    'path': os.environ.get('DMINER_TRACE') or None,
+    'profile': set(filter(None, os.environ.get('DMINER_PROFILE', '').split(','))),
+    'keep': False,
+}
+_CURRENT = contextvars.ContextVar('dminer_span', default=None)
+_IDS = itertools.count(1)
+_LOCK = threading.Lock()
+RECORDS = [] # finished spans of this process, if configure(keep=True)
+
+def configure(path:str=None, profile=None, keep=False):
+    '''
+    turns tracing on: spans are appended as json lines to {path} and/or kept in RECORDS if keep.
+    profile is a span name (or list thereof, '*' for every span) to run under cProfile, whose stats are dumped next to {path}
+    as {path}.{span}.{id}.prof for drill-down with pstats or snakeviz.
+    the settings are exported to the environment so that worker processes started afterwards trace too.
+    '''
+    _CONFIG['path'], _CONFIG['keep'] = path, keep
+    _CONFIG['profile'] = {profile} if isinstance(profile, str) else set(profile or ())
+    if path: os.environ['DMINER_TRACE'] = path
+    else: os.environ.pop('DMINER_TRACE', None)
+    if _CONFIG['profile']: os.environ['DMINER_PROFILE'] = ','.join(_CONFIG['profile'])
+    else: os.environ.pop('DMINER_PROFILE', None)
+
+def enabled() -> bool:
+    return bool(_CONFIG['path'] or _CONFIG['keep'])
+
+def _io() -> tuple:
+    '(bytes read, bytes written) by this process so far, from /proc (linux), None where unavailable'
+    try:
+        with open('/proc/self/io') as f: counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError): return None, None
+
+def _rss() -> tuple:
+    '(current RSS, high-water RSS) of this process in bytes, from /proc/self/status on linux or getrusage elsewhere'
+    try:
+        with open('/proc/self/status') as f: status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _reset_peak() -> bool:
+    'resets the high-water RSS so that the next reading is the peak since now (linux 4.0+), false if that is not possible'
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+        return True
+    except OSError: return False
+
+class Span:
+    '''
+    One timed region, handed out by span(). add(**counts) accumulates counts (rows=..., cells=...), set(**fields) records values.
+    '''
+    __slots__ = ('name', 'id', 'parent', 'fields', 'peak')
+    def __init__(self, name: str, parent, fields: dict):
+        self.name, self.parent, self.fields = name, parent, fields
+        self.id = f'{os.getpid()}-{next(_IDS)}'
+        self.peak = 0
+
+    def add(self, **counts):
+        for k, v in counts.items(): self.fields[k] = self.fields.get(k, 0) + v
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+class _Untraced:
+    'what span() hands out while tracing is off'
+    def add(self, **counts): pass
+    def set(self, **fields): pass
+
+_UNTRACED = _Untraced()
+
+def _emit(record: dict):
+    with _LOCK:
+        if _CONFIG['keep']: RECORDS.append(record)
+        if _CONFIG['path']:
+            with open(_CONFIG['path'], 'a') as f: f.write(json.dumps(record, default=str) + '\n')
+
+@contextmanager
+def span(name: str, **fields):
+    '''
+    times the enclosed block as span {name} with any extra {fields} (e.g. source='ERA5').
+    memory and io are measured for the whole process, so spans running concurrently in threads see each other's.
+    '''
+    if not enabled():
+        yield _UNTRACED
+        return
+    parent = _CURRENT.get()
+    current = Span(name, parent, dict(fields))
+    token = _CURRENT.set(current)
+    profiler = None
+    if name in _CONFIG['profile'] or '*' in _CONFIG['profile']:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    read, written = _io()
+    rss, _ = _rss()
+    resettable = _reset_peak()
+    began, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    error = None
+    if profiler: profiler.enable()
+    try: yield current
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if profiler: profiler.disable()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        read_after, written_after = _io()
+        rss_after, peak = _rss()
+        peak = max(peak, current.peak) # a nested span may have reset the high-water mark in between
+        if parent is not None: parent.peak = max(parent.peak, peak)
+        _CURRENT.reset(token)
+
+        record = {'span': name, 'id': current.id, 'parent': parent.id if parent else None, 'pid': os.getpid(), 'start': round(began, 6),
+            'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6), 'peak_rss_mb': round(peak / 2**20, 1), 'peak_is_process_max': not resettable,
+            'rss_start_mb': round(rss / 2**20, 1) if rss else None, 'rss_end_mb': round(rss_after / 2**20, 1) if rss_after else None,
+            'read_bytes': read_after - read if read is not None else None, 'written_bytes': written_after - written if written is not None else None}
+        record.update(current.fields)
+        if error: record['error'] = error
+        if profiler: profiler.dump_stats(f"{_CONFIG['path'] or './trace'}.{name}.{current.id}.prof")
+        _emit(record)
+
+def traced(name:str=None):
+    'decorator running every call of a function in a span named {name} (the function name by default)'
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__): return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def current() -> object:
+    'the innermost open span, to add counts to from deep inside a stage (a no-op object while tracing is off)'
+    return _CURRENT.get() if enabled() and _CURRENT.get() is not None else _UNTRACED
+
+def load_trace(path: str) -> list:
+    'reads a json lines trace back into a list of records'
+    with open(path) as f: return [json.loads(line) for line in f if line.strip()]
@@ -26,72 +26,194 @@ def check_lat_lon_range(df, verbose=True):
     if df['latitude'].min() < -90 or df['latitude'].max() > 90: print("Warning: Latitude out of range.")
     if df['longitude'].min() < 0 or df['longitude'].max() > 360: print("Warning: Longitude out of range.")
 
-############# ERA5
+##### grid validation engine
 
-import pandas as pd
+import os
 import numpy as np
+import pandas as pd
 from typing import Union
+from dataclasses import dataclass, field
+from data_store import iter_store, naive_timestamp
+from data_trace import current
+
+# plausible daily means, anything outside is counted as out of range. keyed by both downloaded and transformed names.
+VALUE_RANGES = {
+    't2m': (-95., 65.), 'tmp': (-95., 65.), # celsius
+    'tp': (0., 1.), 'percip': (0., 1.) # metres
+}
+
+@dataclass
+class ValidationReport:
+    '''
+    Outcome of validate_grid. Truthy only if no problem was found, so it can be used where a bool used to be returned.
+    problems holds a readable line per failed check, the other fields the numbers behind them.
+    '''
+    rows: int = 0
+    missing_columns: list = field(default_factory=list)
+    nans: dict = field(default_factory=dict) # variable -> count
+    out_of_range: dict = field(default_factory=dict) # variable -> count
+    value_ranges: dict = field(default_factory=dict) # variable -> [min, max]
+    off_grid: int = 0 # rows whose latitude/longitude is not on the expected grid
+    duplicates: int = 0 # cell-days with more than one row
+    incomplete_days: list = field(default_factory=list) # days present but lacking some grid cells
+    missing_dates: list = field(default_factory=list) # expected days without any row
+    problems: list = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return not self.problems
+
+    def __str__(self) -> str:
+        return 'validation passed' if self else 'validation failed:\n\t' + '\n\t'.join(self.problems)
+
+def _day_blocks(days: np.ndarray, max_days: int):
+    'splits row indices into blocks spanning at most {max_days} days, so per-block cell-day counts stay small'
+    block = (days - days.min()) // max_days
+    if block.max() == 0:
+        yield np.arange(len(days))
+        return
+    order = np.argsort(block, kind='stable')
+    bounds = np.flatnonzero(np.diff(block[order])) + 1
+    yield from np.split(order, bounds)
+
+def validate_grid(frames, variables: list, start_date:datetime, end_date:datetime, interpolation:float, ranges:dict=None, max_days=62, complete=True,
+        region=None, allow_nan=False) -> ValidationReport:
+    '''
+    validates long-format frames (time | latitude | longitude | [variable | s...]) chunk by chunk in a single vectorized pass each:
+    every row must sit on the latitude (-90 -> 90-interpolation) longitude (0 -> 360-interpolation) grid,
+    every day present must have exactly one row per grid cell, no variable may be NaN or outside its range (see VALUE_RANGES),
+    and every day from start_date to end_date must be present.
+
+    frames may be any iterable of dataframes, e.g. the partitions of data_store.iter_store, so memory only depends on one chunk.
+    complete=False accepts days that only cover part of the grid (station data).
+    allow_nan still counts NaN values in report.nans, but not as a problem (station data, where one variable is often missing).
+    with a data_spatial.Region the expected grid is only its cells: rows outside of it count as off the grid, and complete days
+    need every cell of the region alone.
+    '''
+    report = ValidationReport()
+    ranges = {**VALUE_RANGES, **(ranges or {})}
+    nlat, nlon = int(round(180 / interpolation)), int(round(360 / interpolation))
+    ncells = nlat * nlon
+    expected = region.mask(interpolation).ravel() if region is not None else np.ones(ncells, dtype=bool)
+    seen = []
+    for v in variables:
+        report.nans[v] = report.out_of_range[v] = 0
+        report.value_ranges[v] = [np.inf, -np.inf]
+
+    for df in frames:
+        if not len(df): continue
+        absent = [c for c in ['time', 'latitude', 'longitude'] + variables if c not in df.columns]
+        if absent:
+            report.missing_columns = sorted(set(report.missing_columns) | set(absent))
+            continue
+        report.rows += len(df)
+        current().add(rows=len(df))
+
+        # grid positions, rows that are not on a grid point are left out of the per-cell checks
+        lat = (df['latitude'].to_numpy(np.float64) + 90) / interpolation
+        lon = df['longitude'].to_numpy(np.float64) / interpolation
+        ilat, ilon = np.rint(lat).astype(np.int64), np.rint(lon).astype(np.int64)
+        on_grid = np.isclose(lat, ilat) & np.isclose(lon, ilon) & (ilat >= 0) & (ilat < nlat) & (ilon >= 0) & (ilon < nlon)
+        on_grid[on_grid] = expected[(ilat * nlon + ilon)[on_grid]]
+        report.off_grid += int((~on_grid).sum())
+
+        days = df['time'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        seen.append(np.unique(days))
+
+        # values
+        for v in variables:
+            values = df[v].to_numpy(np.float64)
+            nan = np.isnan(values)
+            report.nans[v] += int(nan.sum())
+            if (~nan).any():
+                lo, hi = values[~nan].min(), values[~nan].max()
+                report.value_ranges[v] = [min(report.value_ranges[v][0], lo), max(report.value_ranges[v][1], hi)]
+                if v in ranges: report.out_of_range[v] += int(((values[~nan] < ranges[v][0]) | (values[~nan] > ranges[v][1])).sum())
+
+        # one value per cell per day: count rows per (day, cell) with a bincount
+        cells, cdays = (ilat * nlon + ilon)[on_grid], days[on_grid]
+        if not len(cells): continue
+        for block in _day_blocks(cdays, max_days):
+            d0 = cdays[block].min()
+            ndays = int(cdays[block].max() - d0 + 1)
+            counts = np.bincount((cdays[block] - d0) * ncells + cells[block], minlength=ndays * ncells).reshape(ndays, ncells)
+            report.duplicates += int((counts > 1).sum())
+            if not complete: continue
+            present = counts.any(axis=1)
+            lacking = np.flatnonzero(present & (counts[:, expected] == 0).any(axis=1))
+            report.incomplete_days += [str(np.datetime64(int(d0 + d), 'D')) for d in lacking]
+
+    # date coverage
+    first, last = naive_timestamp(start_date), naive_timestamp(end_date)
+    expected = np.arange(np.datetime64(first.date(), 'D'), np.datetime64(last.date(), 'D') + 1).astype(np.int64)
+    seen = np.unique(np.concatenate(seen)) if seen else np.array([], dtype=np.int64)
+    report.missing_dates = [str(np.datetime64(int(d), 'D')) for d in np.setdiff1d(expected, seen)]
+
+    if report.missing_columns: report.problems.append(f"columns missing from the data: {', '.join(report.missing_columns)}")
+    for v in variables:
+        if report.nans[v] and not allow_nan: report.problems.append(f'{report.nans[v]} NA values in {v}')
+        if report.out_of_range[v]: report.problems.append(f'{report.out_of_range[v]} values of {v} outside {ranges[v]}')
+    if report.off_grid: report.problems.append(f'{report.off_grid} rows off the {interpolation} degree grid' + (f' of the {region}' if region is not None else ''))
+    if report.duplicates: report.problems.append(f'{report.duplicates} duplicate entries for the same day and location')
+    if report.incomplete_days: report.problems.append(f'{len(report.incomplete_days)} days lack some grid cells, first {report.incomplete_days[0]}')
+    if report.missing_dates: report.problems.append(f'{len(report.missing_dates)} dates missing from the data, first {report.missing_dates[0]}')
+    return report
+
+def _store_frames(root: str, columns: list, start_date: datetime, end_date: datetime, unreadable: list):
+    '''
+    the partitions of the store in {root} projected to {columns} (see data_store.iter_store), for validate_grid.
+    reading stops at a partition that lacks some of the columns (the parquet reader raises KeyError or ValueError),
+    whose error is appended to {unreadable} instead of being raised, see _unreadable.
+    '''
+    partitions = iter_store(root, columns, start_date, end_date)
+    while True:
+        try: _, _, df = next(partitions)
+        except StopIteration: return
+        except (KeyError, ValueError) as e:
+            unreadable.append(e)
+            return
+        yield df
+
+def _unreadable(report: ValidationReport, variables: list, unreadable: list) -> ValidationReport:
+    'fails {report} when _store_frames could not read every partition'
+    if unreadable:
+        report.missing_columns = sorted(set(report.missing_columns) | set(variables))
+        report.problems.append(f'columns of the data do not match the expected structure ({unreadable[0]})')
+    return report
+
+############# ERA5
 
 # it is worth noting that this ERA5 data will naturally produce many redundant values at 90 degrees and -90 degrees latitude.
 # I will not delete it because I'm not sure if that is ultimately desired behavior.
 
-def validate_preprocessed_era5(variables: Union[str, list], verbose:bool, start_date:datetime, end_date:datetime, interpolation:int, get_from='./') -> bool:
+def validate_preprocessed_era5(variables: Union[str, list], verbose:bool, start_date:datetime, end_date:datetime, interpolation:int, get_from='./',
+        region=None) -> ValidationReport:
     '''
-    loads data from {get_from}data.nc
+    validates the store in {get_from}store/ partition by partition (or a legacy {get_from}data.csv at once), 
+    reading only the expected columns between the dates. see validate_grid for the checks.
 
     validates that era5 data is in form time | latitude | longitude | [variable | s ...]
     as such variables is expected to be an str or list thereof
-    
-    if being verbose, will warn when any variable passed in is not of expected form (i.e. it will not be tested)
-    also warns if any number of NAs are found
 
-    ensures that all expected fields are in latitude (-90 -> 90) longitude (0 -> 360-interpolation) grid based on interpolation (degrees). 
+    ensures that all expected fields are in latitude (-90 -> 90) longitude (0 -> 360-interpolation) grid based on interpolation (degrees),
+    or only in the cells of {region} (a data_spatial.Region) if given.
 
     ensures that exactly one exists for each point + day; one value per day.
-    '''
-    # Load dataframe
-    df = pd.read_csv(f'{get_from}data.csv')
-
-    # Check columns
-    if isinstance(variables, list): expected_columns = ['time', 'latitude', 'longitude'] + variables
-    else: expected_columns = ['time', 'latitude', 'longitude', variables]
-
-    if not all(col in df.columns for col in expected_columns):
-        if verbose: print("Columns of the data do not match the expected structure.")
-        return False
 
-    # Check for NAs
-    if df.isna().sum().any():
-        if verbose: print("Data contains NA values.")
-        return False
-
-    # Create grid of expected latitudes and longitudes
-    expected_lats = np.arange(-90, 90, interpolation)
-    expected_lons = np.arange(0, 360, interpolation)
-    
-    # Check if all expected latitudes and longitudes are present
-    if not all(lat in df['latitude'].unique() for lat in expected_lats):
-        if verbose: print("Some latitudes are missing from the data.")
-        return False
-
-    if not all(lon in df['longitude'].unique() for lon in expected_lons):
-        if verbose: print("Some longitudes are missing from the data.")
-        return False
+    returns a ValidationReport, which is truthy when validation passed. if verbose its problems are printed.
+    '''
+    if isinstance(variables, str): variables = [variables]
+    columns = ['time', 'latitude', 'longitude'] + variables
 
-    # Check for duplicate entries for the same day + lat + lon
-    if df.duplicated(['time', 'latitude', 'longitude']).sum() > 0:
-        if verbose: print("Duplicate entries found for the same day and location.")
-        return False
+    unreadable = []
+    if os.path.exists(f'{get_from}store/'): frames = _store_frames(f'{get_from}store/', columns, start_date, end_date, unreadable)
+    else:
+        df = pd.read_csv(f'{get_from}data.csv', parse_dates=['time'])
+        frames = [df[(df['time'] >= naive_timestamp(start_date)) & (df['time'] <= naive_timestamp(end_date))]]
 
-    # Create expected dates
-    expected_dates = pd.date_range(start_date, end_date)
-    
-    # Check if all expected dates are present
-    if not all(date.strftime('%Y-%m-%d') in df['time'].unique() for date in expected_dates):
-        if verbose: print("Some dates are missing from the data.")
-        return False
+    report = _unreadable(validate_grid(frames, variables, start_date, end_date, interpolation, region=region), variables, unreadable)
 
-    return True
+    if verbose: print(report)
+    return report
 
 
 
@@ -99,13 +221,35 @@ def validate_preprocessed_era5(variables: Union[str, list], verbose:bool, start_
 
 ############# GSM
 
-def validate_preprocessed_gcm(variable, verbose:bool, start_date:datetime, end_date:datetime, interpolation:int, get_from='./') -> bool:
+def validate_preprocessed_gcm(variables: Union[str, list], verbose:bool, start_date:datetime, end_date:datetime, interpolation:int, get_from='./',
+        region=None) -> ValidationReport:
+    '''
+    validates the regridded daily GCM means in {get_from}store/ like era5 (see validate_grid), the GCM covers the whole grid 
+    (or {region}) every day.
+    '''
+    if isinstance(variables, str): variables = [variables]
+    unreadable = []
+    frames = _store_frames(f'{get_from}store/', ['time', 'latitude', 'longitude'] + variables, start_date, end_date, unreadable)
+    report = _unreadable(validate_grid(frames, variables, start_date, end_date, interpolation, region=region), variables, unreadable)
 
-    return True
+    if verbose: print(report)
+    return report
 
 
 ############# GSOD
 
-def validate_preprocessed_gsod(variable, verbose:bool, start_date:datetime, end_date:datetime, interpolation:int, get_from='./') -> bool:
-
-    return True
+def validate_preprocessed_gsod(variables: Union[str, list], verbose:bool, start_date:datetime, end_date:datetime, interpolation:int, get_from='./',
+        region=None) -> ValidationReport:
+    '''
+    validates the gridded station means in {get_from}store/ like era5 (see validate_grid), 
+    except that stations only cover part of the grid (or {region}), so days are not expected to be complete,
+    and a variable may be NaN in a cell-day where no station reported it (e.g. the 99.99 PRCP sentinel) while others were.
+    '''
+    if isinstance(variables, str): variables = [variables]
+    unreadable = []
+    frames = _store_frames(f'{get_from}store/', ['time', 'latitude', 'longitude'] + variables, start_date, end_date, unreadable)
+    report = _unreadable(validate_grid(frames, variables, start_date, end_date, interpolation, complete=False, region=region, allow_nan=True),
+        variables, unreadable)
+
+    if verbose: print(report)
+    return report
@@ -1,25 +1,34 @@
-from data_preprocessor import preprocess_era5_data, preprocess_gcm_data, preprocess_gsod_data
-from data_downloader import download_era5_data, download_gcm_data, download_gsod_data
-from data_validation import validate_preprocessed_era5, validate_preprocessed_gcm, validate_preprocessed_gsod
+from data_sources import REGISTRY, get_source
+from data_trace import span
+from functools import wraps
 import os
-from datetime import datetime, timezone
-from collections import OrderedDict as odict
+import json
+from datetime import datetime
 from typing import Union
-from bidict import bidict
-import asyncio
 
 def dupless(lst:list) -> bool:
     'returns true if all values in list are unique (i.e. if lst is an ordered set)'
     return lst == list(set(lst))
 
+def _stage(flag: str):
+    'runs a WeatherData stage in a data_trace span named after it, tagged with the source, types and dates, and whether it succeeded'
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with span(f'WeatherData.{method.__name__}', source=self.label, types=self._typestr, dates=self._timestr) as s:
+                result = method(self, *args, **kwargs)
+                s.set(ok=bool(getattr(self, flag)))
+            return result
+        return wrapper
+    return decorate
+
 class WeatherData:
     '''
     This struct is intended to abstract the processes of data_downloader and data_preprocessor for various DMiner data sources.
     Simply initialize, call download, and call preprocessing, which will also validate itself.
 
-    Accepts source "ERA5" ([read more here](https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation)) or number 1, 
-    "IPCC Global Climate Model (GCM) Output" ([read more here](https://ipcc-data.org/sim/gcm_monthly/)) or number 2, 
-    "Global Surface Summary of the Day - GSOD" ([read more here](https://www.ncei.noaa.gov/access/metadata/landing-page/bin/iso?id=gov.noaa.ncdc:C00516)) or number 3.
+    Accepts any source registered in data_sources, by name or number: "ERA5" (1), "IPCC Global Climate Model (GCM) Output" (2),
+    "Global Surface Summary of the Day - GSOD" (3). Each source only imports what it needs to download or preprocess when it does so.
 
     If data for this is known an exclusive fp will be made to it in self.data, and likewise for preprocessed_data.
 
@@ -27,106 +36,76 @@ class WeatherData:
 
     Currently only handling data_type='tmp'
     '''
-    SOURCES = bidict({
-        'ERA5': 1,
-        'IPCC Global Climate Model (GCM) Output': 2,
-        'Global Surface Summary of the Day - GSOD': 3
-    })
-    GCMS = bidict({
-        'SSP245': 1,
-        'SSP585': 2
-    })
-    TYPE_MAP = { # maps our internal shorthand to the download servers expected name and the downloaded file's(s') column name(s)
-        'tmp': { # temperatures are only considered at surface-level for our purposes.
-            1: ('2m_temperature', 't2m'),
-            2: ('2m_temperature', 't2m'),
-            3: '?'
-        },
-        'percip': {
-            1: ('total_precipitation', 'tp'),
-            2: ('total_precipitation', 'tp')
-        }
-    }
-    DEFAULT_TYPE_MAP = {
-        1: (['2m_temperature', 'total_precipitation'], ['t2m', 'tp'], ['tmp', 'percip']), # i'm in chronological order!
-        2: (['2m_temperature', 'total_precipitation'], ['t2m', 'tp'], ['tmp', 'percip'])
-    }
-    DATE_MAP = {
-        1: (datetime(1940, 1, 1, tzinfo=timezone.utc), 
-            datetime(2023, 6, 30, tzinfo=timezone.utc)), # data after 2015 will be used for confirming the quality of the trained model
-        2: (datetime(1979, 1, 1, tzinfo=timezone.utc), datetime(2100, 1, 1, 23, tzinfo=timezone.utc)),
-        3: (datetime(1979, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 1, 23, tzinfo=timezone.utc)) # GSOD records actually begin in 1929.
-    } # like GSOD, data continues to present, but we have decided to train model on data until 2015-01-01 00:00.
-    # in effect this will be downloading for all possible hours of every day, and later averaging all of them.
-
-    def __init__(self, source: Union[str, int], gcm_type=None, data_types='default', start_date:datetime=None, end_date:datetime=None, force=False, verbose=False):
-        '''
-        Source implies date ranges (see DATE_MAP), overriding dates is possible, but support has been deprecated since 2023-07-01.
-
-        data_types must be either str of expected types (see TYPE_MAP) or list thereof. 
+    def __init__(self, source: Union[str, int], gcm_type=None, data_types='default', start_date:datetime=None, end_date:datetime=None, force=False, verbose=False,
+                 region=None):
+        '''
+        Source implies date ranges (see Source.dates), overriding dates is possible, but support has been deprecated since 2023-07-01.
+
+        data_types must be either str of expected types (see Source.types) or list thereof. 
         alternatively 'default' assumes the values based on what is needed for dminer research.
-        similarly, datetimes of None will be replaced with defaults (see DATE_MAP).
+        similarly, datetimes of None will be replaced with defaults (see Source.dates).
 
         if source is GCM (2), gcm_type must be specified: either 'SSP245' (1) or 'SSP585' (2). 
         
         by default force will only apply to preprocessing(). pass force=None when calling download for the same effect there.
+
+        region restricts every stage to a (south, west, north, east) box in degrees, a list of boxes, or a data_spatial.Region:
+        ERA5 only downloads the area around it, preprocessing only reads, regrids and writes its cells, and validation only expects those.
+        a region gets its own download and preprocessed folders (and cache entries), named after Region.key.
         '''
-        assert gcm_type in self.SOURCES or gcm_type in self.SOURCES.inverse, f'Invalid source: {source}'
-        if isinstance(source, int): self.source = source
-        else: self.source = self.SOURCES[source] # self.source will be a number
-        if self.source == 2:
-            assert gcm_type in self.GCMS or gcm_type in self.GCMS.inverse, f'Invalid GCM type: {gcm_type}'
-            if isinstance(gcm_type, int): self.gcm_type = gcm_type
-            else: self.gcm_type = self.GCMS[gcm_type]
+        self._backend = get_source(source)
+        self.source = self._backend.number # self.source will be a number
+        self.gcm_type = None
+        if self._backend.variants:
+            variants = self._backend.variants
+            assert gcm_type in variants or gcm_type in variants.inverse, f'Invalid GCM type: {gcm_type}'
+            self.gcm_type = gcm_type if isinstance(gcm_type, int) else variants[gcm_type]
             
         # date mapping to presumed values for our experiments if not overridden in parameters
         if not start_date and end_date: print('WARNING:\tend_date provided but not start_date --is this intentional?')
-        self.start_date = start_date if isinstance(start_date, datetime) else self.DATE_MAP[self.source][0]
-        self.end_date = end_date if isinstance(end_date, datetime) else self.DATE_MAP[self.source][1]
+        self.start_date = start_date if isinstance(start_date, datetime) else self._backend.dates[0]
+        self.end_date = end_date if isinstance(end_date, datetime) else self._backend.dates[1]
         if self.end_date == self.start_date: print(f'asking for weather data from source {source}?... weird')
         assert not (end_date and self.end_date < self.start_date), 'End date not after start date'
 
         assert isinstance(force, bool), 'Force not bool'
         self.force = force
 
-        assert isinstance(force, bool), 'Verbose not bool'
+        assert isinstance(verbose, bool), 'Verbose not bool'
         self.verbose = verbose
 
         self.downloaded = False
         self.preprocessed = False
         self.validated = False
+        self.report = None
+
+        if data_types == 'default': data_types = list(self._backend.defaults)
+        elif isinstance(data_types, str): data_types = [data_types]
+        else: assert dupless(data_types), 'data_types passed in is not unique list'
+        self.data_types = data_types
+        self._downloadingtypenames = [] # data label name during the downloading process
+        self._downloadedtypenames = [] # data label name once downloaded, to be transformed to standard format in preprocessing
+        for e in data_types: 
+            assert any(e in s.types for s in REGISTRY.values()), f"Incorrect data type '{e}'"
+            assert e in self._backend.types, f"Invalid data type '{e}' for source-type {self.source}"
+            dlingname, dlname = self._backend.types[e]
+            self._downloadingtypenames.append(dlingname)
+            self._downloadedtypenames.append(dlname)
 
-        if data_types == 'default': 
-            self._downloadingtypenames, self._downloadedtypenames, self.data_types = self.DEFAULT_TYPE_MAP[self.source]
-        else:
-            if isinstance(data_types, str): data_types = [data_types]
-            else: assert dupless(data_types), 'data_types passed in is not unique list'
-            self.data_types = data_types
-            self._downloadingtypenames = [] # data label name during the downloading process
-            self._downloadedtypenames = [] # data label name once downloaded, to be transformed to standard format in preprocessing
-            for e in data_types: 
-                assert e in self.TYPE_MAP, f"Incorrect data type '{e}'"
-                assert self.source in self.TYPE_MAP[e], f"Invalid data type '{e}' for source-type {self.source}"
-                dlingname, dlname = self.TYPE_MAP[e][self.source]
-                self._downloadingtypenames.append(dlingname)
-                self._downloadedtypenames.append(dlname)
+        if region is not None:
+            from data_spatial import Region
+            region = Region(region)
+        self.region = region
 
         self._timestr = f"from {self.start_date.strftime('%Y-%m-%d')} - {self.end_date.strftime('%Y-%m-%d')}" if self.end_date else f'at {self.start_date}'
         self._typestr = ', '.join(self.data_types)
-        self._sourcestr = f'GCM ({list(self.GCMS)[self.gcm_type-1]})' if self.source == 2 else list(self.SOURCES)[self.source-1]
-        self._str = f'WeatherData source {self._sourcestr} ({self.source}), type(s) {self._typestr}, {self._timestr}'
-        self._downloadat = f'./downloads/{self.source}/{self._typestr}/{self._timestr}/'
-        self._preprocessat = f'./preprocessed/{self.source}/{self._typestr}/{self._timestr}/'
-        self._downloadpatterns = {
-            1: self._downloadat + 'data.nc',
-            2: self._downloadat + 'data...', # need updating
-            3: self._downloadat + 'data...' # need updating
-        }
-        self._preprocesspatterns = {
-            1: self._preprocessat + 'data.csv',
-            2: self._preprocessat + 'data...', # need updating
-            3: self._preprocessat + 'data...' # need updating
-        }
+        self._sourcestr = self._backend.describe(self.gcm_type)
+        self.label = self._backend.label_of(self.gcm_type) # short name, e.g. for merged columns
+        self._str = f'WeatherData source {self._sourcestr} ({self.source}), type(s) {self._typestr}, {self._timestr}' + (f', {region}' if region else '')
+        self._sourcepath = self._backend.path_of(self.gcm_type)
+        regionpath = f'{region.key}/' if region else ''
+        self._downloadat = f'./downloads/{self._sourcepath}/{self._typestr}/{regionpath}{self._timestr}/'
+        self._preprocessat = f'./preprocessed/{self._sourcepath}/{self._typestr}/{regionpath}' # one store for all dates, readers filter by date
 
         if verbose: print(f'{self} initialized.')
 
@@ -139,75 +118,143 @@ class WeatherData:
     def __str__(self) -> str:
         return self._str
 
+    @_stage('downloaded')
     def download(self, force=False):
         '''
         if force is false this function will skip downloading if a download exists in ./downloads/$SOURCE/$DATA_TYPE/$DATE
+        (for ERA5 a legacy data.nc)
         
-        downloads world data
+        downloads world data, or only the area around self.region (ERA5)
+
+        ERA5 goes through the shared DownloadCache in ./downloads/cache/: only the (variable, month) units that no earlier
+        WeatherData downloaded are fetched, and $DATE becomes a folder of links to the cached units. force re-fetches them all.
         '''
         if not os.path.exists(self._downloadat): os.makedirs(self._downloadat) 
-        if os.path.exists(self._downloadpatterns[self.source]) and (not force if isinstance(force, bool) else not self.force):
+        force = force if isinstance(force, bool) else self.force
+        marker = self._backend.download_marker
+        if marker and os.path.exists(self._downloadat + marker) and not force:
             print(f'{self} data already exists. Skipping download.')
             self.downloaded = True
             return
 
-        if self.source == 1: 
-            self.downloaded = download_era5_data(self._downloadingtypenames, 
-                self.start_date, self.end_date, self._downloadat)
-        elif self.source == 2: 
-            self.downloaded = download_gcm_data(self._downloadingtypenames, self.gcm_type,
-                self.start_date, self.end_date, self._downloadat)
-        elif self.source == 3: 
-            self.downloaded = download_gsod_data(self._downloadingtypenames, 
-                self.start_date, self.end_date, self._downloadat)
-        else: assert False, 'unexpected source in downloader'
+        self.downloaded = self._backend.download(self, force)
 
         if not self.downloaded: print(f'{self} reported a failed download')
         elif self.verbose: print(f'{self} reported a successful download')
 
-    def preprocess(self, release=True):
+    @_stage('preprocessed')
+    def preprocess(self, release=True, interpolate=1.25, export_csv=False, incremental=True, pyramid=True):
         '''
-        if force is false this function will skip preprocessing if an export exists in ./preprocessed/$SOURCE/$DATA_TYPE/$DATE
+        preprocesses into ./preprocessed/$SOURCE/$DATA_TYPE/ (the partitioned store, see data_store), which is shared by
+        every date range. export_csv=True also writes the old single data.csv next to it.
 
-        interpolates globally to 1.25 degrees.
+        if incremental (and force is false) only the months whose downloads are new or changed since the last run are processed,
+        so a monthly refresh only costs that month. if force is true every month of this date range is rewritten
+        (months other date ranges wrote are kept, unless the preprocessing parameters changed).
+        if not incremental and force is false this function will skip preprocessing if the store exists.
+
+        interpolates globally (or over self.region) to 1.25 degrees. interpolate may instead be a data_regridder.Regridder (e.g. method='conservative'),
+        whose weights are then shared by every WeatherData it is passed to.
+
+        if pyramid, the month/year/decade aggregates of the store are brought up to date afterwards (see data_pyramid),
+        which is what the maps of data_plotter are drawn from.
         '''
         if not os.path.exists(self._preprocessat): os.makedirs(self._preprocessat)
-        if not self.force and os.path.exists(self._preprocesspatterns[self.source]):
+        if not self.force and not incremental and os.path.exists(self._preprocessat + 'store/'):
             print(f'{self} data already exists. Skipping preprocessing.')
             self.preprocessed = True
             return
         
-        if self.source == 1: 
-            self.preprocessed = preprocess_era5_data(self._downloadedtypenames, self.data_types,
-                1.25, self._downloadat, self._preprocessat, self.verbose)
-        elif self.source == 2: 
-            self.preprocessed = preprocess_gcm_data(self._downloadedtypenames, self.data_types,
-                1.25, self._downloadat, self._preprocessat, self.verbose)
-        elif self.source == 3: 
-            self.preprocessed = preprocess_gsod_data(self._downloadedtypenames, self.data_types,
-                1.25, self._downloadat, self._preprocessat, self.verbose)
-        else: assert False, 'unexpected source in preprocessor'
+        self.preprocessed = self._backend.preprocess(self, interpolate, export_csv, incremental and not self.force)
 
         if not self.preprocessed: print(f'{self} reported a failed preprocessing')
         elif self.verbose: print(f"dataframe {self} saved as with columns noted above")
+        if self.preprocessed and pyramid and interpolate:
+            from data_pyramid import build_pyramid
+            with span('preprocess.pyramid', source=self.label):
+                build_pyramid(self._preprocessat, self.data_types, getattr(interpolate, 'resolution', interpolate),
+                    incremental=incremental and not self.force, verbose=self.verbose)
     
+    def cube(self, interpolation=1.25, mmap=True):
+        '''
+        the preprocessed data of this WeatherData as a data_cube.Cube: one float32 time x latitude x longitude array per data type.
+        it is built from the store once and saved in {self._preprocessat}cube/, then loaded from there (memory-mapped if mmap)
+        until preprocessing changes the store or the dates change.
+        '''
+        from data_cube import Cube
+        assert os.path.exists(self._preprocessat + 'store/'), f'{self} is not preprocessed yet'
+        path = self._preprocessat + 'cube/'
+        built = {'state': os.stat(self._preprocessat + 'state.json').st_mtime_ns, 'dates': [str(self.start_date), str(self.end_date)]}
+        info = Cube.info(path)
+        if info and all(info.get(k) == v for k, v in built.items()) and info['interpolation'] == interpolation and info['variables'] == self.data_types:
+            return Cube.load(path, mmap=mmap)
+
+        # built through memory maps in {path}, decades of days never have to fit in memory
+        cube = Cube.from_store(self._preprocessat + 'store/', self.data_types, self.start_date, self.end_date, interpolation, path=path, **built)
+        if self.verbose: print(f'{cube} saved to {path}')
+        return cube if mmap else Cube.load(path)
+
+    def export_raw(self, save_to:str=None, interpolation=1.25) -> str:
+        '''
+        exports the preprocessed data types as fixed-layout float32 arrays (time x latitude x longitude, one {type}.f32 file each)
+        with a raw.json sidecar describing them, to {save_to} ({self._preprocessat}raw/ by default). see data_cube.export_raw.
+        training processes open it with data_cube.RawArrays (or np.memmap directly) and slice days without copying or parsing.
+        the export is skipped while it is up to date with the store and dates.
+        '''
+        from data_cube import export_raw
+        from data_cache import files_fingerprint
+        save_to = save_to or self._preprocessat + 'raw/'
+        built = {'source': self.label, 'store': files_fingerprint([self._preprocessat + 'store/'])}
+        if os.path.exists(save_to + 'raw.json'):
+            meta = json.load(open(save_to + 'raw.json'))
+            if meta.get('store') == built['store'] and 'present' in meta and meta['time']['start'] == self.start_date.strftime('%Y-%m-%d') \
+                    and meta['time']['count'] == (self.end_date.date() - self.start_date.date()).days + 1 and list(meta['variables']) == self.data_types \
+                    and meta['latitude']['step'] == interpolation:
+                if self.verbose: print(f'{save_to} is up to date')
+                return save_to
+        with span('WeatherData.export_raw', source=self.label):
+            export_raw(self._preprocessat + 'store/', save_to, self.data_types, self.start_date, self.end_date, interpolation, **built)
+        if self.verbose: print(f'{self} exported to {save_to}')
+        return save_to
+
+    def export_series(self, save_to:str=None, interpolation=1.25) -> str:
+        '''
+        lays the preprocessed data types out point-major (latitude x longitude x time, see data_cube.export_series) in {save_to}
+        ({self._preprocessat}series/ by default), so that the whole history of a cell is one contiguous read.
+        it is built from the raw export (brought up to date first, see export_raw) and rebuilt only when that changed.
+        '''
+        from data_cube import export_series
+        from data_cache import files_fingerprint
+        raw = self.export_raw(interpolation=interpolation)
+        save_to = save_to or self._preprocessat + 'series/'
+        built = files_fingerprint([raw + 'raw.json']) # rewritten with every export
+        if os.path.exists(save_to + 'series.json') and json.load(open(save_to + 'series.json')).get('raw') == built:
+            if self.verbose: print(f'{save_to} is up to date')
+            return save_to
+        with span('WeatherData.export_series', source=self.label):
+            export_series(raw, save_to, source=self.label, raw=built)
+        if self.verbose: print(f'{self} laid out per cell in {save_to}')
+        return save_to
+
+    def stations(self, interpolation=1.25):
+        '''
+        the data_spatial.StationIndex of the GSOD stations in this download (built once, then cached in ./cache/stations/).
+        answers nearest-cell, radius and k-nearest queries for every station at once.
+        '''
+        assert self.source == 3, 'only GSOD data comes from stations'
+        from data_spatial import StationIndex
+        return StationIndex.from_isd_history(self._downloadat + 'isd-history.csv', interpolation)
+
+    @_stage('validated')
     def validate(self, verbose=True):
         '''
         verbose if not nonetype will override self.verbose value in the context of this function.
         
-        validates only preprocessed data.
+        validates only preprocessed data. the structured result is kept in self.report (see data_validation.ValidationReport).
         '''
+        self.validated = self._backend.validate(self, verbose if isinstance(verbose, bool) else self.verbose)
 
-        if self.source == 1: 
-            self.validated = validate_preprocessed_era5(self.data_types,
-                verbose if isinstance(verbose, bool) else self.verbose, self.start_date, self.end_date, 1.25, self._preprocessat)
-        elif self.source == 2: 
-            self.validated = validate_preprocessed_gcm(self.data_types,
-                verbose if isinstance(verbose, bool) else self.verbose, self.start_date, self.end_date, 1.25, self._preprocessat)
-        elif self.source == 3: 
-            self.validated = validate_preprocessed_gsod(self.data_types,
-                verbose if isinstance(verbose, bool) else self.verbose, self.start_date, self.end_date, 1.25, self._preprocessat)
-        else: assert False, 'unexpected source in validator'
-
-        if not self.preprocessed: print(f'{self} reported a failed validation')
+        self.report = self.validated
+        self.validated = bool(self.validated)
+        if not self.validated: print(f'{self} reported a failed validation')
         elif verbose: print(f"{self} passed validation")
@@ -1,18 +1,18 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-from data_downloader import *
-from data_plotter import *
-from data_preprocessor import *
 from ingest_struct import WeatherData
-import asyncio
+from meta_struct import WorkingData
 
 def main():
     #test = WeatherData(2, "tmp", datetime.strptime('2023-04-02', '%Y-%m-%d'), datetime.strptime('2023-04-30', '%Y-%m-%d'))
-    test = WeatherData(2, 2, force=True, verbose=True)
-    print(test)
-    test.download()
-    test.preprocess()
-    test.validate()
+    sources = [
+        WeatherData(1, verbose=True),
+        WeatherData(2, 'SSP245', verbose=True),
+        WeatherData(2, 'SSP585', verbose=True),
+    ]
+    working = WorkingData(sources)
+    print(working)
+    # downloads, preprocessing and validation of every source run side by side
+    working.run(verbose=True)
+    print(working.status)
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,16 @@
-from data_merger import *
-from data_plotter import *
 from ingest_struct import WeatherData
+import os
 import string
 import random
 from typing import Union
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import asyncio
 
+def _run_stage(data: WeatherData, stage: str) -> WeatherData:
+    'runs one stage of a WeatherData in whichever worker it was sent to, and hands it back with its updated state'
+    getattr(data, stage)()
+    return data
+
 class WorkingData:
     '''
     This struct is intended to abstract the process of data_merger and data_plotter.
@@ -14,41 +19,166 @@ class WorkingData:
 
     You may set a contant UID value for WorkingData to proceed assuming it has prepared its data before. 
     Use with CAUTION though, as this obviously may be unpredictable.
+
+    WeatherData that is not preprocessed yet can be brought up to date with run(), which schedules the stages of all of them at once.
     '''
-    def __init__(self, data: Union[WeatherData, list], UID=''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(16))):
+    STAGES = ('download', 'preprocess', 'validate') # each stage of a WeatherData depends on the one before it
+    RESOURCES = {'download': 'network', 'preprocess': 'cpu', 'validate': 'cpu'}
+    LIMITS = {'network': 4, 'cpu': os.cpu_count() or 1} # stages running at once per resource class
+
+    def __init__(self, data: Union[WeatherData, list], UID=None):
         # here we really need to enforce that it's in a list form for future logic to work, and we need to ensure that each element in the list is WeatherData.
-        self.merged = isinstance(data, WeatherData)
-        if not self.merged: data = [data]
-        assert all([e.preprocessed_data for e in data]), "WeatherData is not fully preprocessed" # assuming list is all weatherdata
+        if isinstance(data, WeatherData): data = [data]
+        assert all(isinstance(e, WeatherData) for e in data), 'WorkingData expects WeatherData or a list thereof'
+        self.merged = len(data) == 1
         self.data = data
+        UID = UID or ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(16))
+        self.status = {}
 
         self.prepared = False
         self.UID = UID
-        self.df = None
+        self.cubes = None # label -> data_cube.Cube, see load
+        self.series_arrays = {} # label -> (fingerprint, data_cube.SeriesArrays), see series
         self._folder = f"./working/{self.UID}/"
-        self._datastring = '\n\t' + '\n\t'.join(data)
+        self._datastring = '\n\t' + '\n\t'.join(str(e) for e in data)
         self._str = f'WorkingData {self._folder} containing the following data:\n\t{self._datastring}'
 
     def __str__(self):
         return self._str
 
+    def run(self, stages=STAGES, limits:dict=None, verbose=False) -> bool:
+        '''
+        runs {stages} of every WeatherData as one dependency graph: a stage starts as soon as the previous stage of the same
+        WeatherData succeeded, independently of the others. network-bound stages (downloads) run on a thread pool, 
+        cpu-bound ones (preprocessing, validation) on a process pool, each bounded by its own limit in {limits} (see LIMITS),
+        so a full refresh takes about as long as its slowest source.
+
+        self.status maps (index of the WeatherData, stage) to True/False once done, or None if skipped because a dependency failed.
+        returns whether every stage succeeded.
+        '''
+        return asyncio.run(self._run(stages, {**self.LIMITS, **(limits or {})}, verbose))
+
+    async def _run(self, stages, limits: dict, verbose: bool) -> bool:
+        loop = asyncio.get_event_loop()
+        pools = {'network': ThreadPoolExecutor(limits['network']), 'cpu': ProcessPoolExecutor(limits['cpu'])}
+        flags = {'download': 'downloaded', 'preprocess': 'preprocessed', 'validate': 'validated'}
+        tasks = {}
+
+        async def node(i: int, stage: str, after):
+            if after is not None and not await after: 
+                self.status[i, stage] = None
+                return False
+            pool = pools[self.RESOURCES[stage]]
+            result = await loop.run_in_executor(pool, _run_stage, self.data[i], stage)
+            if pool is pools['cpu']: self.data[i].__dict__.update(result.__dict__) # the worker had a copy
+            self.status[i, stage] = bool(getattr(self.data[i], flags[stage]))
+            if verbose: print(f"{self.data[i]} {stage} {'done' if self.status[i, stage] else 'FAILED'}")
+            return self.status[i, stage]
+
+        for i in range(len(self.data)):
+            after = None
+            for stage in stages:
+                after = tasks[i, stage] = asyncio.ensure_future(node(i, stage, after))
+        try: done = await asyncio.gather(*tasks.values())
+        finally:
+            for pool in pools.values(): pool.shutdown()
+        return all(done)
+
+    def load(self, interpolation=1.25, mmap=True) -> dict:
+        '''
+        the preprocessed data of every WeatherData as dense cubes (label -> data_cube.Cube, see WeatherData.cube), kept in self.cubes.
+        a cube holds only the values, so it takes a fraction of the memory and disk of the same data in long format.
+        cubes are kept in the data_cache too, so loading again (or from another WorkingData) is free until a store changes.
+        '''
+        from data_cache import cached
+        self.cubes = {e.label: cached(('cube', e._preprocessat, e._timestr, interpolation, mmap), [e._preprocessat + 'store/'],
+            lambda e=e: e.cube(interpolation, mmap)) for e in self.data}
+        return self.cubes
+
+    def read(self, label:str=None, columns:list=None, start_date=None, end_date=None):
+        '''
+        long-format data of the merged store in "./working/{self.UID}/store/", or of the WeatherData labelled {label},
+        through the process-wide data_cache: reading the same data again hits memory until the store is rewritten.
+        the frame is shared, copy it before modifying it.
+        '''
+        from data_cache import cached
+        from data_store import read_store
+        roots = {e.label: e._preprocessat + 'store/' for e in self.data}
+        assert label is None or label in roots, f'no WeatherData labelled {label} in {self}'
+        root = f'{self._folder}store/' if label is None else roots[label]
+        key = ('read', root, tuple(columns) if columns else None, str(start_date), str(end_date))
+        return cached(key, [root], lambda: read_store(root, columns, start_date, end_date))
+
+    def batches(self, inputs:str=None, targets:str=None, input_interpolation=1.25, target_interpolation=1.25, **kwargs):
+        '''
+        training batches pairing the WeatherData labelled {inputs} (the GCM by default) with the one labelled {targets}
+        (the first other one by default), through their raw exports (see WeatherData.export_raw, which are made or refreshed here).
+        the interpolations are those the two were preprocessed with. {kwargs} go to data_loader.PairedBatches
+        (patch, window, batch_size, seed, prefetch...), iterate over the result once per epoch.
+        '''
+        from data_loader import PairedBatches
+        labels = {e.label: e for e in self.data}
+        inputs = inputs or next((label for label, e in labels.items() if e.source == 2), None)
+        targets = targets or next((label for label in labels if label != inputs), None)
+        assert inputs in labels and targets in labels and inputs != targets, f'no pair of inputs and targets to be found in {self}'
+        return PairedBatches(labels[inputs].export_raw(interpolation=input_interpolation),
+            labels[targets].export_raw(interpolation=target_interpolation), **kwargs)
+
+    def series(self, label:str=None, interpolation=1.25):
+        '''
+        the point-major layout of the WeatherData labelled {label} (the first one by default) as a data_cube.SeriesArrays,
+        exported on first use (see WeatherData.export_series) and kept in self.series_arrays. the queries below go through it.
+        every access compares the fingerprints of the store's state.json and of series.json with those it was opened at
+        (two stats), so after preprocessing or another export the layout is brought up to date and reopened
+        instead of reading unlinked files.
+        '''
+        from data_cache import files_fingerprint
+        labels = {e.label: e for e in self.data}
+        label = label or self.data[0].label
+        assert label in labels, f'no WeatherData labelled {label} in {self}'
+        data = labels[label]
+        watched = lambda path: files_fingerprint([data._preprocessat + 'state.json', path + 'series.json'])
+        kept = self.series_arrays.get(label)
+        if kept is None or kept[0] != watched(kept[1].path) or kept[1].interpolation != interpolation:
+            from data_cube import SeriesArrays
+            path = data.export_series(interpolation=interpolation)
+            self.series_arrays[label] = (watched(path), SeriesArrays(path))
+        return self.series_arrays[label][1]
+
+    def cell(self, lat: float, lon: float, label:str=None):
+        'full daily history of the grid cell holding (lat, lon), time | latitude | longitude | [variable | s...]'
+        return self.series(label).cell(lat, lon)
+
+    def cells(self, lats, lons, label:str=None):
+        'full daily histories of the grid cells holding every (lat, lon), one after the other in the same long format'
+        return self.series(label).cells(lats, lons)
+
+    def nearest(self, lat: float, lon: float, label:str=None):
+        'full daily history of the cell with data nearest to (lat, lon), e.g. the GSOD cell of a station (distance in .attrs["km"])'
+        return self.series(label).nearest(lat, lon)
+
     # I realize it would be very complicated to handle the force=False case here because there's no reliable way of 
     # knowing if WeatherData's files were modified since last initilization. Thus, that will have to wait.
 
     def merger(self, technique="saveall") -> bool:
         '''
-        This function may be needed in the case where data needs to be merged someday; currently data_merger.py is empty
-        Saves to "./working/{self.UID}/"
+        Joins the preprocessed stores of every WeatherData on (time, latitude, longitude), month by month (see data_merger).
+        Saves to "./working/{self.UID}/store/"
         technique:
           - saveall: merge into standardized form without losing any data (warning: duplicates)
           - combine: average values of the same type 
         '''
         if not len(self.data) > 1: return False
-        # it is okay to leave this empty for now.
-        self.merged = True
+        from data_merger import merge_stores
+        stores = {e.label: e._preprocessat + 'store/' for e in self.data}
+        assert len(stores) == len(self.data), 'WorkingData holds the same source twice, nothing to tell them apart by'
+        start, end = min(e.start_date for e in self.data), max(e.end_date for e in self.data)
+        self.merged = merge_stores(stores, self._folder, technique, 1.25, start, end)
+        return self.merged
 
     def prepare(self, technique="combine", force=False) -> bool:
         'Saves to "./working/{self.UID}/". When force is false prepare will skip standardization if already prepared '
+        assert all(e.preprocessed for e in self.data), "WeatherData is not fully preprocessed (see run)"
         if not len(self.data) > 1: self.merger(technique)
         if self.prepared and not force: self.prepared = self.standardize()
         assert self.validate(), f'working data of type {self} --failing validation.'
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of this repo live at its top level
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
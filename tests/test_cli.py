@@ -0,0 +1,27 @@
+import os
+import cli
+from benchmark import synthetic_era5
+from ingest_struct import WeatherData
+
+ARGS = ['preprocess', 'ERA5', '--types', 'tmp', '--start', '2020-01-01', '--end', '2020-01-31', '--no-pyramid']
+
+def _partitions(root: str) -> dict:
+    return {os.path.join(d, f): os.stat(os.path.join(d, f)).st_mtime_ns for d, _, files in os.walk(root) for f in files}
+
+def test_rebuild_rewrites_partitions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = WeatherData('ERA5', data_types='tmp', start_date=cli._date('2020-01-01'), end_date=cli._date('2020-01-31'))
+    os.makedirs(data._downloadat)
+    synthetic_era5(data._downloadat, 2020, 1, resolution=2.5, hours=1)
+
+    assert cli.main(ARGS) == 0
+    written = _partitions(data._preprocessat + 'store/')
+    assert written
+
+    assert cli.main(ARGS) == 0 # nothing changed, nothing rewritten
+    assert _partitions(data._preprocessat + 'store/') == written
+
+    assert cli.main(ARGS + ['--rebuild']) == 0
+    rebuilt = _partitions(data._preprocessat + 'store/')
+    assert rebuilt.keys() == written.keys()
+    assert all(rebuilt[path] != written[path] for path in written)
@@ -0,0 +1,80 @@
+import os
+import time
+import asyncio
+import threading
+from collections import Counter
+from datetime import datetime
+from benchmark import StubCDSClient
+from data_downloader import plan_era5_requests, _run_era5_jobs, ERA5_HOURS
+
+def test_splits_by_month_and_variable():
+    jobs = plan_era5_requests(['2m_temperature', 'total_precipitation'], datetime(2020, 1, 30), datetime(2020, 3, 2))
+    assert [job['target'] for job in jobs] == [f'era5_2020_{m:02d}_{v}.nc' for m in (1, 2, 3) for v in ('2m_temperature', 'total_precipitation')]
+    days = {job['request']['month']: job['request']['day'] for job in jobs}
+    assert days['01'] == ['30', '31']
+    assert days['02'] == [f'{d:02d}' for d in range(1, 30)] # leap year
+    assert days['03'] == ['01', '02']
+    assert all(job['request']['time'] == ERA5_HOURS and job['request']['year'] == '2020' for job in jobs)
+    assert all('area' not in job['request'] for job in jobs)
+
+def test_groups():
+    variables = ['a', 'b', 'c']
+    jobs = plan_era5_requests(variables, datetime(2021, 12, 1), datetime(2022, 1, 31), group_size=2)
+    assert [(j['request']['year'], j['request']['month'], j['request']['variable']) for j in jobs] == \
+        [('2021', '12', ['a', 'b']), ('2021', '12', ['c']), ('2022', '01', ['a', 'b']), ('2022', '01', ['c'])]
+    together = plan_era5_requests(variables, datetime(2021, 12, 1), datetime(2022, 1, 31), group_size=None)
+    assert [j['target'] for j in together] == ['era5_2021_12_a+b+c.nc', 'era5_2022_01_a+b+c.nc']
+
+def test_single_day_and_area():
+    jobs = plan_era5_requests('2m_temperature', datetime(2019, 6, 15), None, hours=['12:00'], area=(62.5, -12.5, 32.5, 32.5))
+    assert len(jobs) == 1
+    request = jobs[0]['request']
+    assert request['day'] == ['15'] and request['time'] == ['12:00']
+    assert request['area'] == [62.5, -12.5, 32.5, 32.5]
+
+class _CountingClient(StubCDSClient):
+    'a stub cds that counts the jobs in flight, and fails the transfers of the months in {fail} that many times'
+    def __init__(self, fail:dict=None):
+        super().__init__(resolution=10., hours=1)
+        self.fail = dict(fail or {})
+        self.lock = threading.Lock()
+        self.active = self.peak = 0
+        self.calls = Counter()
+
+    def retrieve(self, name: str, request: dict):
+        result = super().retrieve(name, request)
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.calls[request['month']] += 1
+        download = result.download
+        def counted(target: str):
+            try:
+                time.sleep(0.05) # long enough for the other jobs to pile up
+                with self.lock:
+                    failing = self.fail.get(request['month'], 0)
+                    if failing: self.fail[request['month']] = failing - 1
+                if failing: raise IOError('stub transfer failed')
+                download(target)
+            finally:
+                with self.lock: self.active -= 1
+        result.download = counted
+        return result
+
+def _run(client, jobs: list, save_to: str, max_inflight=3, retries=2) -> list:
+    return asyncio.run(_run_era5_jobs(client, jobs, save_to, max_inflight, retries, 0, 0, False))
+
+def test_jobs_in_flight_stay_at_the_limit(tmp_path):
+    client = _CountingClient()
+    jobs = plan_era5_requests('2m_temperature', datetime(2020, 1, 1), datetime(2020, 8, 1), hours=['00:00'])
+    assert all(_run(client, jobs, f'{tmp_path}/'))
+    assert client.peak == 3
+    assert sorted(os.listdir(tmp_path)) == sorted(job['target'] for job in jobs) # no .part left behind
+
+def test_failing_jobs_are_retried_then_reported(tmp_path, capsys):
+    client = _CountingClient(fail={'01': 1, '02': 10})
+    jobs = plan_era5_requests('2m_temperature', datetime(2020, 1, 1), datetime(2020, 3, 1), hours=['00:00'])
+    assert _run(client, jobs, f'{tmp_path}/') == [True, False, True]
+    assert client.calls == {'01': 2, '02': 3, '03': 1} # retries=2: three attempts at most
+    assert 'era5_2020_02_2m_temperature.nc failed after 3 attempts' in capsys.readouterr().out
+    assert sorted(os.listdir(tmp_path)) == ['era5_2020_01_2m_temperature.nc', 'era5_2020_03_2m_temperature.nc']
@@ -0,0 +1,78 @@
+import os
+import hashlib
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer
+import pytest
+from benchmark import _ScidbHandler
+from data_downloader import fetch_file, http_session
+
+CONTENT = os.urandom(3 << 20)
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+class _Recording(_ScidbHandler):
+    'records the headers of every request, and drops the connection half way through the first {drops} transfers'
+    requests, drops = [], 0
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if type(self).drops and not self.headers.get('Range'):
+            type(self).drops -= 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(CONTENT)))
+            self.end_headers()
+            self.wfile.write(CONTENT[:len(CONTENT) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        return super().do_GET()
+
+@pytest.fixture
+def server(tmp_path):
+    served = tmp_path / 'served'
+    served.mkdir()
+    (served / 'data.nc').write_bytes(CONTENT)
+    _Recording.requests, _Recording.drops = [], 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_Recording, directory=str(served)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/download?fileId=1&fileName=data.nc'
+    server.shutdown()
+
+def _fetch(url: str, path: str, **kwargs) -> bool:
+    return fetch_file(http_session(1), url, path, backoff=0, verbose=False, **kwargs)
+
+def test_interrupted_transfer_resumes(server, tmp_path):
+    _Recording.drops = 1
+    path = str(tmp_path / 'data.nc')
+    assert _fetch(server, path, sha256=SHA256)
+    assert open(path, 'rb').read() == CONTENT and not os.path.exists(path + '.part')
+    first, resumed = _Recording.requests
+    assert 'Range' not in first and resumed['Range'] == f'bytes={len(CONTENT) // 2}-' # only the second half again
+    assert all(r['Accept-Encoding'] == 'identity' for r in _Recording.requests)
+
+def test_partial_file_resumes(server, tmp_path):
+    path = str(tmp_path / 'data.nc')
+    open(path + '.part', 'wb').write(CONTENT[:1000])
+    assert _fetch(server, path)
+    assert open(path, 'rb').read() == CONTENT
+    assert _Recording.requests[0]['Range'] == 'bytes=1000-'
+
+def test_finished_part_file_is_kept(server, tmp_path):
+    'the server answers 416 when the part file already holds everything, nothing is downloaded again'
+    path = str(tmp_path / 'data.nc')
+    open(path + '.part', 'wb').write(CONTENT)
+    assert _fetch(server, path, sha256=SHA256)
+    assert open(path, 'rb').read() == CONTENT
+    assert len(_Recording.requests) == 1
+
+def test_corrupted_file_is_fetched_again(server, tmp_path):
+    path = str(tmp_path / 'data.nc')
+    open(path + '.part', 'wb').write(b'\0' * len(CONTENT)) # the right size, the wrong bytes
+    assert _fetch(server, path, sha256=SHA256)
+    assert open(path, 'rb').read() == CONTENT
+    assert 'Range' not in _Recording.requests[-1] # started over
+
+def test_wrong_checksum_fails(server, tmp_path):
+    path = str(tmp_path / 'data.nc')
+    assert not _fetch(server, path, sha256='0' * 64, retries=1)
+    assert not os.path.exists(path) and not os.path.exists(path + '.part')
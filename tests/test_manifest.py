@@ -0,0 +1,43 @@
+import json
+from datetime import date, datetime
+import data_downloader
+from benchmark import StubCDSClient
+from data_manifest import DownloadCache
+
+KEY = DownloadCache.key(1, '2m_temperature', 2020, 1)
+
+def _unit(tmp_path, name='unit.nc', content=b'era5') -> str:
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+def test_days_covered(tmp_path):
+    cache = DownloadCache(f'{tmp_path}/cache/')
+    cache.add(KEY, _unit(tmp_path), ('2020-01-01', '2020-01-15'))
+    assert cache.has(KEY) and cache.has(KEY, days=('2020-01-03', '2020-01-15'))
+    assert not cache.has(KEY, days=('2020-01-01', '2020-01-31'))
+    assert cache.missing([KEY], days={KEY: ('2020-01-10', '2020-01-20')}) == [KEY]
+    assert json.load(open(f'{tmp_path}/cache/manifest.json'))[KEY]['days'] == ['2020-01-01', '2020-01-15']
+
+def test_units_without_days_are_whole(tmp_path):
+    'manifests written before days were recorded only held whole months'
+    cache = DownloadCache(f'{tmp_path}/cache/')
+    cache.add(KEY, _unit(tmp_path))
+    assert cache.has(KEY, days=('2020-01-01', '2020-01-31'))
+
+def test_partial_month_is_filled_later(tmp_path, monkeypatch):
+    cache, view = DownloadCache(f'{tmp_path}/cache/'), f'{tmp_path}/view/'
+    client = StubCDSClient(resolution=10., hours=1)
+    download = lambda: data_downloader.download_era5_data('2m_temperature', datetime(2020, 1, 1), datetime(2020, 1, 31), view,
+        client=client, poll=0, backoff=0, cache=cache)
+
+    monkeypatch.setattr(data_downloader, '_latest_era5_day', lambda: date(2020, 1, 15)) # january is not over yet
+    assert download()
+    assert cache.manifest[KEY]['days'] == ['2020-01-01', '2020-01-15']
+    first = cache.manifest[KEY]['sha256']
+    assert download() and cache.manifest[KEY]['sha256'] == first # nothing new is out yet, nothing fetched
+
+    monkeypatch.setattr(data_downloader, '_latest_era5_day', lambda: date(2020, 2, 10))
+    assert download()
+    assert cache.manifest[KEY]['days'] == ['2020-01-01', '2020-01-31']
+    assert cache.manifest[KEY]['sha256'] != first
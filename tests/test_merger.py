@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from data_merger import encode_key, decode_key
+
+def _cells(n=200, seed=0, interpolation=1.25) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'time': pd.Timestamp('1979-01-01') + pd.to_timedelta(rng.integers(0, 20000, n), 'D'),
+        'latitude': rng.integers(0, int(180 / interpolation), n) * interpolation - 90,
+        'longitude': rng.integers(0, int(360 / interpolation), n) * interpolation,
+    })
+
+def test_round_trip():
+    df = _cells()
+    decoded = decode_key(encode_key(df))
+    pd.testing.assert_frame_equal(decoded, df.astype({'latitude': np.float64, 'longitude': np.float64}), check_dtype=False)
+    assert decoded['time'].dtype == 'datetime64[ns]'
+
+def test_round_trip_other_resolution():
+    df = _cells(interpolation=0.25)
+    np.testing.assert_allclose(decode_key(encode_key(df, 0.25), 0.25)[['latitude', 'longitude']].to_numpy(), df[['latitude', 'longitude']].to_numpy())
+
+def test_sorts_by_time_latitude_longitude():
+    df = _cells()
+    keys = encode_key(df)
+    assert len(np.unique(keys)) == len(df.drop_duplicates())
+    by_key = df.iloc[np.argsort(keys, kind='stable')].reset_index(drop=True)
+    pd.testing.assert_frame_equal(by_key, df.sort_values(['time', 'latitude', 'longitude'], kind='stable').reset_index(drop=True))
+
+def test_longitudes_wrap_and_snap():
+    'a -180 -> 180 longitude is the same cell as its 0 -> 360 equivalent, and values off the grid snap to the nearest cell'
+    df = pd.DataFrame({'time': pd.to_datetime(['2000-01-01'] * 4), 'latitude': [10., 10., 10.1, -90.],
+        'longitude': [-1.25, 358.75, 359.9, 0.]})
+    keys = encode_key(df)
+    assert keys[0] == keys[1]
+    decoded = decode_key(keys)
+    assert decoded['longitude'].tolist() == [358.75, 358.75, 0., 0.]
+    assert decoded['latitude'].tolist() == [10., 10., 10., -90.]
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from data_preprocessor import _daily_mean, _to_frame, _time_chunks
+
+def _six_hourly(start='2020-01-30 12:00', periods=20, seed=0) -> xr.Dataset:
+    'two variables every 6 hours with scattered NaNs, a cell that is NaN all of one day, and days cut short at both ends'
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=periods, freq='6H')
+    lat, lon = np.array([-1.25, 0., 1.25]), np.array([0., 1.25, 358.75])
+    data = {v: rng.normal(280, 5, (len(times), len(lat), len(lon))).astype(np.float32) for v in ('t2m', 'tp')}
+    for v in data: data[v][rng.random(data[v].shape) < 0.2] = np.nan
+    data['t2m'][(times.floor('D') == pd.Timestamp('2020-02-01')), 1, 1] = np.nan
+    return xr.Dataset({v: (('time', 'latitude', 'longitude'), a) for v, a in data.items()}, coords={'time': times, 'latitude': lat, 'longitude': lon})
+
+def _previous(data: xr.Dataset) -> pd.DataFrame:
+    'the long-format daily mean preprocessing took before _daily_mean: dropna, then groupby cell and day'
+    df = data.to_dataframe().reset_index().dropna(how='any')
+    df = df.set_index('time')
+    df.index = df.index.to_period('D')
+    df = df.groupby(['latitude', 'longitude', df.index]).mean().reset_index()
+    df['time'] = df['time'].dt.to_timestamp()
+    return df
+
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    return df[['time', 'latitude', 'longitude', 't2m', 'tp']].sort_values(['time', 'latitude', 'longitude']).reset_index(drop=True)
+
+@pytest.mark.parametrize('chunk', [None, 'D', 'M'])
+def test_same_as_groupby(chunk):
+    data = _six_hourly()
+    new = pd.concat([_to_frame(_daily_mean(part, ['t2m', 'tp'])) for _, part in _time_chunks(data, chunk)])
+    expected = _sorted(_previous(data))
+    assert len(expected) < 6 * 9 # 6 days of 9 cells, less the cell-days without a value
+    pd.testing.assert_frame_equal(_sorted(new), expected, check_dtype=False, rtol=1e-6)
+
+def test_days_are_never_split_by_chunks():
+    'chunk boundaries fall on day boundaries, so a day averaged in pieces never happens'
+    data = _six_hourly(periods=40)
+    for chunk in ('D', 'M'):
+        days = [part.indexes['time'].floor('D') for _, part in _time_chunks(data, chunk)]
+        assert sum(len(set(d)) for d in days) == len(set(data.indexes['time'].floor('D')))
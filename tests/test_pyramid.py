@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+from data_pyramid import _cover
+
+def _months(blocks) -> list:
+    'every month the blocks cover, in order'
+    months = []
+    for level, year, month in blocks:
+        if level == 'month': months.append(pd.Period(f'{year}-{month:02d}', 'M'))
+        else: months.extend(pd.period_range(f'{year}-01', f"{year + (9 if level == 'decade' else 0)}-12", freq='M'))
+    return months
+
+def test_decades_then_years_then_months():
+    assert _cover(pd.Period('2009-11', 'M'), pd.Period('2021-03', 'M')) == [('month', 2009, 11), ('month', 2009, 12),
+        ('decade', 2010, None), ('year', 2020, None), ('month', 2021, 1), ('month', 2021, 2), ('month', 2021, 3)]
+
+def test_decades_are_aligned():
+    'a decade block starts on a year ending in 0, so 2015-2024 is years, not a decade'
+    assert _cover(pd.Period('2015-01', 'M'), pd.Period('2024-12', 'M')) == [('year', y, None) for y in range(2015, 2025)]
+
+@pytest.mark.parametrize('start, end', [('1979-01', '2023-08'), ('2000-02', '2000-02'), ('1990-01', '1999-12'), ('2018-07', '2020-06')])
+def test_covers_every_month_once(start, end):
+    start, end = pd.Period(start, 'M'), pd.Period(end, 'M')
+    assert _months(_cover(start, end)) == list(pd.period_range(start, end, freq='M'))
+
+def test_empty_range():
+    assert _cover(pd.Period('2020-02', 'M'), pd.Period('2020-01', 'M')) == []
+
+def test_query_days_averages_the_daily_data(tmp_path):
+    'whole months from the pyramid and the days around them from the store add up to the plain mean of the days'
+    import numpy as np
+    from data_pyramid import build_pyramid, query_days
+    from data_store import write_partition, read_store
+    rng = np.random.default_rng(0)
+    days = pd.date_range('2019-11-20', '2020-03-10', freq='D')
+    cells = [(-90., 0.), (0., 1.25), (10., 358.75), (88.75, 180.)]
+    df = pd.DataFrame([(day, lat, lon) for day in days for lat, lon in cells], columns=['time', 'latitude', 'longitude'])
+    df['tmp'] = rng.normal(10, 5, len(df)).astype(np.float32)
+    df.loc[rng.random(len(df)) < 0.2, 'tmp'] = np.nan
+    write_partition(df, f'{tmp_path}/store/')
+    assert build_pyramid(f'{tmp_path}/', ['tmp'], 1.25, incremental=False)
+
+    start, end = pd.Timestamp('2019-11-25'), pd.Timestamp('2020-03-05')
+    latitude, longitude, values = query_days(f'{tmp_path}/', 'tmp', start, end)
+    daily = read_store(f'{tmp_path}/store/', None, start, end + pd.Timedelta(hours=23))
+    expected = daily.groupby(['latitude', 'longitude'])['tmp'].mean()
+    for (lat, lon), mean in expected.items():
+        got = values[np.flatnonzero(latitude == lat)[0], np.flatnonzero(longitude == lon)[0]]
+        assert got == pytest.approx(mean, rel=1e-6)
+    assert np.isfinite(values).sum() == len(expected)
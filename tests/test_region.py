@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import xarray as xr
+from data_regridder import Regridder
+from data_spatial import Region
+
+def _source(resolution=0.25) -> xr.Dataset:
+    'a smooth field on a -180 -> 180 grid with ERA5-like descending latitudes, as cds returns a region whose west is below 0'
+    lat, lon = np.arange(90, -90 - resolution / 2, -resolution), np.arange(-180, 180, resolution)
+    values = (np.sin(np.deg2rad(lat))[:, None] + np.cos(np.deg2rad(lon))[None, :])[None]
+    return xr.Dataset({'t2m': (('time', 'latitude', 'longitude'), values)}, coords={'time': [0], 'latitude': lat, 'longitude': lon})
+
+def _expected(lat, lon) -> np.ndarray:
+    return np.sin(np.deg2rad(lat))[:, None] + np.cos(np.deg2rad(lon))[None, :]
+
+@pytest.mark.parametrize('box', [(35, -10, 60, 30), (-20, 170, 10, -170), (10, -120, 40, -60)])
+def test_regrid_region_from_pm180_source(box, tmp_path):
+    region = Region(box)
+    lat, lon = region.grid(1.25)
+    assert (lon >= 0).all() and (lon < 360).all()
+    regridder = Regridder(1.25, lat=lat, lon=lon, cache_dir=f'{tmp_path}/')
+    out = regridder(region.subset(_source(), pad=1.25))['t2m'].values[0]
+    assert not np.isnan(out).any()
+    np.testing.assert_allclose(out, _expected(lat, lon), atol=1e-4)
+
+def test_subset_of_wrapped_source_pads_by_its_spacing(tmp_path):
+    'a source whose longitudes wrap (180 -> 359.75, then 0 -> 179.75) is padded by its 0.25 degree cells, not the 360 degree jump'
+    source = _source().assign_coords(longitude=lambda d: d['longitude'] % 360)
+    assert source['longitude'].values[0] == 180 and source['longitude'].values[720] == 0
+    region = Region((35, -10, 60, 30))
+    subset = region.subset(source, pad=1.25)
+    assert subset.sizes['longitude'] == int((40 + 2 * 1.5) / 0.25) + 1 # -11.5 -> 31.5
+    assert subset.sizes['latitude'] == int((25 + 2 * 1.5) / 0.25) + 1
+    lat, lon = region.grid(1.25)
+    out = Regridder(1.25, lat=lat, lon=lon, cache_dir=f'{tmp_path}/')(subset)['t2m'].values[0]
+    np.testing.assert_allclose(out, _expected(lat, lon), atol=1e-4)
+
+def test_region_crossing_zero_grid():
+    lat, lon = Region((35, -10, 60, 30)).grid(1.25)
+    assert lat[0] == 35 and lat[-1] == 60
+    assert lon[0] == 350 and lon[-1] == 30 and len(lon) == 33 # 350 -> 358.75, then 0 -> 30
+
+def test_region_wrapping_around():
+    region = Region((-20, 170, 10, -170))
+    assert region.enclosing() == (-20, 170, 10, 20)
+    assert region.area() == [10, 170, -20, 190]
+    inside = region.contains(np.array([0., 0.]), np.array([175., 185., 200., 160.]))
+    assert inside.tolist() == [[True, True, False, False]] * 2
+
+def test_region_area_west_below_zero():
+    assert Region((35, -10, 60, 30)).area(2.5) == [62.5, -12.5, 32.5, 32.5]
+
+def test_several_boxes():
+    region = Region([(0, 10, 10, 20), (0, 350, 10, 355)])
+    south, west, north, width = region.enclosing()
+    assert (south, west, north, width) == (0, 350, 10, 30) # 350 -> 20 across 0 rather than 10 -> 355
+    mask = region.mask(1.25)
+    assert mask.shape == (144, 288)
+    assert mask[72, 8] and mask[72, 282] and not mask[72, 0] # 10 and 352.5 inside, 0 between the boxes
+
+def test_key_is_order_independent():
+    assert Region([(0, 10, 10, 20), (5, 30, 15, 40)]).key == Region([(5, 30, 15, 40), (0, 10, 10, 20)]).key
+    assert Region((0, -10, 10, 10)) == Region((0, 350, 10, 10))
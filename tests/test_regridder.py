@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import xarray as xr
+from data_regridder import Regridder, _unwrap
+
+def _random(lat, lon, times=2, seed=0) -> xr.Dataset:
+    values = np.random.default_rng(seed).normal(size=(times, len(lat), len(lon)))
+    return xr.Dataset({'t2m': (('time', 'latitude', 'longitude'), values)}, coords={'time': np.arange(times), 'latitude': lat, 'longitude': lon})
+
+def test_linear_matches_xarray_interp(tmp_path):
+    source = _random(np.arange(-90, 90.1, 2.5), np.arange(0, 360, 2.5))
+    regridder = Regridder(1.25, cache_dir=f'{tmp_path}/')
+    expected = source.interp(latitude=regridder.lat, longitude=regridder.lon, method='linear')['t2m'].values
+    out = regridder(source)['t2m'].values
+    assert np.isnan(out).sum() == np.isnan(expected).sum() > 0 # 358.75 is past the last source longitude
+    np.testing.assert_allclose(out, expected, atol=1e-12)
+
+def test_linear_descending_latitudes(tmp_path):
+    'ERA5 latitudes run 90 -> -90, which must give the same result as the same data sorted'
+    source = _random(np.arange(90, -90.1, -2.5), np.arange(0, 360, 2.5))
+    regridder = Regridder(1.25, cache_dir=f'{tmp_path}/')
+    np.testing.assert_allclose(regridder(source)['t2m'].values, regridder(source.sortby('latitude'))['t2m'].values, atol=1e-12)
+
+def test_conservative_keeps_constants_and_skips_nan(tmp_path):
+    source = _random(np.arange(-89.875, 90, 0.25), np.arange(0.125, 360, 0.25), times=1)
+    source['t2m'][:] = 3.
+    source['t2m'][0, :40, :40] = np.nan
+    out = Regridder(1.25, 'conservative', cache_dir=f'{tmp_path}/')(source)['t2m'].values
+    np.testing.assert_allclose(out[np.isfinite(out)], 3.)
+    assert np.isnan(out[0, 3, 3]) # -86.25, 3.75 only overlaps missing cells
+    assert np.isfinite(out[0, 9:, 9:]).all() and np.isfinite(out[0, 8, 8]) # partly missing cells keep the rest
+
+def test_weights_are_cached_on_disk(tmp_path):
+    source = _random(np.arange(-90, 90.1, 2.5), np.arange(0, 360, 2.5))
+    first = Regridder(1.25, cache_dir=f'{tmp_path}/')(source)['t2m'].values
+    assert len(list(tmp_path.glob('linear_*.npz'))) == 1
+    again = Regridder(1.25, cache_dir=f'{tmp_path}/')(source)['t2m'].values
+    np.testing.assert_array_equal(first, again)
+    Regridder(2.5, 'conservative', cache_dir=f'{tmp_path}/')(source)
+    assert len(list(tmp_path.glob('conservative_*.npz'))) == 1 # keyed by method, not shared with linear
+
+@pytest.mark.parametrize('src, origin', [(np.arange(0, 360, 2.5), 0), (np.arange(-180, 180, 2.5), 0), (np.r_[350:360:2.5, 0:30:2.5], 350)])
+def test_unwrap(src, origin):
+    s, d = _unwrap(src, np.array([0., 10.]))
+    assert s.min() == origin and np.all(np.diff(np.sort(s)) == 2.5) # one continuous range
+    assert np.all((d - s.min()) % 360 == (np.array([0., 10.]) - origin) % 360)
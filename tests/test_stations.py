@@ -0,0 +1,42 @@
+import io
+import tarfile
+import numpy as np
+import pandas as pd
+from data_spatial import StationIndex
+from data_preprocessor import _ingest_gsod_year
+from data_store import read_store
+
+IDS = ['72509014739', '01001099999', '94767099999', '72295023174']
+LATS, LONS = [42.36, 70.93, -33.95, 33.94], [-71.01, -8.67, 151.17, -118.39]
+
+def test_positions():
+    index = StationIndex(IDS, LATS, LONS)
+    assert index.positions(['94767099999', 'unknown', '72509014739', '72509014739']).tolist() == [2, -1, 0, 0]
+    assert index.positions([]).tolist() == []
+    assert StationIndex([], [], []).positions(['72509014739']).tolist() == [-1]
+    lat, lon = index.cell_of(['01001099999', 'unknown'])
+    assert lat[0] == 71.25 and lon[0] == 351.25 and np.isnan(lat[1]) and np.isnan(lon[1])
+
+def _archive(path: str, stations: dict):
+    'a gsod_YYYY.tar.gz of one csv per station, each {station: (latitude, longitude, [(date, TEMP)...])}'
+    with tarfile.open(path, 'w:gz') as archive:
+        for station, (lat, lon, days) in stations.items():
+            body = 'STATION,DATE,LATITUDE,LONGITUDE,TEMP\n' + ''.join(f'"{station}","{d}",{lat},{lon},{t}\n' for d, t in days)
+            info = tarfile.TarInfo(f'{station}.csv')
+            info.size = len(body.encode())
+            archive.addfile(info, io.BytesIO(body.encode()))
+
+def test_rows_without_location_are_placed_from_the_index(tmp_path):
+    path = f'{tmp_path}/gsod_2020.tar.gz'
+    _archive(path, {'72509014739': ('', '', [('2020-01-01', 50.), ('2020-01-02', 9999.9)]), # boston, no location in the archive
+        '01001099999': (70.93, -8.67, [('2020-01-01', 14.)]), 'A0000099999': ('', '', [('2020-01-01', 32.)])}) # the last one is unknown
+    rows, cells = _ingest_gsod_year(path, ['TEMP'], ['tmp'], 1.25, f'{tmp_path}/', None, None, index=StationIndex(IDS, LATS, LONS))
+    assert (rows, cells) == (3, 2) # boston's missing value is kept as a station row, but has no cell-day
+    gridded = read_store(f'{tmp_path}/store/').sort_values('latitude')
+    assert gridded[['latitude', 'longitude']].values.tolist() == [[42.5, 288.75], [71.25, 351.25]]
+    np.testing.assert_allclose(gridded['tmp'], [10., -10.])
+
+def test_rows_without_location_are_dropped_without_an_index(tmp_path):
+    path = f'{tmp_path}/gsod_2020.tar.gz'
+    _archive(path, {'72509014739': ('', '', [('2020-01-01', 50.)]), '01001099999': (70.93, -8.67, [('2020-01-01', 14.)])})
+    assert _ingest_gsod_year(path, ['TEMP'], None, 1.25, f'{tmp_path}/', None, None) == (1, 1)